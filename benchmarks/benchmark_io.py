@@ -0,0 +1,70 @@
+"""Benchmarks of the output writer and of the prefetching pipeline
+
+These timings depend on the machine and its load, and so are measured here
+rather than asserted by the tests, which only check that the results are the
+same as without these optimizations. Run from the repository root with:
+
+    python benchmarks/benchmark_io.py
+"""
+import os
+import time
+import tempfile
+import numpy as np
+import pandas as pd
+
+from nixtract.extractors.output import _write_tsv
+from nixtract.cli.base import _pipeline
+
+
+def _best_time(func, n=3):
+    """Shortest wall-clock time of n calls of func, in seconds"""
+    times = []
+    for _ in range(n):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def benchmark_write_tsv(out_dir, n_decimals=4):
+    """Compare _write_tsv to to_csv on a parcel table, as written once per
+    input file
+    """
+    rng = np.random.RandomState(8)
+    timeseries = pd.DataFrame(rng.standard_normal((400, 333)),
+                              columns=[f'region{i}' for i in range(333)])
+    fname = os.path.join(out_dir, 'sub-01_timeseries.tsv')
+    float_format = f'%.{n_decimals}f'
+
+    for output_format in ['tsv', 'tsv.gz']:
+        compression = 'gzip' if output_format == 'tsv.gz' else None
+        expected = _best_time(lambda: timeseries.to_csv(
+            fname, sep='\t', index=False, float_format=float_format,
+            compression=compression
+        ))
+        actual = _best_time(lambda: _write_tsv(timeseries, fname, n_decimals,
+                                               output_format))
+        print(f'{output_format}: to_csv {expected * 1e3:.1f} ms, _write_tsv '
+              f'{actual * 1e3:.1f} ms ({expected / actual:.1f}x)')
+
+
+def benchmark_pipeline(n_items=8, seconds=0.05, n_prefetch=2):
+    """Compare the prefetching pipeline to loading, computing and writing
+    each item one after another, with stages that each take `seconds`
+    """
+    def _stage(x):
+        time.sleep(seconds)
+        return x
+
+    items = list(range(n_items))
+    expected = _best_time(lambda: [_stage(_stage(_stage(x))) for x in items])
+    actual = _best_time(lambda: list(_pipeline(items, _stage, _stage, _stage,
+                                               n_prefetch)))
+    print(f'pipeline: sequential {expected:.2f} s, pipelined {actual:.2f} s '
+          f'({expected / actual:.1f}x)')
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as out_dir:
+        benchmark_write_tsv(out_dir)
+    benchmark_pipeline()
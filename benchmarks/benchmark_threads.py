@@ -0,0 +1,77 @@
+"""Benchmark of splitting the CPUs of a machine between processes (--n_jobs)
+and threads per process (--threads_per_job)
+
+Runs nixtract-cifti on copies of the mock dtseries of the test suite, denoised
+before extraction, once per split of the CPUs, and prints the throughput of
+each split in files/s. Run from the repository root with:
+
+    python benchmarks/benchmark_threads.py
+
+The mock data are built by the test suite, or by running
+`python setup_mock_data.py` in `tests/`.
+"""
+import os
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+import time
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                        'tests', 'data')
+REGRESSORS = ['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z']
+
+
+def cpu_splits(n_cpus):
+    """Every split of n_cpus into processes and threads per process, and
+    processes that each use every CPU
+    """
+    n_cpus = max(n_cpus, 2)
+    return [(n, n_cpus // n) for n in range(1, n_cpus + 1)
+            if n_cpus % n == 0] + [(n_cpus, n_cpus)]
+
+
+def benchmark_threads(out_dir, n_inputs=8, n_cpus=None):
+    """Time nixtract-cifti with every split of the CPUs (see cpu_splits)"""
+    dtseries = os.path.join(DATA_DIR, 'mock', 'gordon.dtseries.nii')
+    roi_file = os.path.join(
+        DATA_DIR, 'Gordon333_FreesurferSubcortical.32k_fs_LR.dlabel.nii'
+    )
+    if not os.path.exists(dtseries):
+        raise FileNotFoundError(f'{dtseries} not found. Run '
+                                '`python setup_mock_data.py` in tests/')
+
+    input_files = []
+    for i in range(n_inputs):
+        fname = os.path.join(out_dir, f'sub-{i:02d}.dtseries.nii')
+        shutil.copy2(dtseries, fname)
+        input_files.append(fname)
+    config_file = os.path.join(out_dir, 'config.json')
+    regressor_file = os.path.join(DATA_DIR, 'example_regressors.tsv')
+    with open(config_file, 'w') as f:
+        json.dump({'regressor_files': [regressor_file] * n_inputs,
+                   'regressors': REGRESSORS}, f)
+
+    for n_jobs, n_threads in cpu_splits(n_cpus or os.cpu_count() or 1):
+        cmd = (f"nixtract-cifti "
+               f"{os.path.join(out_dir, f'jobs-{n_jobs}_threads-{n_threads}')} "
+               f"--input_files {' '.join(input_files)} --roi_file {roi_file} "
+               f"-c {config_file} --denoise-pre-extract --n_jobs {n_jobs} "
+               f"--threads_per_job {n_threads}")
+        start = time.perf_counter()
+        subprocess.run(cmd.split(), check=True, stdout=subprocess.DEVNULL)
+        rate = n_inputs / (time.perf_counter() - start)
+        print(f'n_jobs {n_jobs}, threads_per_job {n_threads}: '
+              f'{rate:.2f} files/s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_inputs', type=int, default=8,
+                        help='Number of copies of the mock dtseries')
+    parser.add_argument('--n_cpus', type=int,
+                        help='Number of CPUs to split. Default: all CPUs')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as out_dir:
+        benchmark_threads(out_dir, args.n_inputs, args.n_cpus)
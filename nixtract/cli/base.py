@@ -5,9 +5,19 @@ import sys
 import ast
 import argparse
 import glob
+import shutil
+import tempfile
 import json
-from itertools import repeat
+import time
+from datetime import datetime
+import hashlib
+import queue
+from collections import deque
+from itertools import islice
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 import multiprocessing
+from threadpoolctl import threadpool_limits
 
 # import for version reporting
 from platform import python_version
@@ -20,6 +30,11 @@ import pandas
 import natsort
 import pkg_resources  # for nixtract itself
 
+from nixtract.extractors.summary import SUMMARY_STATS
+from nixtract.extractors.output import OUTPUT_FORMATS
+from nixtract.extractors.plan import file_hash
+from nixtract.extractors.store import store_key
+
 def base_cli(parser):
     """Generate CLI with arguments shared among all interfaces"""
     
@@ -80,11 +95,117 @@ def base_cli(parser):
     parser.add_argument('--n_jobs', type=int, default=1,
                         help='The number of CPUs to use if parallelization is '
                              'desired. Default: 1 (serial processing)')
+    parser.add_argument('--pool_chunksize', type=int, default=1,
+                        help='Number of input files sent to a CPU at a time '
+                             'when n_jobs > 1. Larger chunks reduce the '
+                             'overhead of many small input files. Default: 1')
+    parser.add_argument('--max_tasks_per_child', type=int,
+                        help='Number of input files that each CPU extracts '
+                             'before it is replaced by a new process when '
+                             'n_jobs > 1, which releases the memory that '
+                             'long-running processes accumulate. Default: '
+                             'processes are never replaced')
+    parser.add_argument('--threads_per_job', type=int,
+                        help='Number of threads that numpy, scipy and nilearn '
+                             'can use for linear algebra (BLAS) and OpenMP '
+                             'operations in each extraction, e.g. when '
+                             'denoising. Also the number of threads that '
+                             'denoise vertices with --denoise-pre-extract '
+                             '(CIFTI and GIFTI). Default: the number of CPUs '
+                             'divided '
+                             'by n_jobs when n_jobs > 1, so that processes do '
+                             'not compete for CPUs, and no limit otherwise')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='Number of input files that are loaded (read and '
+                             'decompressed) by background threads ahead of '
+                             'their extraction, while outputs are saved by a '
+                             'separate thread, so that reading, computing and '
+                             'writing overlap. When n_jobs > 1, each process '
+                             'extracts batches of prefetch + 1 input files '
+                             '(or pool_chunksize, if larger) in this way. '
+                             'Each prefetched input file is held in memory '
+                             'until it is extracted. Default: 0 (no '
+                             'prefetching)')
+    parser.add_argument('--max_memory', type=str,
+                        help='Memory budget of parallel extraction when '
+                             'n_jobs > 1, e.g. 16G or 512M (plain numbers '
+                             'are bytes). The memory of each input file is '
+                             'estimated from its header, and an input file '
+                             'only starts once the estimated memory of the '
+                             'running input files leaves room for it, so '
+                             'large input files run alongside fewer others. '
+                             'Input files that exceed the budget run on '
+                             'their own. Default: no budget, n_jobs input '
+                             'files run at a time')
     parser.add_argument('--n_decimals', type=int, 
                         help='Specify the number of decimals for output '
                              'timeseries files. Fewer decimals are recommended '
                              'for reducing disk-space, particularly for large '
                              'extractions')
+    parser.add_argument('--output_format', type=str, default='tsv',
+                        choices=list(OUTPUT_FORMATS),
+                        help='File format of the output timeseries. tsv is '
+                             'a tab-separated text file, which is compressed '
+                             'while it is written for tsv.gz (gzip) and '
+                             'tsv.zst (zstd, which requires zstandard). '
+                             'parquet and feather '
+                             '(which require pyarrow) and hdf5 (which requires '
+                             'h5py) are binary formats that are smaller and '
+                             'much faster to write and read, and keep the '
+                             'timeseries labels as metadata. npy writes a '
+                             'numpy array, with labels in a .json sidecar file. '
+                             'Default: tsv')
+    parser.add_argument('--compression_level', type=int,
+                        help='Compression level of tsv.gz (1-9) and tsv.zst '
+                             '(1-22) outputs. Higher levels are smaller but '
+                             'slower to write. Default: 6 for tsv.gz and 3 for '
+                             'tsv.zst')
+    parser.add_argument('--output_store', action='store_true', default=False,
+                        help='Write the timeseries of all input files into a '
+                             'single HDF5 file, <out_dir>/timeseries.h5, '
+                             'instead of one file per input file. Each output '
+                             'is a dataset keyed by its output file name '
+                             'without extension, alongside shared label '
+                             'tables, an index of all outputs, and the '
+                             'extraction parameters. Requires h5py. '
+                             '--output_format is ignored. Default: False')
+    parser.add_argument('--summary', nargs='+', type=str, 
+                        choices=SUMMARY_STATS,
+                        help='One or more summary statistics of the '
+                             'vertices/voxels in each region, which are all '
+                             'computed in a single pass over the data: mean, '
+                             'median, std, trimmed_mean (10%% cut from each '
+                             'end) and eigenvariate (first principal '
+                             'eigenvariate, as in SPM). If any statistic '
+                             'other than the mean is requested, one output '
+                             'file is written per statistic, with '
+                             '`stat-<statistic>` added to the file name. Not '
+                             'available for coordinates or vertex/voxel '
+                             'extraction. Default: mean')
+    parser.add_argument('--precision', type=str, 
+                        choices=['float32', 'float64'],
+                        help='Floating point precision used to load, extract, '
+                             'denoise and save the data. float32 halves '
+                             'memory use and bandwidth, and agrees with float64 '
+                             'to within 1e-5 of the magnitude of the input '
+                             'data. Default: '
+                             'float64, except for NIFTI images, which follow '
+                             'the nilearn default')
+    parser.add_argument('--cache_dir', type=str,
+                        help='Directory in which compiled roi files are '
+                             'cached, so that each roi file is only parsed '
+                             'once and then reused by every extraction. Can '
+                             'be shared across runs. Default: '
+                             '<out_dir>/nixtract_data/cache')
+    parser.add_argument('--overwrite', action='store_true', default=False,
+                        help='Re-extract every input file. By default, input '
+                             'files whose outputs already exist in out_dir '
+                             'and were extracted from the same input file, '
+                             'regressor file, roi file(s) and parameters are '
+                             'skipped, as recorded in '
+                             'nixtract_data/manifest.jsonl. This allows '
+                             'interrupted runs to be resumed, and new input '
+                             'files to be added to out_dir. Default: False')
     parser.add_argument('-c', '--config', type=str,
                         help='A configuration .json file to pass parameters '
                              'This will overwrite command-line arguments if '
@@ -92,7 +213,9 @@ def base_cli(parser):
                              'online documentation for formatting and what '
                              'keys to include')
     parser.add_argument('-v', '--verbose', action='store_true', default=False, 
-                        help='Print out extraction progress')
+                        help='Print out extraction progress, including the '
+                             'number of files done, the throughput and the '
+                             'estimated time remaining')
     return parser
 
 
@@ -104,6 +227,26 @@ def empty_to_none(x):
     return x
 
 
+def check_roi_files(x):
+    """Get a single roi file, or a list if multiple roi files are provided
+
+    Parameters
+    ----------
+    x : str, list or None
+        One or more roi files
+
+    Returns
+    -------
+    str, list or None
+        A single roi file, a list of multiple roi files, or None if no roi 
+        files are provided
+    """
+    x = empty_to_none(x)
+    if isinstance(x, list) and len(x) == 1:
+        return x[0]
+    return x
+
+
 def merge_params(params, config):
     """Merge CLI params with configuration file params. Configuration params 
     will overwrite the CLI params.
@@ -182,6 +325,19 @@ def handle_base_args(params):
     if isinstance(params['regressors'], str):
         params['regressors'] = [params['regressors']]
 
+    params['summary'] = empty_to_none(params.get('summary'))
+    if params.get('output_format') is None:
+        params['output_format'] = 'tsv'
+    params['output_store'] = bool(params.get('output_store'))
+    params.setdefault('compression_level', None)
+    params['pool_chunksize'] = params.get('pool_chunksize') or 1
+    params.setdefault('max_tasks_per_child', None)
+    params['max_memory'] = parse_memory(params.get('max_memory'))
+    params.setdefault('threads_per_job', None)
+    params['prefetch'] = params.get('prefetch') or 0
+    if params['threads_per_job'] is not None and params['threads_per_job'] < 1:
+        raise ValueError('threads_per_job must be a positive integer')
+
     if isinstance(params["load_confounds_kwargs"], str):
         params["load_confounds_kwargs"] = _parse_input_str(params["load_confounds_kwargs"])
 
@@ -189,6 +345,10 @@ def handle_base_args(params):
     os.makedirs(os.path.join(params['out_dir'], 'nixtract_data'),
                 exist_ok=True)
 
+    if params.get('cache_dir') is None:
+        params['cache_dir'] = os.path.join(params['out_dir'], 'nixtract_data',
+                                           'cache')
+
     return params
 
 
@@ -208,6 +368,13 @@ def _get_package_versions():
      return versions
 
 
+def _get_param_info(params):
+    """Get the command-line call, parameters and package versions"""
+    versions = _get_package_versions()
+    return {'command': " ".join(sys.argv), 'parameters': params,
+            'meta_data': versions}
+
+
 def make_param_file(params):
     """Generate a parameters.json file to be saved in the output
 
@@ -221,11 +388,8 @@ def make_param_file(params):
     str
         Path to which metadata is stored, including parameters.json
     """
-    versions = _get_package_versions()
-
     # export command-line call and parameters to a file
-    param_info = {'command': " ".join(sys.argv), 'parameters': params,
-                  'meta_data': versions}
+    param_info = _get_param_info(params)
 
     metadata_path = os.path.join(params['out_dir'], 'nixtract_data')
     param_file = os.path.join(metadata_path, 'parameters.json')
@@ -235,41 +399,554 @@ def make_param_file(params):
     return metadata_path
 
 
-def replace_file_ext(fname):
+def replace_file_ext(fname, output_format='tsv'):
     """Make a output _timeseries.tsv file based on the input file name
 
     Parameters
     ----------
     fname : str
         Input functional file
+    output_format : str, optional
+        Output file format, which determines the extension (see 
+        nixtract.extractors.output.OUTPUT_FORMATS), by default 'tsv'
 
     Returns
     -------
     str
-        _timeseries.tsv file to be used for output
+        _timeseries.tsv (or other extension) file to be used for output
     """
-    for ext in ['.nii.gz', '.func.gii', '.dtseries.nii']:
+    out_ext = '_timeseries' + OUTPUT_FORMATS[output_format]
+    for ext in ['.nii.gz', '.func.gii', '.dtseries.nii', '.nii']:
         if fname.endswith(ext):
-            return os.path.basename(fname).replace(ext, '_timeseries.tsv')
+            return os.path.basename(fname).replace(ext, out_ext)
+
+
+def store_fname(out_dir):
+    """Consolidated HDF5 store of all outputs in out_dir (see --output_store)
+    """
+    return os.path.join(out_dir, 'timeseries.h5')
+
+
+# parameters that do not change the outputs of an input file, or that are 
+# recorded per input file
+_MANIFEST_EXCLUDE = ['input_files', 'lh_files', 'rh_files', 'regressor_files',
+                     'out_dir', 'cache_dir', 'n_jobs', 'pool_chunksize', 
+                     'max_tasks_per_child', 'max_memory', 'threads_per_job', 
+                     'prefetch', 'verbose', 'overwrite']
+
+
+def manifest_fname(out_dir):
+    """Manifest of the outputs in out_dir, which records which inputs and
+    parameters each output was extracted from
+    """
+    return os.path.join(out_dir, 'nixtract_data', 'manifest.jsonl')
+
+
+def _hash_param(x):
+    """Replace file paths in a parameter by their contents' digest"""
+    if isinstance(x, str) and os.path.isfile(x):
+        return file_hash(x)
+    if isinstance(x, (list, tuple)):
+        return [_hash_param(i) for i in x]
+    return x
+
+
+def _params_digest(params):
+    """Digest of the parameters that determine the outputs of every input
+    file, including the contents of files such as roi files
+    """
+    relevant = {k: _hash_param(v) for k, v in params.items() 
+                if k not in _MANIFEST_EXCLUDE}
+    relevant['nixtract'] = pkg_resources.require("nixtract")[0].version
+    relevant = json.dumps(relevant, sort_keys=True, default=str)
+    return hashlib.sha256(relevant.encode('utf-8')).hexdigest()
+
+
+def _input_digest(in_file, regressor_file, params_digest):
+    """Digest of an input file, its regressor file and the parameters
+
+    Input files are identified by their size and modification time rather 
+    than their contents, which avoids reading (potentially very large) input
+    files that are up to date. Regressor files are identified by their 
+    contents.
+    """
+    files = in_file if isinstance(in_file, (list, tuple)) else [in_file]
+    stats = [os.stat(x) for x in files if x is not None]
+    identity = [params_digest, [[x.st_size, x.st_mtime_ns] for x in stats], 
+                None if regressor_file is None else file_hash(regressor_file)]
+    identity = json.dumps(identity).encode('utf-8')
+    return hashlib.sha256(identity).hexdigest()
+
+
+def _manifest_key(in_file):
+    """Manifest entry of an input file, or pair of GIFTI input files"""
+    files = in_file if isinstance(in_file, (list, tuple)) else [in_file]
+    return ', '.join('' if x is None else os.path.abspath(x) for x in files)
+
+
+def load_manifest(out_dir):
+    """Read the manifest of out_dir
+
+    The manifest has one JSON line per extracted input file, which is 
+    appended as soon as the outputs of the input file are written. Later 
+    lines replace earlier lines of the same input file, and an incomplete 
+    last line (e.g., from an interrupted run) is ignored.
+
+    Parameters
+    ----------
+    out_dir : str
+        Output directory
+
+    Returns
+    -------
+    dict
+        Entry of each input file, with the digest of its inputs and 
+        parameters and its outputs
+    """
+    manifest = {}
+    fname = manifest_fname(out_dir)
+    if not os.path.exists(fname):
+        return manifest
+    with open(fname, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.decoder.JSONDecodeError:
+                continue
+            manifest[entry['input']] = entry
+    return manifest
+
+
+def _is_up_to_date(entry, digest, store=None):
+    """Check if the outputs of a manifest entry match the digest of an input
+    and all still exist
+    """
+    if entry is None or entry['digest'] != digest:
+        return False
+    if store is not None:
+        return all(store_key(x) in store for x in entry['outputs'])
+    return all(os.path.exists(x) for x in entry['outputs'])
+
+
+def _record_outputs(in_file, digest, result, out_dir):
+    """Append the outputs of an input file to the manifest"""
+    entry = {'input': _manifest_key(in_file), 'digest': digest,
+             'outputs': result['outputs'], 'seconds': result['seconds']}
+    line = (json.dumps(entry) + '\n').encode('utf-8')
+    with open(manifest_fname(out_dir), 'ab+') as f:
+        # start a new line after an incomplete line of an interrupted run
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                line = b'\n' + line
+        f.write(line)
+
+
+def _open_store(params):
+    """Open the store of all outputs, if --output_store is used"""
+    if not params.get('output_store'):
+        return None
+    from nixtract.extractors.store import TimeseriesStore
+    store = TimeseriesStore(store_fname(params['out_dir']))
+    store.set_metadata(_get_param_info(params))
+    return store
+
+
+def save_outputs(out, extractor, params):
+    """Save the timeseries of an extractor to out, unless they are added to 
+    the output store by run_extraction
+
+    Parameters
+    ----------
+    out : str
+        Output file name
+    extractor : nixtract.extractors.base_extractor.BaseExtractor
+        Extractor, after extraction
+    params : dict
+        Parameter dictionary for extraction
+    """
+    if not params['output_store']:
+        extractor.save(out, params['n_decimals'], params['output_format'],
+                       params['compression_level'])
+
+
+def _extract_job(extract_func, args, store_dir=None, n_decimals=None):
+    """Run extract_func on a tuple of arguments, and return a compact record
+    of the extraction instead of the extractor
+
+    Extractors hold the loaded data, so only the information that the main
+    process needs is returned: the output file, the output files, the 
+    regressor names, whether load_confounds was used, and the extraction time 
+    in seconds. If store_dir is set, the timeseries are written to a store 
+    file of their own in store_dir (see _store_shard), and only its file name
+    is returned, to be merged into the output store by the main process.
+    """
+    start = time.perf_counter()
+    out, extractor = extract_func(*args)
+    return _result_record(out, extractor, start, store_dir, n_decimals)
+
+
+def _store_shard(out, extractor, store_dir, n_decimals=None):
+    """Write the timeseries of an extractor to a store file in store_dir, 
+    named after its output file, and return the store file name
+    """
+    from nixtract.extractors.store import TimeseriesStore
+    fname = os.path.join(store_dir, store_key(out) + '.h5')
+    with TimeseriesStore(fname, mode='w') as shard:
+        extractor.save_to_store(shard, out, n_decimals)
+    return fname
+
+
+def _result_record(out, extractor, start, store_dir=None, n_decimals=None):
+    """Compact record of an extraction that started at time start (see 
+    _extract_job)
+    """
+    regressor_names = extractor.regressor_names
+    result = {
+        'out': out,
+        'outputs': [x for x, _ in extractor._outputs(out)],
+        'regressor_names': (None if regressor_names is None 
+                            else list(regressor_names)),
+        'load_confounds': getattr(extractor, '_load_confounds', False),
+        'store': None
+    }
+    if store_dir is not None:
+        result['store'] = _store_shard(out, extractor, store_dir, n_decimals)
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def _pipeline(items, load, compute, write, n_prefetch=1):
+    """Load, compute and write items in a pipeline, so that the next items 
+    are loaded by background threads and the previous item is written by a 
+    writer thread while the current item is computed
+
+    Up to n_prefetch items are loaded ahead of the item that is computed, and
+    one item is written at a time, which bounds the number of items that are
+    held at once. Decompression and file I/O release the GIL, and so run 
+    alongside computation.
+
+    Parameters
+    ----------
+    items : iterable
+        Items to process, in order
+    load : callable
+        Load an item, in a background thread
+    compute : callable
+        Compute the result of a loaded item, in the calling thread
+    write : callable
+        Write the result of compute, in the writer thread
+    n_prefetch : int, optional
+        Number of items loaded ahead, by default 1
+
+    Yields
+    ------
+    object
+        Value returned by write for each item, in order
+    """
+    items = iter(items)
+    with ThreadPoolExecutor(n_prefetch) as loader, \
+            ThreadPoolExecutor(1) as writer:
+        loading = deque(loader.submit(load, x) 
+                        for x in islice(items, n_prefetch))
+        writing = deque()
+        while loading:
+            loaded = loading.popleft().result()
+            for x in islice(items, 1):
+                loading.append(loader.submit(load, x))
+            writing.append(writer.submit(write, compute(loaded)))
+            # wait for the previous item, so that results do not pile up 
+            # behind a slow writer
+            while len(writing) > 1 or (writing and writing[0].done()):
+                yield writing.popleft().result()
+        while writing:
+            yield writing.popleft().result()
 
 
-def _make_regressor_file(outputs, out_dir):
+def _pipeline_jobs(load_func, items, store_dir=None, n_decimals=None, 
+                   n_prefetch=1):
+    """Run jobs in a pipeline (see _pipeline), with load_func loading input
+    files ahead of their extraction, and outputs saved in the writer thread.
+    Items are the (index, arguments) pair of each job
+
+    Yields
+    ------
+    tuple
+        Index and compact record (see _extract_job) of each job, in order
+    """
+    def _load(item):
+        i, args = item
+        start = time.perf_counter()
+        return i, start, args[-1], load_func(*args)
+
+    def _compute(loaded):
+        i, start, params, (out, extractor) = loaded
+        extractor.extract()
+        return i, start, params, out, extractor
+
+    def _write(computed):
+        i, start, params, out, extractor = computed
+        save_outputs(out, extractor, params)
+        return i, _result_record(out, extractor, start, store_dir, 
+                                 n_decimals)
+
+    return _pipeline(items, _load, _compute, _write, n_prefetch)
+
+
+def _pipeline_batch(load_func, items, store_dir=None, n_decimals=None, 
+                    n_prefetch=1):
+    """Run a batch of jobs in a pipeline in a pool process (see 
+    _pipeline_jobs), and return the index and record of each job
+    """
+    return list(_pipeline_jobs(load_func, items, store_dir, n_decimals, 
+                               n_prefetch))
+
+
+# binary units of memory sizes
+_MEMORY_UNITS = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+
+
+def parse_memory(value):
+    """Convert a memory size, such as '16G' or '512M', to bytes
+
+    Parameters
+    ----------
+    value : str, int or None
+        Memory size, as a number of bytes, optionally followed by a K, M, G 
+        or T unit (binary, e.g. 1K = 1024 bytes)
+
+    Returns
+    -------
+    int or None
+        Number of bytes, or None if value is None
+
+    Raises
+    ------
+    ValueError
+        Invalid or non-positive memory size
+    """
+    if value is None:
+        return None
+    size = str(value).strip().upper()
+    if size.endswith('B'):
+        size = size[:-1]
+    unit = 1
+    if size and size[-1] in _MEMORY_UNITS:
+        unit = _MEMORY_UNITS[size[-1]]
+        size = size[:-1]
+    try:
+        nbytes = int(float(size) * unit)
+    except ValueError as e:
+        raise ValueError(f'Invalid memory size {value}. Must be a number of '
+                         'bytes, optionally followed by K, M, G or T') from e
+    if nbytes <= 0:
+        raise ValueError(f'Invalid memory size {value}. Must be positive')
+    return nbytes
+
+
+def estimate_memory(n_values, raw_dtype, params, scaled=False):
+    """Estimate the peak memory used to extract an input file
+
+    The estimate counts the data as read from the file, and each copy of the
+    data at the extraction precision: the loaded data, the denoised data if
+    denoising is done before extraction, and the extracted timeseries if 
+    vertices/voxels are extracted. Data with scaling factors are scaled in 
+    float64.
+
+    Parameters
+    ----------
+    n_values : int
+        Number of values of the data that are loaded at once
+    raw_dtype : numpy.dtype
+        Data type of the data in the file
+    params : dict
+        Extraction parameters
+    scaled : bool, optional
+        If the data have scaling factors, by default False
+
+    Returns
+    -------
+    int
+        Estimated memory, in bytes
+    """
+    dtype = numpy.dtype(params.get('precision') or numpy.float64)
+    n_copies = (1 + bool(params.get('denoise_pre_extract')) 
+                + bool(params.get('as_vertices') or params.get('as_voxels')))
+    nbytes = n_values * (numpy.dtype(raw_dtype).itemsize 
+                         + n_copies * dtype.itemsize)
+    if scaled:
+        nbytes += n_values * numpy.dtype(numpy.float64).itemsize
+    return int(nbytes)
+
+
+def _imap_by_memory(pool, job, jobs, footprints, max_memory, n_jobs):
+    """Run jobs on a pool while the estimated memory of the running jobs is 
+    within a budget, and yield their (index, result) as they are completed
+
+    Jobs are started in order, as soon as a process is free and the budget 
+    leaves room for the next job. A job that exceeds the budget on its own 
+    is started once no other job is running.
+
+    Parameters
+    ----------
+    pool : multiprocessing.Pool
+        Process pool
+    job : callable
+        Job function, which takes an (index, arguments) pair and returns the 
+        index and result (see _indexed_job)
+    jobs : list
+        Arguments of each job
+    footprints : list of int
+        Estimated memory of each job, in bytes
+    max_memory : int
+        Memory budget, in bytes
+    n_jobs : int
+        Maximum number of jobs that run at once
+
+    Yields
+    ------
+    tuple
+        Index and result of each completed job
+    """
+    done = queue.Queue()
+    pending = deque(range(len(jobs)))
+    running = {}
+    while pending or running:
+        while pending and len(running) < n_jobs:
+            i = pending[0]
+            if running and sum(running.values()) + footprints[i] > max_memory:
+                break
+            running[pending.popleft()] = footprints[i]
+            pool.apply_async(job, ((i, jobs[i]),), callback=done.put, 
+                             error_callback=done.put)
+        result = done.get()
+        if isinstance(result, BaseException):
+            raise result
+        del running[result[0]]
+        yield result
+
+
+def threads_per_job(params, n_inputs=None):
+    """Number of BLAS/OpenMP threads that each extraction can use
+
+    Parameters
+    ----------
+    params : dict
+        Extraction parameters. `threads_per_job`, if set, is used as is. 
+        Otherwise, the CPUs are split between the `n_jobs` processes
+    n_inputs : int, optional
+        Number of input files to extract, which caps the number of processes
+        that CPUs are split between. By default None
+
+    Returns
+    -------
+    int or None
+        Number of threads, or None if threads are not limited, which is the 
+        default when extracting without parallelization
+    """
+    if params.get('threads_per_job') is not None:
+        return params['threads_per_job']
+    n_jobs = params['n_jobs']
+    if n_inputs is not None:
+        n_jobs = min(n_jobs, n_inputs)
+    if n_jobs <= 1:
+        return None
+    return max(1, (os.cpu_count() or 1) // n_jobs)
+
+
+def denoise_threads(params):
+    """Number of threads that an extractor uses to denoise vertices before 
+    extraction, which is `threads_per_job` if set (see threads_per_job), and
+    1 otherwise
+    """
+    return params.get('threads_per_job') or 1
+
+
+# thread limits of a pool process, which apply for the life of the process
+_THREAD_LIMITS = None
+
+
+def _limit_threads(n_threads):
+    """Limit the BLAS/OpenMP threads of a pool process"""
+    global _THREAD_LIMITS
+    if n_threads is not None:
+        _THREAD_LIMITS = threadpool_limits(limits=n_threads)
+
+
+def _indexed_job(job, item):
+    """Run a job on the arguments of an (index, arguments) pair, and return
+    the index with the result so that results can be completed in any order
+    """
+    i, args = item
+    return i, job(args)
+
+
+def _input_size(in_file):
+    """Size in bytes of an input file, or pair of GIFTI input files"""
+    files = in_file if isinstance(in_file, (list, tuple)) else [in_file]
+    return sum(os.path.getsize(x) for x in files if x is not None)
+
+
+class _Progress(object):
+    def __init__(self, sizes, verbose=False):
+        """Report the progress of extraction as each input file is done, 
+        with the throughput in files and (input) megabytes per second, and 
+        the estimated time remaining
+
+        Parameters
+        ----------
+        sizes : list of int
+            Size in bytes of each input file to extract
+        verbose : bool, optional
+            Print the progress after each input file, by default False
+        """
+        self.sizes = sizes
+        self.verbose = verbose
+        self.n_done = 0
+        self.n_bytes = 0
+        self.start = time.perf_counter()
+
+    def update(self, i):
+        """Mark input file i as done"""
+        self.n_done += 1
+        self.n_bytes += self.sizes[i]
+        if self.verbose:
+            print(self.message())
+
+    def message(self):
+        """Progress message"""
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        rate = self.n_done / elapsed
+        eta = (len(self.sizes) - self.n_done) / rate if rate else 0
+        t = datetime.now().strftime("%H:%M:%S")
+        eta = time.strftime('%H:%M:%S', time.gmtime(eta))
+        return (f'[{t}] {self.n_done}/{len(self.sizes)} files done '
+                f'({rate:.2f} files/s, {self.n_bytes / 2 ** 20 / elapsed:.1f} '
+                f'MB/s), ETA {eta}')
+
+
+def _make_regressor_file(results, out_dir):
 
     reg_dict = {}
-    for fname, extractor in outputs:
-        if extractor.regressor_names is not None:
-            reg_dict[fname] = list(extractor.regressor_names)
+    for result in results:
+        if result['regressor_names'] is not None:
+            reg_dict[result['out']] = result['regressor_names']
 
     if len(reg_dict) != 0:
         # check if all extractors used load_confounds
-        if all([x[1]._load_confounds for x in outputs]):
+        if all([x['load_confounds'] for x in results]):
             reg_file = os.path.join(out_dir, 'nixtract_data',
                                     'load_confounds_regressors.json')
+            # keep the regressors of inputs skipped by a resumed run
+            if os.path.exists(reg_file):
+                with open(reg_file, 'r') as f:
+                    reg_dict = {**json.load(f), **reg_dict}
             with open(reg_file, 'w') as f:
                 json.dump(reg_dict, f, indent=2)
 
 
-def run_extraction(extract_func, input_files, roi_file, params):
+def run_extraction(extract_func, input_files, roi_file, params, 
+                   estimate_func=None, load_func=None):
     """Extract timeseries from input files
 
     Extraction is determined by the `extract_func`, in which there is one
@@ -295,15 +972,35 @@ def run_extraction(extract_func, input_files, roi_file, params):
         List of input files for extraction. If extract_func is 
         nixtract.cli.gifti.extract_gifti, then list must have tuples in which
         each tuple is (left, right) hemisphere input files
-    roi_file : str or tuple
-        File that defines regions of interest(s). If extract_func is 
+    roi_file : str, list or tuple
+        File that defines regions of interest(s), or a list of files, in which
+        case each input file is loaded once and extracted with every roi 
+        file, with one output per roi file. If extract_func is 
         nixtract.cli.gifti.extract_gifti, then must be a tuple containing each
         hemisphere, i.e. (left, right) 
     regressor_files : list
         List of regressor files to pair with input_files. Should be in the 
         same order.
     params : dict
-        Input parameter dictionary
+        Input parameter dictionary. If `output_store` is True, the timeseries
+        of all input files are written into a single store (see 
+        store_fname) rather than by extract_func: each extraction writes its
+        own store file in a temporary directory of out_dir, which is merged
+        into the store by the main process. Input files whose 
+        outputs were already extracted with the same parameters (see 
+        load_manifest) are skipped, unless `overwrite` is True
+    estimate_func : callable, optional
+        Function that estimates the memory used to extract an input file from
+        its header, as estimate_func(input_file, params), in bytes (see 
+        estimate_memory). Used to schedule parallel extraction within 
+        `max_memory`. By default None
+    load_func : callable, optional
+        Function that sets up the extraction of an input file and loads its 
+        data, with the same arguments as extract_func, and returns the output
+        file and extractor before extraction (e.g., 
+        nixtract.cli.cifti.load_cifti). Used to load input files ahead of 
+        their extraction when `prefetch` is set, in the main process or in 
+        each pool process. By default None
     """
     regressor_files = params['regressor_files']
     if regressor_files is None:
@@ -312,22 +1009,121 @@ def run_extraction(extract_func, input_files, roi_file, params):
     if len(regressor_files) != len(input_files):
         raise ValueError('Number of regressor files do not equal number of input files')
 
-    n_jobs = params['n_jobs']
-    # no parallelization
-    if n_jobs == 1:
+    out_dir = params['out_dir']
+    store = _open_store(params)
+    store_dir = None
+    if store is not None:
+        store_dir = tempfile.mkdtemp(prefix='.timeseries-', dir=out_dir)
+    try:
+        # skip inputs whose outputs are up to date
+        manifest = load_manifest(out_dir)
+        params_digest = _params_digest(params)
+        jobs, digests = [], []
+        for in_file, regressor_file in zip(input_files, regressor_files):
+            digest = _input_digest(in_file, regressor_file, params_digest)
+            entry = manifest.get(_manifest_key(in_file))
+            if params.get('overwrite') or not _is_up_to_date(entry, digest, 
+                                                              store):
+                jobs.append((in_file, roi_file, regressor_file, params))
+                digests.append(digest)
+        if params['verbose'] and len(jobs) < len(input_files):
+            print(f'Skipping {len(input_files) - len(jobs)} input file(s) '
+                  'with up-to-date outputs')
+
+        n_jobs = params['n_jobs']
+        n_threads = threads_per_job(params, len(jobs))
+        if params['verbose'] and n_threads is not None:
+            print(f'Extracting with {min(n_jobs, max(len(jobs), 1))} '
+                  f'process(es) of {n_threads} thread(s) each')
+        # each extraction denoises with the threads of its process (see 
+        # denoise_threads)
+        params = dict(params, threads_per_job=n_threads)
+        jobs = [x[:-1] + (params,) for x in jobs]
+        job = partial(_indexed_job, partial(_extract_job, extract_func, 
+                                            store_dir=store_dir, 
+                                            n_decimals=params['n_decimals']))
+        limiter = None
+        if n_jobs == 1 or len(jobs) <= 1:
+            # no parallelization
+            if n_threads is not None:
+                limiter = threadpool_limits(limits=n_threads)
+            if params['prefetch'] and load_func is not None:
+                results = _pipeline_jobs(load_func, enumerate(jobs), 
+                                         store_dir, 
+                                         params['n_decimals'], 
+                                         params['prefetch'])
+            else:
+                results = (job(x) for x in enumerate(jobs))
+            pool = None
+        else:
+            # BLAS/OpenMP threads are limited in each process, including 
+            # those that replace processes after max_tasks_per_child
+            pool = multiprocessing.Pool(
+                processes=n_jobs, 
+                initializer=_limit_threads, 
+                initargs=(n_threads,),
+                maxtasksperchild=params.get('max_tasks_per_child')
+            )
+            tasks, task = jobs, job
+            chunksize = params['pool_chunksize']
+            pipelined = params['prefetch'] and load_func is not None
+            if pipelined:
+                # each task is a batch of input files that a process extracts 
+                # in a pipeline, loading the next input files of the batch 
+                # while extracting the current one
+                size = max(chunksize, params['prefetch'] + 1)
+                items = list(enumerate(jobs))
+                tasks = [items[k:k + size] for k in range(0, len(items), size)]
+                task = partial(_indexed_job, partial(
+                    _pipeline_batch, load_func, store_dir=store_dir,
+                    n_decimals=params['n_decimals'], 
+                    n_prefetch=params['prefetch']
+                ))
+                chunksize = 1
+
+            # results are handled in the order in which they are completed
+            max_memory = params.get('max_memory')
+            if max_memory is not None and estimate_func is not None:
+                footprints = [estimate_func(x[0], params) for x in jobs]
+                if params['verbose'] and max(footprints) > max_memory:
+                    print(f'{sum(x > max_memory for x in footprints)} input '
+                          'file(s) exceed max_memory and are extracted on '
+                          'their own')
+                if pipelined:
+                    footprints = [sum(footprints[i] for i, _ in x) 
+                                  for x in tasks]
+                results = _imap_by_memory(pool, task, tasks, footprints, 
+                                          max_memory, n_jobs)
+            else:
+                results = pool.imap_unordered(task, enumerate(tasks), 
+                                              chunksize=chunksize)
+            if pipelined:
+                results = (x for _, batch in results for x in batch)
+
+        # outputs are recorded as soon as each input file is done, so that 
+        # an interrupted run can be resumed. Only compact records of each 
+        # extraction are kept
+        progress = _Progress([_input_size(x[0]) for x in jobs], 
+                             params['verbose'])
         res = []
-        for i, in_file in enumerate(input_files):
-            out, extractor = extract_func(in_file, roi_file, 
-                                          regressor_files[i], params)
-            res.append((out, extractor))
-    else:
-        args = zip(
-            input_files,
-            repeat(roi_file),
-            regressor_files, 
-            repeat(params)
-        )
-        with multiprocessing.Pool(processes=n_jobs) as pool:
-            res = pool.starmap(extract_func, args)
-
-    _make_regressor_file(res, params['out_dir'])
+        try:
+            for i, result in results:
+                shard = result.pop('store')
+                if shard is not None:
+                    store.merge(shard)
+                    os.remove(shard)
+                _record_outputs(jobs[i][0], digests[i], result, out_dir)
+                res.append(result)
+                progress.update(i)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            if limiter is not None:
+                limiter.restore_original_limits()
+    finally:
+        if store is not None:
+            store.close()
+            shutil.rmtree(store_dir, ignore_errors=True)
+
+    _make_regressor_file(res, out_dir)
@@ -3,10 +3,13 @@
 import argparse
 import os
 import shutil
+import nibabel as nib
 from nilearn.signal import clean
 
 from nixtract.cli.base import (base_cli, handle_base_args, replace_file_ext,
-                               make_param_file, check_glob, run_extraction)
+                               make_param_file, check_glob, check_roi_files,
+                               run_extraction, estimate_memory, 
+                               save_outputs, denoise_threads)
 from nixtract.extractors import CiftiExtractor
 
 def _cli_parser():
@@ -22,9 +25,18 @@ def _cli_parser():
                              'the file pattern. If so, these files are '
                              'naturally sorted by file name prior to '
                              'extraction')
-    parser.add_argument('--roi_file', type=str, 
+    parser.add_argument('--roi_file', nargs='+', type=str, 
                         help='CIFTI dlabel file (.dlabel.nii) with one or more '
-                             'labels')
+                             'labels, or a CIFTI dscalar file (.dscalar.nii) '
+                             'with one weighted (e.g., probabilistic) region '
+                             'per map. Weighted region timeseries are the '
+                             'weighted mean of their vertices. If multiple '
+                             'files are provided, each input file is loaded '
+                             'once and extracted with every roi file, and '
+                             '`atlas-<name>` is added to the output file names '
+                             'of each roi file, where <name> is the roi file '
+                             'name without its extension and non-alphanumeric '
+                             'characters')
     # other
     parser.add_argument('--as_vertices', default=False,
                         action='store_true',
@@ -39,6 +51,13 @@ def _cli_parser():
                              'Otherwise, denoising is done on the extracted '
                              'timeseries, which is consistent with nilearn and '
                              'is more computationally efficient. Default: False')                  
+    parser.add_argument('--chunk_size', type=int,
+                        help='Read and reduce each input file in blocks of '
+                             'this many timepoints, so that memory use is '
+                             'bounded by the block size rather than the length '
+                             'of the run. Cannot be used with '
+                             '--denoise-pre-extract. Default: load the entire '
+                             'file')
     parser = base_cli(parser)                         
     return parser.parse_args()
 
@@ -55,32 +74,60 @@ def _check_cifti_params(params):
         if not params['input_files']:
             raise ValueError('Missing input files. Check files')
 
+    params['roi_file'] = check_roi_files(params['roi_file'])
     if not params['roi_file']:
         raise ValueError('Missing roi_file input.')
     
     return params
 
 
-def extract_cifti(input_file, roi_file, regressor_file, params):
-    """Extract timeseries from a CIFTI image
+def estimate_cifti_memory(input_file, params):
+    """Estimate the memory used to extract a CIFTI image from its header (see
+    nixtract.cli.base.estimate_memory)
+    """
+    img = nib.load(input_file)
+    n_timepoints, n_vertices = img.shape
+    if params['chunk_size'] is not None:
+        # streamed one block of timepoints at a time
+        n_timepoints = min(n_timepoints, params['chunk_size'])
+    proxy = img.dataobj
+    scaled = (getattr(proxy, 'slope', 1) != 1 
+              or getattr(proxy, 'inter', 0) != 0)
+    return estimate_memory(n_timepoints * n_vertices, img.get_data_dtype(), 
+                           params, scaled)
+
+
+def load_cifti(input_file, roi_file, regressor_file, params):
+    """Set up the extraction of a CIFTI image, and load its data
 
     Parameters
     ----------
     input_files : str
         File path of the input .dtseries.nii file
-    roi_file : str
-        File path of the input .dlabel.nii file. 
+    roi_file : str or list
+        File path of the input .dlabel.nii or .dscalar.nii file, or a list of
+        file paths
     regressor_file : str
         File path of regressor file
     params : dict
         Parameter dictionary for extraction
+
+    Returns
+    -------
+    str, nixtract.extractors.CiftiExtractor
+        Output file name, and the extractor, ready to extract
     """
     extractor = CiftiExtractor(
         fname=input_file, 
         roi_file=roi_file,
         as_vertices=params['as_vertices'],
         verbose=params['verbose'],
+        cache_dir=params['cache_dir'],
+        dtype=params['precision'],
+        summary=params['summary'],
+        chunk_size=params['chunk_size'],
         pre_clean=params['denoise_pre_extract'],
+        n_threads=denoise_threads(params),
         standardize=params['standardize'], 
         t_r=params['t_r'], 
         high_pass=params['high_pass'], 
@@ -94,10 +141,29 @@ def extract_cifti(input_file, roi_file, regressor_file, params):
     if (params['discard_scans'] is not None) and (params['discard_scans'] > 0):
         extractor.discard_scans(params['discard_scans'])
 
-    extractor.extract()
-    out = os.path.join(params['out_dir'], replace_file_ext(input_file))
-    extractor.save(out, params['n_decimals'])
+    out = os.path.join(params['out_dir'], 
+                       replace_file_ext(input_file, params['output_format']))
+    return out, extractor.load()
+
+
+def extract_cifti(input_file, roi_file, regressor_file, params):
+    """Extract timeseries from a CIFTI image
 
+    Parameters
+    ----------
+    input_files : str
+        File path of the input .dtseries.nii file
+    roi_file : str or list
+        File path of the input .dlabel.nii or .dscalar.nii file, or a list of
+        file paths
+    regressor_file : str
+        File path of regressor file
+    params : dict
+        Parameter dictionary for extraction
+    """
+    out, extractor = load_cifti(input_file, roi_file, regressor_file, params)
+    extractor.extract()
+    save_outputs(out, extractor, params)
     return out, extractor
     
 
@@ -105,10 +171,17 @@ def main():
     params = vars(_cli_parser())
     params = _check_cifti_params(params)
     metadata_path = make_param_file(params)
-    shutil.copy2(params['roi_file'], metadata_path)
-
+    roi_files = params['roi_file']
+    if isinstance(roi_files, str):
+        roi_files = [roi_files]
+    for roi_file in roi_files:
+        shutil.copy2(roi_file, metadata_path)
+        # compile the roi file once so that each extraction only loads the 
+        # plan
+        CiftiExtractor.load_plan(roi_file, params['cache_dir'])
     run_extraction(extract_cifti, params['input_files'], params['roi_file'], 
-                   params)
+                   params, estimate_func=estimate_cifti_memory, 
+                   load_func=load_cifti)
 
 
 if __name__ == '__main__':
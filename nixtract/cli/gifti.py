@@ -5,9 +5,14 @@ import sys
 import os
 import json
 import shutil
+from xml.etree import ElementTree
+import numpy as np
+from nibabel.nifti1 import data_type_codes
 
 from nixtract.cli.base import (base_cli, handle_base_args, replace_file_ext,
-                               make_param_file, check_glob, run_extraction)
+                               make_param_file, check_glob, run_extraction,
+                               estimate_memory, save_outputs, 
+                               denoise_threads)
 from nixtract.extractors import GiftiExtractor
 
 def _cli_parser():
@@ -34,11 +39,19 @@ def _cli_parser():
     parser.add_argument('--lh_roi_file', type=str, 
                         help='A label GIFTI file (.label.gii) or a Freesurfer '
                              'annotation file (.annot) for the left hemipshere. '
-                             'Must include one or more labels')
+                             'Must include one or more labels. Or, a GIFTI '
+                             'file (.func.gii or .shape.gii) with one weighted '
+                             '(e.g., probabilistic) region per data array, '
+                             'whose timeseries are the weighted mean of their '
+                             'vertices')
     parser.add_argument('--rh_roi_file', type=str, metavar='roi_file', 
                         help='A label GIFTI file (.label.gii) or a Freesurfer '
                              'annotation file (.annot) for the right hemipshere. '
-                             'Must include one or more labels')
+                             'Must include one or more labels. Or, a GIFTI '
+                             'file (.func.gii or .shape.gii) with one weighted '
+                             '(e.g., probabilistic) region per data array, '
+                             'whose timeseries are the weighted mean of their '
+                             'vertices')
     # other
     parser.add_argument('--as_vertices', default=False,
                         action='store_true',
@@ -84,7 +97,7 @@ def _check_gifti_params(params):
     return params
 
 
-def _set_out_fname(input_files, out_dir):
+def _set_out_fname(input_files, out_dir, output_format='tsv'):
     """Make output _timeseries.tsv filename based on what hemisphere are
     provided
 
@@ -103,6 +116,8 @@ def _set_out_fname(input_files, out_dir):
         be in file names. 
     out_dir : str
         Output directory
+    output_format : str, optional
+        Output file format, by default 'tsv'
 
     Returns
     -------
@@ -130,11 +145,38 @@ def _set_out_fname(input_files, out_dir):
         raise ValueError('Must include input file from at least one '
                          'hemisphere')
 
-    return os.path.join(out_dir, replace_file_ext(out_fname))
+    return os.path.join(out_dir, replace_file_ext(out_fname, output_format))
 
 
-def extract_gifti(input_files, roi_file, regressor_file, params):
-    """Extract timeseries from a GIFTI image
+def _gifti_size(fname):
+    """Number of values and data type of a GIFTI file, read from the 
+    attributes of its data arrays without decoding their data
+    """
+    n_values, dtype = 0, np.float32
+    for event, elem in ElementTree.iterparse(fname, events=('start', 'end')):
+        if event == 'start' and elem.tag == 'DataArray':
+            dims = [int(elem.get(f'Dim{i}')) 
+                    for i in range(int(elem.get('Dimensionality')))]
+            n_values += int(np.prod(dims))
+            dtype = data_type_codes.dtype[elem.get('DataType')]
+        elif event == 'end':
+            elem.clear()
+    return n_values, dtype
+
+
+def estimate_gifti_memory(input_files, params):
+    """Estimate the memory used to extract a pair of GIFTI files from their
+    headers (see nixtract.cli.base.estimate_memory)
+    """
+    nbytes = 0
+    for fname in input_files:
+        if fname is not None:
+            nbytes += estimate_memory(*_gifti_size(fname), params)
+    return nbytes
+
+
+def load_gifti(input_files, roi_file, regressor_file, params):
+    """Set up the extraction of a GIFTI image, and load its data
 
     Parameters
     ----------
@@ -150,9 +192,15 @@ def extract_gifti(input_files, roi_file, regressor_file, params):
         File path of regressor file
     params : dict
         Parameter dictionary for extraction
+
+    Returns
+    -------
+    str, nixtract.extractors.GiftiExtractor
+        Output file name, and the extractor, ready to extract
     """
     # validate input file(s) and make output file before extraction
-    out = _set_out_fname(input_files, params['out_dir'])
+    out = _set_out_fname(input_files, params['out_dir'], 
+                         params['output_format'])
 
     extractor = GiftiExtractor(
         lh_file=input_files[0],
@@ -161,7 +209,11 @@ def extract_gifti(input_files, roi_file, regressor_file, params):
         rh_roi_file=roi_file[1],
         as_vertices=params['as_vertices'],
         verbose=params['verbose'],
+        cache_dir=params['cache_dir'],
+        dtype=params['precision'],
+        summary=params['summary'],
         pre_clean=params['denoise_pre_extract'],
+        n_threads=denoise_threads(params),
         standardize=params['standardize'], 
         t_r=params['t_r'], 
         high_pass=params['high_pass'], 
@@ -174,10 +226,31 @@ def extract_gifti(input_files, roi_file, regressor_file, params):
 
     if (params['discard_scans'] is not None) and (params['discard_scans'] > 0):
         extractor.discard_scans(params['discard_scans'])
-    
-    extractor.extract()
-    extractor.save(out, params['n_decimals'])
 
+    return out, extractor.load()
+
+
+def extract_gifti(input_files, roi_file, regressor_file, params):
+    """Extract timeseries from a GIFTI image
+
+    Parameters
+    ----------
+    input_files : tuple
+        Tuple of left and right hemisphere func.gii files, (left, right). If
+        only one hemisphere is desired, then the other hemisphere can be 
+        specified as None, e.g., left only: (left, None).  
+    roi_file : tuple
+        Tuple of left and right hemisphere label.gii files, (left, right). If
+        only one hemisphere is desired, then the other hemisphere can be 
+        specified as None, e.g., left only: (left, None).  
+    regressor_file : str
+        File path of regressor file
+    params : dict
+        Parameter dictionary for extraction
+    """
+    out, extractor = load_gifti(input_files, roi_file, regressor_file, params)
+    extractor.extract()
+    save_outputs(out, extractor, params)
     return out, extractor
     
 
@@ -189,11 +262,15 @@ def main():
     for roi_file in [params['lh_roi_file'], params['rh_roi_file']]:
         if roi_file:
             shutil.copy2(roi_file, metadata_path)
+            # compile once so that each extraction only loads the plan
+            GiftiExtractor.load_plan(roi_file, params['cache_dir'])
 
     # setup and run extraction
     input_files = list(zip(params['lh_files'], params['rh_files']))
     roi_files = (params['lh_roi_file'], params['rh_roi_file'])
-    run_extraction(extract_gifti, input_files, roi_files, params)
+    run_extraction(extract_gifti, input_files, roi_files, params,
+                   estimate_func=estimate_gifti_memory, 
+                   load_func=load_gifti)
 
 
 if __name__ == '__main__':
@@ -3,14 +3,17 @@
 import argparse
 import os
 import shutil
+import numpy as np
 import pandas as pd
+import nibabel as nib
 from nilearn.datasets import (fetch_atlas_destrieux_2009, fetch_atlas_yeo_2011,
                               fetch_atlas_aal, fetch_atlas_basc_multiscale_2015,
                               fetch_atlas_talairach, fetch_atlas_schaefer_2018)
 
 from nixtract.cli.base import (base_cli, handle_base_args, replace_file_ext,
                                make_param_file, check_glob, empty_to_none, 
-                               run_extraction)
+                               check_roi_files, run_extraction, 
+                               estimate_memory, save_outputs)
 from nixtract.extractors import NiftiExtractor
 
 def _cli_parser():
@@ -19,22 +22,34 @@ def _cli_parser():
     """
     parser = argparse.ArgumentParser()
     parser.add_argument('--input_files', nargs='+', type=str,
-                        help='One or more input NIFTI images (.nii.gz only). '
+                        help='One or more input NIFTI images (.nii.gz or '
+                             '.nii). Regions of uncompressed .nii images are '
+                             'extracted from a memory map, so that only the '
+                             'voxels of the regions are read. '
                              'Can also be a single string with wildcards (*) '
                              'to specify all files matching the file pattern. '
                              'If so, these files are naturally sorted by file '
                              'name prior to extraction')
-    parser.add_argument('--roi_file', type=str, 
+    parser.add_argument('--roi_file', nargs='+', type=str, 
                         help='Parameter that defines the region(s) of interest. '
                              'This can be 1) a file path to NIFTI image that is '
                              'an atlas of multiple regions or a binary mask of '
-                             'one region, 2) a nilearn query string formatted as '
+                             'one region, or a 4D NIFTI image of weighted '
+                             '(e.g., probabilistic) regions with one volume per '
+                             'region, whose timeseries are the weighted mean of '
+                             'their voxels, 2) a nilearn query string formatted as '
                              '`nilearn:<atlas-name>:<atlas-parameters> 3) a '
                              'file path to a .tsv file that has x, y, z columns '
                              'that contain coordinates in MNI space. Refer to '
                              'online documentation for more detail and how '
                              'these options map onto the underlying nilearn '
-                             'masker classes')
+                             'masker classes. If multiple roi files are '
+                             'provided, each input file is loaded once and '
+                             'extracted with every roi file, and '
+                             '`atlas-<name>` is added to the output file names '
+                             'of each roi file, where <name> is the roi file '
+                             'name without its extension and non-alphanumeric '
+                             'characters')
     parser.add_argument('--mask_img', type=str,
                         help='File path of a binary mask a to be used when '
                              '`roi_file` is a) an multi-region atlas or b) a list '
@@ -49,7 +64,9 @@ def _cli_parser():
                              'correspond to the atlas indices. The number of '
                              'labels provided must match the number of non-zero '
                              'indices in `roi_file`. Numeric indices are used if '
-                             'not provided')
+                             'not provided. If multiple roi files are provided, '
+                             'labels can only be set with a configuration file, '
+                             'as a list with the labels of each roi file')
     parser.add_argument('--as_voxels', default=False, action='store_true',
                         help='Extract the timeseries of each voxel instead in a '
                              'a region rather than the mean timeseries. This is '
@@ -68,6 +85,14 @@ def _cli_parser():
     parser.add_argument('--smoothing_fwhm', type=float,
                         help='Smoothing kernel FWHM (in mm) if spatial smoothing '
                              'is desired.')
+    parser.add_argument('--gzip_index', action='store_true', default=False,
+                        help='Build a gzip seek point index of each input '
+                             'file, stored in <cache_dir>/gzip_index, so that '
+                             'volumes can be read without decompressing the '
+                             'preceding volumes (e.g., with --discard_scans), '
+                             'and so that re-runs on the same input files '
+                             'reuse the index. Requires indexed_gzip. Default: '
+                             'False')
     parser = base_cli(parser)
     return parser.parse_args()
 
@@ -168,45 +193,96 @@ def _check_nifti_params(params):
         if not params['input_files']:
             raise ValueError('Missing input files. Check files')
 
-    if not all([i.endswith('.nii.gz') for i in params['input_files']]):
-        raise ValueError('input_files must be gzipped NIFTI images')
+    if not all([i.endswith(('.nii.gz', '.nii')) 
+                for i in params['input_files']]):
+        raise ValueError('input_files must be NIFTI images (.nii.gz or .nii)')
 
+    params['roi_file'] = check_roi_files(params['roi_file'])
     if not params['roi_file']:
         raise ValueError('Missing roi_file input.')
     
-    if params['roi_file'].startswith('nilearn:'):
-        cache = os.path.join(params['output_dir'], 'nixtract_data')
+    if isinstance(params['roi_file'], str):
+        params['roi_file'], params['labels'] = _check_roi_file(
+            params['roi_file'], params['labels'], params['out_dir']
+        )
+    else:
+        # one set of labels per roi file
+        labels = empty_to_none(params['labels'])
+        if labels is None:
+            labels = [None] * len(params['roi_file'])
+        if (len(labels) != len(params['roi_file']) or 
+                any(isinstance(x, str) and not x.endswith('.tsv') 
+                    for x in labels)):
+            raise ValueError('If multiple roi files are provided, labels must '
+                             'be a list with the labels (a list of strings, a '
+                             '.tsv file, or null) of each roi file')
+        checked = [_check_roi_file(f, x, params['out_dir']) 
+                   for f, x in zip(params['roi_file'], labels)]
+        params['roi_file'] = [x[0] for x in checked]
+        params['labels'] = [x[1] for x in checked]
+
+    return params
+
+
+def _check_roi_file(roi_file, labels, out_dir):
+    """Fetch a nilearn atlas query and read a label file, if applicable"""
+    if roi_file.startswith('nilearn:'):
+        cache = os.path.join(out_dir, 'nixtract_data')
         os.makedirs(cache, exist_ok=True)
-        atlas, labels = get_labelled_atlas(params['roi_file'], data_dir=cache,
-                                           return_labels=True)
-        params['roi_file'] = atlas
-        params['labels'] = labels
-
-    params['labels'] = empty_to_none(params['labels'])
-    if isinstance(params['labels'], str):
-        if params['labels'].endswith('.tsv'):
-            df = pd.read_table(params['labels'])
-            params['labels'] = df['Label'].tolist()
+        roi_file, labels = get_labelled_atlas(roi_file, data_dir=cache,
+                                              return_labels=True)
+
+    labels = empty_to_none(labels)
+    if isinstance(labels, str):
+        if labels.endswith('.tsv'):
+            df = pd.read_table(labels)
+            labels = df['Label'].tolist()
         else:
             raise ValueError('Labels must be a filename or a list of strings.')
+    return roi_file, labels
 
-    return params
 
+def _gzip_index_dir(params):
+    """Directory of gzip seek point indexes, if enabled"""
+    if params.get('gzip_index'):
+        return os.path.join(params['cache_dir'], 'gzip_index')
+
+
+def estimate_nifti_memory(input_file, params):
+    """Estimate the memory used to extract a NIFTI image from its header (see
+    nixtract.cli.base.estimate_memory)
+    """
+    img = nib.load(input_file)
+    shape = img.shape
+    n_timepoints = shape[3] if len(shape) > 3 else 1
+    # discarded scans are never loaded
+    n_timepoints = max(n_timepoints - (params['discard_scans'] or 0), 1)
+    proxy = img.dataobj
+    scaled = (getattr(proxy, 'slope', 1) != 1 
+              or getattr(proxy, 'inter', 0) != 0)
+    return estimate_memory(int(np.prod(shape[:3])) * n_timepoints, 
+                           img.get_data_dtype(), params, scaled)
 
-def extract_nifti(input_file, roi_file, regressor_file, params):
-    """Extract timeseries from a NIFTI image
+
+def load_nifti(input_file, roi_file, regressor_file, params):
+    """Set up the extraction of a NIFTI image, and read its data
 
     Parameters
     ----------
     input_files : str
         File path of the functional nifti file
-    roi_file : str
+    roi_file : str or list
         File path of the roi file, where each region is labelled based on the
-        numeric values in the file 
+        numeric values in the file, or a list of file paths
     regressor_file : str
         File path of regressor file
     params : dict
         Parameter dictionary for extraction
+
+    Returns
+    -------
+    str, nixtract.extractors.NiftiExtractor
+        Output file name, and the extractor, ready to extract
     """
     extractor = NiftiExtractor(
         fname=input_file,
@@ -216,13 +292,17 @@ def extract_nifti(input_file, roi_file, regressor_file, params):
         mask_img=params['mask_img'], 
         radius=params['radius'], 
         allow_overlap=params['allow_overlap'],
-        verbose=params['verbose'], 
+        verbose=params['verbose'],
+        cache_dir=params['cache_dir'],
+        dtype=params['precision'], 
+        summary=params['summary'],
         standardize=params['standardize'], 
         t_r=params['t_r'], 
         high_pass=params['high_pass'], 
         low_pass=params['low_pass'], 
         detrend=params['detrend'],
-        smoothing_fwhm=params['smoothing_fwhm']
+        smoothing_fwhm=params['smoothing_fwhm'],
+        gzip_index_dir=_gzip_index_dir(params)
     )
     if regressor_file is not None:
         extractor.set_regressors(regressor_file, params['regressors'], 
@@ -231,21 +311,48 @@ def extract_nifti(input_file, roi_file, regressor_file, params):
     if (params['discard_scans'] is not None) and (params['discard_scans'] > 0):
         extractor.discard_scans(params['discard_scans'])
     
-    extractor.extract()
-    out = os.path.join(params['out_dir'], replace_file_ext(input_file))
-    extractor.save(out, params['n_decimals'])
+    out = os.path.join(params['out_dir'], 
+                       replace_file_ext(input_file, params['output_format']))
+    return out, extractor.load()
+
+
+def extract_nifti(input_file, roi_file, regressor_file, params):
+    """Extract timeseries from a NIFTI image
 
+    Parameters
+    ----------
+    input_files : str
+        File path of the functional nifti file
+    roi_file : str or list
+        File path of the roi file, where each region is labelled based on the
+        numeric values in the file, or a list of file paths
+    regressor_file : str
+        File path of regressor file
+    params : dict
+        Parameter dictionary for extraction
+    """
+    out, extractor = load_nifti(input_file, roi_file, regressor_file, params)
+    extractor.extract()
+    save_outputs(out, extractor, params)
     return out, extractor
 
 def main():
     params = vars(_cli_parser())
     params = _check_nifti_params(params)
     metadata_path = make_param_file(params)
-    shutil.copy2(params['roi_file'], metadata_path)
+    roi_files = params['roi_file']
+    if isinstance(roi_files, str):
+        roi_files = [roi_files]
+    for roi_file in roi_files:
+        shutil.copy2(roi_file, metadata_path)
+        # compile the roi file once so that each extraction only loads the 
+        # plan
+        NiftiExtractor.load_plan(roi_file, params['cache_dir'])
 
     # setup and run extraction
     run_extraction(extract_nifti, params['input_files'], params['roi_file'], 
-                   params)
+                   params, estimate_func=estimate_nifti_memory, 
+                   load_func=load_nifti)
 
 if __name__ == '__main__':
     raise RuntimeError("`nixtract/cli/nifti.py` should not be run directly. "
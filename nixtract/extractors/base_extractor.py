@@ -5,6 +5,68 @@ import numpy as np
 import pandas as pd
 import load_confounds
 
+from .plan import load_plan
+from .summary import check_summary, summary_fname, _insert_entity
+from .output import check_output_format, write_timeseries
+from .store import store_key
+
+# roi file extensions removed from atlas names
+_ROI_EXTENSIONS = ['.dlabel.nii', '.dscalar.nii', '.label.gii', '.func.gii', 
+                   '.shape.gii', '.nii.gz', '.nii', '.annot', '.tsv', '.csv']
+
+
+def atlas_names(roi_files):
+    """Make a unique name for each roi file, used to name its outputs
+
+    Names are the roi file names without their extension or any 
+    non-alphanumeric characters. Repeated names are numbered.
+
+    Parameters
+    ----------
+    roi_files : list of str
+        ROI files
+
+    Returns
+    -------
+    list of str
+        Atlas name of each roi file
+    """
+    names = []
+    for fname in roi_files:
+        name = os.path.basename(fname)
+        for ext in _ROI_EXTENSIONS:
+            if name.endswith(ext):
+                name = name[:-len(ext)]
+                break
+        names.append(''.join(c for c in name if c.isalnum()) or 'atlas')
+
+    counts = {n: names.count(n) for n in names}
+    seen = {}
+    for i, name in enumerate(names):
+        if counts[name] > 1:
+            seen[name] = seen.get(name, 0) + 1
+            names[i] = f'{name}{seen[name]}'
+    return names
+
+
+def atlas_fname(fname, atlas):
+    """Insert an `atlas-<atlas>` entity into an output file name
+
+    Parameters
+    ----------
+    fname : str
+        Output file name, typically ending with _timeseries.tsv
+    atlas : str
+        Atlas name (see atlas_names)
+
+    Returns
+    -------
+    str
+        File name of the atlas, e.g. sub-01_atlas-Gordon_timeseries.tsv for
+        sub-01_timeseries.tsv
+    """
+    return _insert_entity(fname, 'atlas', atlas)
+
 
 def _load_from_strategy(denoiser, fname):
     """Verifies if load_confounds strategy is useable given the regressor files.
@@ -72,6 +134,92 @@ def _load_regressor_names(regressors, regressor_file):
 
 class BaseExtractor(object):
 
+    @classmethod
+    def load_plan(cls, roi_file, cache_dir=None):
+        """Load the compiled extraction plan of an roi file, which is compiled
+        by the `_compile_plan` of each extractor
+
+        Parameters
+        ----------
+        roi_file : str
+            ROI file
+        cache_dir : str, optional
+            Directory in which compiled plans are cached. If None, the plan is
+            compiled without caching. By default None
+
+        Returns
+        -------
+        nixtract.extractors.plan.ExtractionPlan or None
+            Compiled plan, or None if roi_file does not support plans
+        """
+        return load_plan(roi_file, cls._compile_plan, cache_dir)
+
+    def _set_roi_files(self, roi_file):
+        """Validate and set one or more roi files. If more than one roi file
+        is provided, each is named (see atlas_names) so that its outputs can 
+        be saved separately
+
+        Parameters
+        ----------
+        roi_file : str or list of str
+            ROI file(s)
+
+        Raises
+        ------
+        ValueError
+            No roi files are provided
+        """
+        self.roi_file = roi_file
+        if isinstance(roi_file, str):
+            roi_file = [roi_file]
+        self.roi_files = list(roi_file)
+        if not self.roi_files:
+            raise ValueError('At least one roi file must be provided')
+        self.atlas_names = None
+        if len(self.roi_files) > 1:
+            self.atlas_names = atlas_names(self.roi_files)
+
+    def _set_results(self, summaries):
+        """Set the extracted timeseries of each roi file
+
+        Parameters
+        ----------
+        summaries : list of dict of pandas.DataFrame
+            Timeseries of each summary statistic, per roi file. The first roi
+            file and summary statistic are also set as `timeseries`
+        """
+        self.summaries = summaries[0]
+        self.timeseries = self.summaries[self.summary[0]]
+        self.atlas_summaries = None
+        if getattr(self, 'atlas_names', None) is not None:
+            self.atlas_summaries = dict(zip(self.atlas_names, summaries))
+
+    def _set_summary(self, summary, as_vertices=False):
+        """Validate and set the summary statistics to extract
+
+        Parameters
+        ----------
+        summary : str or list of str or None
+            Summary statistics (see nixtract.extractors.summary.check_summary)
+        as_vertices : bool, optional
+            If individual vertices/voxels are extracted, in which case only 
+            the default summary is possible. By default False
+
+        Raises
+        ------
+        ValueError
+            Invalid summary statistics, or summary is used with as_vertices
+        """
+        self.summary = check_summary(summary)
+        if self.summary == ['mean']:
+            # default extraction, without per-region statistics
+            self._summary = None
+        elif as_vertices:
+            raise ValueError('Summary statistics cannot be computed when '
+                             'extracting individual vertices/voxels')
+        else:
+            self._summary = self.summary
+
     def set_regressors(self, regressor_file, regressors=None, 
                        load_confounds_kwargs=None):
         """Set regressors to be used with extraction
@@ -144,6 +292,19 @@ class BaseExtractor(object):
         mask = np.isnan(self.regressor_array[0, :])
         self.regressor_array[0, mask] = self.regressor_array[1, mask]
 
+    def load(self):
+        """Load the data to extract ahead of extraction, such as in a 
+        background thread while another input file is extracted (see 
+        nixtract.cli.base.run_extraction). Extractors that load their data 
+        when they are created have nothing left to load
+
+        Returns
+        -------
+        BaseExtractor
+            The extractor
+        """
+        return self
+
     def check_extracted(self):
         """Check is extraction has been performed
 
@@ -156,18 +317,87 @@ class BaseExtractor(object):
             raise ValueError('timeseries data does not yet exist. Must call '
                              'extract().')
 
-    def save(self, out, n_decimals=None):
-        """Save file to a .tsv file
+    def save(self, out, n_decimals=None, output_format=None, 
+             compression_level=None):
+        """Save timeseries to a .tsv file, or to a binary file format
+
+        If summary statistics other than the mean were extracted, one file is
+        saved per statistic, with a `stat-<statistic>` entity added to out 
+        (see nixtract.extractors.summary.summary_fname). If more than one roi
+        file was extracted, one file is saved per roi file, with an 
+        `atlas-<name>` entity added to out (see atlas_fname).
+
+        npy outputs are saved with a .json sidecar file that holds the labels,
+        input file(s) and regressor names, and can be memory-mapped (see 
+        nixtract.extractors.output.read_timeseries).
 
         Parameters
         ----------
         out : str
             Output file name
+        n_decimals : int, optional
+            Number of decimals of the saved timeseries, by default None
+        output_format : str, optional
+            'tsv', 'tsv.gz', 'tsv.zst', 'parquet', 'feather', 'npy' or 'hdf5' 
+            (see nixtract.extractors.output.write_timeseries). If None, the 
+            format is inferred from the extension of out. By default None
+        compression_level : int, optional
+            Compression level of 'tsv.gz' and 'tsv.zst' files, by default None
+        """
+        output_format = check_output_format(output_format, out)
+        regressors = getattr(self, 'regressor_names', None)
+        metadata = {
+            'source': self._source_files(),
+            'regressors': None if regressors is None else list(regressors)
+        }
+        for fname, tseries in self._outputs(out):
+            write_timeseries(tseries, fname, output_format, n_decimals, 
+                             compression_level, metadata)
+
+    def save_to_store(self, store, out, n_decimals=None):
+        """Add timeseries to a consolidated store instead of separate files
+
+        Each table of timeseries is keyed by the file name that save would
+        use, without its directory and extension.
+
+        Parameters
+        ----------
+        store : nixtract.extractors.store.TimeseriesStore
+            Open store
+        out : str
+            Output file name
+        n_decimals : int, optional
+            Number of decimals of the stored timeseries, by default None
+        """
+        source = ', '.join(self._source_files())
+        for fname, tseries in self._outputs(out):
+            if n_decimals:
+                tseries = tseries.round(n_decimals)
+            store.append(store_key(fname), tseries, source)
+
+    def _source_files(self):
+        """Input file(s) of the extracted timeseries"""
+        return [self.fname]
+
+    def _outputs(self, out):
+        """Yield the file name and table of each set of extracted timeseries,
+        per roi file and summary statistic (see save)
         """
         self.check_extracted()
-        float_format = f'%.{n_decimals}f' if n_decimals else None
-        self.timeseries.to_csv(out, sep='\t', index=False, 
-                               float_format=float_format)
+        results = getattr(self, 'atlas_summaries', None)
+        if results is None:
+            summaries = getattr(self, 'summaries', None)
+            if summaries is None:
+                summaries = {'mean': self.timeseries}
+            results = {None: summaries}
+
+        for atlas, summaries in results.items():
+            fname = out if atlas is None else atlas_fname(out, atlas)
+            if list(summaries) == ['mean']:
+                yield fname, summaries['mean']
+                continue
+            for stat, tseries in summaries.items():
+                yield summary_fname(fname, stat), tseries
 
     def show_extract_msg(self, fname):
         """Display extraction message if verbosity is set
@@ -3,7 +3,9 @@ import numpy as np
 import nibabel as nib
 
 from .base_extractor import BaseExtractor
-from .utils import mask_data, label_timeseries
+from .utils import mask_datasets, mask_chunks_rois, label_timeseries
+from .plan import ExtractionPlan
+from .reduction import LabelReducer
 
 
 def _check_cifti(fname):
@@ -28,7 +30,7 @@ def _read_dlabel(fname):
     img = _check_cifti(fname)
 
     # actual numerical labels in data to compare with label table
-    vertex_labels = np.unique(img.get_fdata())
+    vertex_labels = np.unique(np.asanyarray(img.dataobj))
 
     label_dict = img.header.get_axis(index=0).label[0]
     labels = []
@@ -38,6 +40,21 @@ def _read_dlabel(fname):
     return img, labels
 
 
+def _read_dscalar(fname):
+    """Safely read a dscalar file of weighted regions, with one region per 
+    map, and return the image, region reducer and map names
+    """
+    if not fname.endswith('.dscalar.nii'):
+        raise ValueError(f'{fname} must be a .dscalar.nii file')
+    img = _check_cifti(fname)
+
+    names = list(img.header.get_axis(index=0).name)
+    labels = [n if n else f'map{i + 1}' for i, n in enumerate(names)]
+    # read one map at a time from the proxy
+    maps = (np.asarray(img.dataobj[i]) for i in range(img.shape[0]))
+    return img, LabelReducer.from_weights(maps), labels
+
+
 def _get_models(img):
     """Pull out all brain models from cifti file"""
     brain_models = list(img.header.get_index_map(1).brain_models)
@@ -70,27 +87,82 @@ def _has_medwall(model):
         return False
 
 
-def _load_and_align_ciftis(dlabel, dtseries):
-    """Correctly align the dlabel with the dtseries data
+def _align_indices(dl_models, dts_models):
+    """Get the indices that align dlabel vertices with dtseries vertices
+
+    Iterate through the brain models in dtseries and check vertex alignment of
+    surface models, and the existence of volume models. 
+
+    Parameters
+    ----------
+    dl_models : dict
+        Brain models of the dlabel (see `_get_models`)
+    dts_models : dict
+        Brain models of the dtseries (see `_get_models`)
+
+    Returns
+    -------
+    np.ndarray, np.ndarray
+        Indices into the dlabel and dtseries vertices, respectively
+
+    Raises
+    ------
+    ValueError
+        If a brain model has different lengths in dlabel and dtseries but no 
+        medial wall has been detected in either
+    """
+    dlabel_list = []
+    dtseries_list = []
+    for k, v in dts_models.items():
+
+        if k not in dl_models.keys():
+            # dlabel does not have the brain model
+            continue
+
+        if dl_models[k]['count'] == v['count']:
+            # both are the same so doesnt matter if medial wall or not
+            dts_idx = np.arange(v['count']) + v['offset']
+            dl_idx = dts_idx
+        elif _has_medwall(dl_models[k]) and not _has_medwall(v):
+            # use dtseries vertices to index dlabel
+            dl_idx = v['indices'] + dl_models[k]['offset']
+            dts_idx = np.arange(v['count']) + v['offset']
+        elif _has_medwall(v) and not _has_medwall(dl_models[k]):
+            # use dlabel vertices to index dtseries
+            dts_idx = dl_models[k]['indices'] + v['offset']
+            dl_idx = np.arange(dl_models[k]['count']) + dl_models[k]['offset']
+        else:
+            # no medial wall in both but also not equal
+            raise ValueError('Cannot align dlabel with dtseries.')
+        
+        dlabel_list.append(dl_idx)
+        dtseries_list.append(dts_idx)
+
+    return np.hstack(dlabel_list), np.hstack(dtseries_list)
+
+
+def _align_ciftis(plan, dtseries):
+    """Align the dlabel with the dtseries vertices without loading any data
 
     If dlabel and dtseries have the same number of elements, then they are 
-    already aligned, and are each plainly loaded. If not, then iterate through
-    the brain models in dtseries and check vertex alignment of surface models, 
-    and the existence of volume models. This will happen if a) dlabel includes
-    medial wall vertices but dtseries does not or vice versa, or b) if dlabel
-    does not have all the brain models found in dtseries. 
+    already aligned. If not, then the vertices are aligned via the brain 
+    models in each file (see `_align_indices`). This will happen if a) dlabel
+    includes medial wall vertices but dtseries does not or vice versa, or b) 
+    if dlabel does not have all the brain models found in dtseries. 
 
     Parameters
     ----------
-    dlabel : nibabel.Cifti1Image
-        ROI/label file
+    plan : nixtract.extractors.plan.ExtractionPlan
+        Compiled ROI/label file
     dtseries : nibabel.Cifti1Image
         Functional data
 
     Returns
     -------
-    np.ndarray, np.ndarray
-        Aligned arrays for the dlabel and dtseries, respectively
+    np.ndarray, np.ndarray or None, LabelReducer
+        Aligned dlabel array, the dtseries vertices aligned to it (None if 
+        all vertices are already aligned), and the reducer of the aligned 
+        dlabel
 
     Raises
     ------
@@ -98,62 +170,69 @@ def _load_and_align_ciftis(dlabel, dtseries):
         If dlabel and dtseries have different lengths but no medial wall has
         been detected in either
     """
+    dlabel_data = plan.roi
 
-    dlabel_data = dlabel.get_fdata().ravel()
-    dtseries_data = dtseries.get_fdata()
-
-    if dlabel.shape[1] == dtseries.shape[1]:
-        return dlabel_data, dtseries_data
+    if len(dlabel_data) == dtseries.shape[1]:
+        return dlabel_data, None, plan.reducer
     else:
-        warnings.warn(f'dlabel has shape {dlabel.shape[1]} and dtseries has '
+        warnings.warn(f'dlabel has shape {len(dlabel_data)} and dtseries has '
                       f'shape {dtseries.shape[1]}. Aligning files via '
                       'brain structures present in each file. Double check '
                       'results!')
-        dl_models = _get_models(dlabel)
-        dts_models = _get_models(dtseries)
-
-        dlabel_list = []
-        dtseries_list = []
-        for k, v in dts_models.items():
-  
-            if k not in dl_models.keys():
-                # dlabel does not have the brain model
-                continue
-
-            if dl_models[k]['count'] == v['count']:
-                # both are the same so doesnt matter if medial wall or not
-                dts_idx = np.arange(v['count']) + v['offset']
-                dl_idx = dts_idx
-            elif _has_medwall(dl_models[k]) and not _has_medwall(v):
-                # use dtseries vertices to index dlabel
-                dl_idx = v['indices'] + dl_models[k]['offset']
-                dts_idx = np.arange(v['count']) + v['offset']
-            elif _has_medwall(v) and not _has_medwall(dl_models[k]):
-                # use dlabel vertices to index dtseries
-                dts_idx = dl_models[k]['indices'] + v['offset']
-                dl_idx = np.arange(dl_models[k]['count']) + dl_models[k]['offset']
-            else:
-                # no medial wall in both but also not equal
-                raise ValueError('Cannot align dlabel with dtseries.')
-            
-            dlabel_list.append(dlabel_data[dl_idx])
-            dtseries_list.append(dtseries_data[:, dts_idx])
+        dl_idx, dts_idx = _align_indices(plan.layout, _get_models(dtseries))
+        return dlabel_data[dl_idx], dts_idx, plan.reducer.subset(dl_idx)
+
 
-        return np.hstack(dlabel_list), np.hstack(dtseries_list)
+def _iter_dtseries(dtseries, chunk_size, columns=None, start=0, 
+                   dtype=np.float64):
+    """Read the dtseries data in blocks of timepoints
+
+    Only one block is read from the data proxy at a time, so memory is bounded
+    by `chunk_size` rather than by the number of timepoints.
+
+    Parameters
+    ----------
+    dtseries : nibabel.Cifti1Image
+        Functional data
+    chunk_size : int
+        Number of timepoints per block
+    columns : np.ndarray, optional
+        Vertices to keep from each block, by default None (all vertices)
+    start : int, optional
+        First timepoint to read, by default 0
+    dtype : numpy.dtype, optional
+        Floating point type of each block, by default np.float64
+
+    Yields
+    ------
+    np.ndarray, (chunk_size, n_vertices)
+        Block of timepoints. The final block may be shorter
+    """
+    for i in range(start, dtseries.shape[0], chunk_size):
+        block = np.asarray(dtseries.dataobj[i:i + chunk_size], dtype=dtype)
+        if columns is not None:
+            block = block[:, columns]
+        yield block
             
 
 class CiftiExtractor(BaseExtractor):
     def __init__(self, fname, roi_file, as_vertices=False, pre_clean=False, 
-                 verbose=False, **kwargs):
+                 verbose=False, cache_dir=None, chunk_size=None, dtype=None,
+                 n_threads=1, summary=None, **kwargs):
         """Cifti extraction class
 
         Parameters
         ----------
         fname : str
             Functional dtseries.nii file
-        roi_file : str
+        roi_file : str or list of str
             dlabel.nii file that identifies regions of interests. Can be an 
-            atlas/parcellation with multiple regions, or a binary mask
+            atlas/parcellation with multiple regions, or a binary mask. Or, a
+            dscalar.nii file of weighted (e.g., probabilistic) regions with 
+            one map per region, in which case region timeseries are weighted
+            means and are named after each map. If a list, the dtseries is 
+            loaded once and extracted with every roi file, and the outputs of
+            each roi file are kept separate (see `atlas_summaries`)
         as_vertices : bool, optional
             Extract the individual vertex timeseries from a region. Only 
             possible when roi_file is a binary mask (single region), by 
@@ -165,6 +244,33 @@ class CiftiExtractor(BaseExtractor):
             computationally efficient. By default False
         verbose : bool, optional
             Print out extraction timestamp, by default False
+        cache_dir : str, optional
+            Directory in which the compiled roi_file is cached and reused 
+            across extractors. If None, roi_file is compiled without caching.
+            By default None
+        chunk_size : int, optional
+            Stream the dtseries in blocks of `chunk_size` timepoints, which 
+            are each reduced to region timeseries before the next block is 
+            read. Peak memory is then bounded by the chunk size rather than by
+            the number of timepoints, and `darray` is never loaded. Denoising 
+            is performed on the extracted timeseries, so this cannot be 
+            combined with pre_clean. If None, the full dtseries is loaded. By
+            default None
+        dtype : numpy.dtype or str, optional
+            Floating point type used to load, extract and denoise the data. 
+            'float32' halves memory use, and results agree with float64 to
+            within nixtract.extractors.utils.FLOAT32_RTOL. If None, float64 
+            is used. By default None
+        n_threads : int, optional
+            Number of threads used to denoise vertices if pre_clean=True, by 
+            default 1
+        summary : str or list of str, optional
+            Summary statistic(s) of the vertices in each region, computed in
+            a single pass over the data. One or more of 'mean', 'median', 
+            'std', 'trimmed_mean' and 'eigenvariate' (see 
+            nixtract.extractors.summary). The eigenvariate cannot be combined
+            with chunk_size. If None, only the mean is extracted. By default 
+            None
         **kwargs
             Arguments to pass to nilearn.signal.clean other than 
             confounds_regressors
@@ -172,17 +278,61 @@ class CiftiExtractor(BaseExtractor):
         
         self.fname = fname
         self.dtseries = _read_dtseries(fname)
-        self.roi_file = roi_file
-        self.dlabel, self.labels = _read_dlabel(roi_file)     
+        self._set_roi_files(roi_file)
+        self.plans = [self.load_plan(x, cache_dir) for x in self.roi_files]
+        self.plan = self.plans[0]
+        self.labels = self.plan.labels
         self.as_vertices = as_vertices
         self.pre_clean = pre_clean
         self.verbose = verbose
         self._clean_kwargs = kwargs
+        self.n_threads = n_threads
+        self.dtype = np.dtype(np.float64 if dtype is None else dtype)
+        self._set_summary(summary, as_vertices)
 
-        self.dlabel_array, self.darray = _load_and_align_ciftis(self.dlabel, 
-                                                                self.dtseries)
+        if chunk_size is not None:
+            if chunk_size < 1:
+                raise ValueError('chunk_size must be a positive integer')
+            if pre_clean:
+                raise ValueError('pre_clean cannot be used with chunk_size; '
+                                 'streamed data can only be denoised after '
+                                 'extraction')
+            if 'eigenvariate' in self.summary:
+                raise ValueError('The eigenvariate cannot be computed with '
+                                 'chunk_size, as it requires all timepoints')
+        self.chunk_size = chunk_size
+        self._start = 0
+
+        # align each roi file with the dtseries vertices. Reducers are placed
+        # over all dtseries vertices, so that the data are shared by every 
+        # roi file rather than copied out for each
+        self.dlabel_arrays, self.reducers = [], []
+        for plan in self.plans:
+            dlabel_array, columns, reducer = _align_ciftis(plan, 
+                                                           self.dtseries)
+            if columns is not None:
+                reducer = reducer.expand(columns, self.dtseries.shape[1])
+            self.dlabel_arrays.append(dlabel_array)
+            self.reducers.append(reducer)
+        self.dlabel_array = self.dlabel_arrays[0]
+        self.reducer = self.reducers[0]
+
+        self.darray = None
+        if self.chunk_size is None:
+            self.darray = self.dtseries.get_fdata(dtype=self.dtype)
         self.regressor_names = None
         self.regressor_array = None
+
+    @staticmethod
+    def _compile_plan(roi_file):
+        """Compile a dlabel or dscalar file into an ExtractionPlan"""
+        if roi_file.endswith('.dscalar.nii'):
+            img, reducer, labels = _read_dscalar(roi_file)
+            return ExtractionPlan(reducer.to_roi(), labels, reducer, 
+                                  layout=_get_models(img), roi_file=roi_file)
+        img, labels = _read_dlabel(roi_file)
+        return ExtractionPlan(img.get_fdata().ravel(), labels, 
+                              layout=_get_models(img), roi_file=roi_file)
         
     def discard_scans(self, n_scans):
         """Discard first N scans from data and regressors, if available 
@@ -192,19 +342,47 @@ class CiftiExtractor(BaseExtractor):
         n_scans : int
             Number of initial scans to remove
         """
-        self.darray = self.darray[n_scans:, :]
+        if self.chunk_size is None:
+            self.darray = self.darray[n_scans:, :]
+        else:
+            # skipped when the dtseries is streamed
+            self._start += n_scans
 
         if self.regressor_array is not None:
             self.regressor_array = self.regressor_array[n_scans:, :]
     
     def extract(self):
-        """Extract timeseries"""
+        """Extract timeseries
+        
+        If there are multiple roi files, the data are reduced with every roi
+        file, and the timeseries of all roi files are denoised together. With
+        pre_clean, the data are denoised once for all roi files.
+        """
         self.show_extract_msg(self.fname)
-        tseries = mask_data(self.darray, self.dlabel_array, 
-                            self.regressor_array, self.as_vertices, 
-                            self.pre_clean, **self._clean_kwargs)
-        self.timeseries = label_timeseries(tseries, self.labels, 
-                                           self.as_vertices)
-        # remove extracted background signal if any
-        if '???' in self.timeseries.columns:
-            self.timeseries = self.timeseries.drop('???', axis=1)
\ No newline at end of file
+        n_rois = len(self.reducers)
+        if self.chunk_size is None:
+            tseries = mask_datasets([self.darray] * n_rois, self.reducers, 
+                                    self.regressor_array, self.as_vertices, 
+                                    self.pre_clean, self.n_threads, 
+                                    self._summary, **self._clean_kwargs)
+        else:
+            chunks = _iter_dtseries(self.dtseries, self.chunk_size, 
+                                    start=self._start, dtype=self.dtype)
+            tseries = mask_chunks_rois(chunks, self.reducers, 
+                                       self.regressor_array, 
+                                       self.as_vertices, self._summary, 
+                                       **self._clean_kwargs)
+        if self._summary is None:
+            tseries = [{'mean': x} for x in tseries]
+
+        results = []
+        for plan, summaries in zip(self.plans, tseries):
+            labelled = {}
+            for stat, x in summaries.items():
+                x = label_timeseries(x, plan.labels, self.as_vertices)
+                # remove extracted background signal if any
+                if '???' in x.columns:
+                    x = x.drop('???', axis=1)
+                labelled[stat] = x
+            results.append(labelled)
+        self._set_results(results)
@@ -0,0 +1,187 @@
+"""Denoising of vertex/voxel data with a precomputed projection"""
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from scipy import linalg
+from nilearn.signal import butterworth, _standardize
+
+from . import reduction
+
+
+def _detrend_basis(n_timepoints):
+    """Orthonormal basis of the constant and linear trend removed by
+    nilearn.signal._detrend
+    """
+    trend = np.arange(n_timepoints, dtype=np.float64)
+    trend -= trend.mean()
+    basis = [np.full(n_timepoints, 1 / np.sqrt(n_timepoints))]
+    if np.linalg.norm(trend) >= np.finfo(np.float64).eps:
+        basis.append(trend / np.linalg.norm(trend))
+    return np.column_stack(basis)
+
+
+def _confound_basis(confounds, n_timepoints, detrend, standardize_confounds,
+                    filter_kwargs):
+    """Orthonormal basis of the confounds, prepared the same way as in
+    nilearn.signal.clean
+    """
+    if isinstance(confounds, (list, tuple)):
+        confounds = np.column_stack([np.asarray(c) for c in confounds])
+    confounds = np.asarray(confounds, dtype=np.float64)
+    if confounds.ndim == 1:
+        confounds = confounds[:, np.newaxis]
+    if confounds.shape[0] != n_timepoints:
+        raise ValueError('Confound signal has an incorrect length')
+
+    if filter_kwargs is not None:
+        confounds = butterworth(confounds.copy(), **filter_kwargs)
+    confounds = _standardize(confounds, standardize=standardize_confounds,
+                             detrend=detrend)
+    if not standardize_confounds:
+        confound_max = np.max(np.abs(confounds), axis=0)
+        confound_max[confound_max == 0] = 1
+        confounds /= confound_max
+
+    Q, R, _ = linalg.qr(confounds, mode='economic', pivoting=True)
+    return Q[:, np.abs(np.diag(R)) > np.finfo(np.float64).eps * 100.]
+
+
+class SignalCleaner(object):
+    def __init__(self, n_timepoints, confounds=None, detrend=True,
+                 standardize='zscore', standardize_confounds=True,
+                 low_pass=None, high_pass=None, t_r=2.5,
+                 ensure_finite=False, n_threads=1):
+        """Denoise many signals that share the same confounds and filters
+
+        Equivalent to nilearn.signal.clean (without sessions), but the
+        detrending, filtering and confound regression steps are combined into
+        a single linear projection that is computed once. Signals are then
+        cleaned by matrix products over blocks of columns, which can be run
+        in parallel threads. Without filtering, the projection is applied in
+        low-rank form, i.e. by removing an orthonormal basis of the trends and
+        confounds. With filtering, a dense (n_timepoints, n_timepoints)
+        operator is used.
+
+        Parameters
+        ----------
+        n_timepoints : int
+            Number of timepoints of the signals
+        confounds : numpy.ndarray, pandas.DataFrame or list, optional
+            Confound regressors, (n_timepoints, n_confounds), by default None
+        detrend, standardize, standardize_confounds, low_pass, high_pass,
+        t_r, ensure_finite
+            See nilearn.signal.clean; defaults are the same
+        n_threads : int, optional
+            Number of threads used to clean blocks of columns, by default 1
+
+        Raises
+        ------
+        ValueError
+            Filtering requested without t_r, or confounds do not match
+            n_timepoints
+        """
+        if standardize not in [True, False, 'psc', 'zscore']:
+            raise ValueError(f'{standardize} is no valid standardize '
+                             'strategy.')
+        self.n_timepoints = n_timepoints
+        self.detrend = detrend and n_timepoints > 1
+        self.standardize = standardize
+        self.ensure_finite = ensure_finite
+        self.n_threads = max(1, n_threads)
+
+        filter_kwargs = None
+        if low_pass is not None or high_pass is not None:
+            if t_r is None:
+                raise ValueError('Repetition time (t_r) must be specified '
+                                 'for filtering')
+            filter_kwargs = dict(sampling_rate=1. / t_r, low_pass=low_pass,
+                                 high_pass=high_pass)
+
+        bases = []
+        if self.detrend:
+            bases.append(_detrend_basis(n_timepoints))
+        if confounds is not None:
+            # confounds are detrended along with the signals, and so are
+            # already orthogonal to the trend basis
+            bases.append(_confound_basis(confounds, n_timepoints, detrend,
+                                         standardize_confounds,
+                                         filter_kwargs))
+
+        self.basis = None
+        self.operator = None
+        if filter_kwargs is None:
+            if bases:
+                self.basis = np.hstack(bases)
+        else:
+            # detrend -> filter -> remove confounds, as a dense operator
+            operator = butterworth(np.eye(n_timepoints), **filter_kwargs)
+            if self.detrend:
+                trend = bases.pop(0)
+                operator -= (operator @ trend) @ trend.T
+            if bases:
+                Q = bases[0]
+                operator -= Q @ (Q.T @ operator)
+            self.operator = operator
+
+    def _clean(self, signals):
+        """Clean a single block of signals"""
+        if self.ensure_finite:
+            signals = np.where(np.isfinite(signals), signals, 0)
+
+        if self.operator is not None:
+            cleaned = self.operator @ signals
+        elif self.basis is not None:
+            cleaned = signals - self.basis @ (self.basis.T @ signals)
+        else:
+            cleaned = np.array(signals, dtype=np.float64)
+
+        if self.detrend and self.standardize == 'psc':
+            # psc is relative to the original mean signal
+            cleaned += signals.mean(axis=0)
+            return _standardize(cleaned, standardize='psc', detrend=False)
+        return _standardize(cleaned, standardize=self.standardize,
+                            detrend=False)
+
+    def transform(self, signals):
+        """Clean signals
+
+        Parameters
+        ----------
+        signals : numpy.ndarray, (n_timepoints, n_signals)
+            Signals to clean, which are not modified
+
+        Returns
+        -------
+        numpy.ndarray, (n_timepoints, n_signals)
+            Cleaned signals, with the same floating point type as signals
+
+        Raises
+        ------
+        ValueError
+            Number of timepoints does not match the cleaner
+        """
+        signals = np.asarray(signals)
+        if signals.shape[0] != self.n_timepoints:
+            raise ValueError(f'Signals have {signals.shape[0]} timepoints '
+                             f'but cleaner has {self.n_timepoints}')
+        dtype = np.result_type(signals.dtype, np.float32)
+        out = np.empty(signals.shape, dtype=dtype)
+        if out.size == 0:
+            return out
+
+        # bounded blocks, with at least one block per thread
+        n_columns = signals.shape[1]
+        step = min(reduction._BLOCK_BYTES // (self.n_timepoints * 8),
+                   -(-n_columns // self.n_threads))
+        blocks = [slice(i, min(i + max(1, step), n_columns))
+                  for i in range(0, n_columns, max(1, step))]
+
+        def _clean_block(block):
+            out[:, block] = self._clean(signals[:, block])
+
+        if self.n_threads == 1 or len(blocks) == 1:
+            for block in blocks:
+                _clean_block(block)
+        else:
+            with ThreadPoolExecutor(self.n_threads) as pool:
+                list(pool.map(_clean_block, blocks))
+        return out
@@ -5,7 +5,9 @@ import pandas as pd
 import nibabel as nib
 
 from .base_extractor import BaseExtractor
-from .utils import mask_data, label_timeseries
+from .utils import mask_datasets, label_timeseries
+from .plan import ExtractionPlan
+from .reduction import LabelReducer
 
 
 def _check_labels(darray, labels, fname):
@@ -57,6 +59,24 @@ def _read_gifti_label(fname):
     return darray, labels
 
 
+def _read_gifti_weights(fname):
+    """Safely read a func.gii or shape.gii file of weighted regions, with one
+    region per data array, and return the region reducer + labels
+    """
+    img = nib.load(fname)
+    if not isinstance(img, nib.GiftiImage):
+        raise ValueError(f'{fname} not an read as a GiftiImage')
+    if not img.darrays:
+        raise ValueError(f'{fname} has no data arrays')
+
+    labels = {}
+    for i, darray in enumerate(img.darrays):
+        name = darray.meta.metadata.get('Name')
+        labels[i + 1] = name if name else f'map{i + 1}'
+    reducer = LabelReducer.from_weights(x.data for x in img.darrays)
+    return reducer, labels
+
+
 def _load_gifti_roi(fname):
     """Only read acceptable roi files"""
     if fname.endswith('.annot'):
@@ -64,25 +84,26 @@ def _load_gifti_roi(fname):
     elif fname.endswith('.label.gii'):
         darray, labels = _read_gifti_label(fname)
     else:
-        raise ValueError(f'{fname} must be a valid .annot or .label.gii file')
+        raise ValueError(f'{fname} must be a valid .annot, .label.gii, '
+                         '.func.gii or .shape.gii file')
     return darray, labels
 
 
-def _load_hem(in_file, roi_file):
+def _load_hem(in_file, roi_file, cache_dir=None, dtype=np.float64):
     """Load hemisphere only if func.gii and label.gii are available"""
     if in_file:
-        in_array = nib.load(in_file).agg_data()
+        in_array = nib.load(in_file).agg_data().astype(dtype, copy=False)
         
         if roi_file:
-            roi_darray, labels = _load_gifti_roi(roi_file)
+            plan = GiftiExtractor.load_plan(roi_file, cache_dir)
             loaded = True
         else:
             raise ValueError('Missing ROI file')
         
-        return in_array, roi_darray, labels, loaded
+        return in_array, plan, loaded
     else:
         loaded = False
-        return None, None, None, loaded
+        return None, None, loaded
 
 
 def drop_zeros(tseries, labels, as_vertices):
@@ -109,7 +130,8 @@ def _combine_timeseries(lh, rh):
 class GiftiExtractor(BaseExtractor):
     def __init__(self, lh_file=None, rh_file=None, lh_roi_file=None, 
                  rh_roi_file=None,  as_vertices=False, pre_clean=False, 
-                 verbose=False, drop_zero_label=True, **kwargs):
+                 verbose=False, drop_zero_label=True, cache_dir=None, 
+                 dtype=None, n_threads=1, summary=None, **kwargs):
         """Gifti extraction class. 
 
         Either left, right or both hemispheres can be provided. To use a 
@@ -124,10 +146,11 @@ class GiftiExtractor(BaseExtractor):
             Right hemisphere func.gii file, by default None
         lh_roi_file : str, optional
             Left hemisphere label.gii or .annot file containing region 
-            labels, by default None
+            labels. Or, a func.gii/shape.gii file of weighted (e.g., 
+            probabilistic) regions with one data array per region, in which
+            case region timeseries are weighted means. By default None
         rh_roi_file : str, optional
-            Right hemisphere label.gii or .annot file containing region 
-            labels, by default None
+            Right hemisphere roi file, as for lh_roi_file, by default None
         as_vertices : bool, optional
             Extract the individual vertex timeseries from a region. Only 
             possible when roi_file is a binary mask (single region), by 
@@ -139,6 +162,26 @@ class GiftiExtractor(BaseExtractor):
             computationally efficient. By default False
         verbose : bool, optional
             Print out extraction timestamp, by default False
+        drop_zero_label : bool, optional
+            Remove the timeseries of label 0 (background), by default True
+        cache_dir : str, optional
+            Directory in which compiled roi files are cached and reused 
+            across extractors. If None, roi files are compiled without 
+            caching. By default None
+        dtype : numpy.dtype or str, optional
+            Floating point type used to load, extract and denoise the data. 
+            'float32' halves memory use, and results agree with float64 to
+            within nixtract.extractors.utils.FLOAT32_RTOL. If None, float64 
+            is used. By default None
+        n_threads : int, optional
+            Number of threads used to denoise vertices if pre_clean=True, by 
+            default 1
+        summary : str or list of str, optional
+            Summary statistic(s) of the vertices in each region, computed in
+            a single pass over the data. One or more of 'mean', 'median', 
+            'std', 'trimmed_mean' and 'eigenvariate' (see 
+            nixtract.extractors.summary). If None, only the mean is 
+            extracted. By default None
         **kwargs
             Arguments to pass to nilearn.signal.clean other than 
             confounds_regressors
@@ -149,29 +192,60 @@ class GiftiExtractor(BaseExtractor):
             No hemispheres are provided
         """
             
+        self.dtype = np.dtype(np.float64 if dtype is None else dtype)
+
         self.lh_file = lh_file
         self.lh_roi_file = lh_roi_file
-        (self.lh_darray, self.lh_roi, 
-         self.lh_labels, self._lh) = _load_hem(lh_file, lh_roi_file)
+        self.lh_darray, lh_plan, self._lh = _load_hem(lh_file, lh_roi_file, 
+                                                      cache_dir, self.dtype)
 
         self.rh_file = rh_file
         self.rh_roi_file = rh_roi_file
-        (self.rh_darray, self.rh_roi, 
-         self.rh_labels, self._rh) = _load_hem(rh_file, rh_roi_file)
+        self.rh_darray, rh_plan, self._rh = _load_hem(rh_file, rh_roi_file, 
+                                                      cache_dir, self.dtype)
 
         if not any([self._lh, self._rh]):
             raise ValueError('At least one hemisphere must be provided to '
                              'GiftiExtractor')
 
+        self.lh_roi, self.lh_labels, self.lh_reducer = None, None, None
+        if self._lh:
+            self.lh_roi = lh_plan.roi
+            self.lh_labels = lh_plan.labels
+            self.lh_reducer = lh_plan.reducer
+        self.rh_roi, self.rh_labels, self.rh_reducer = None, None, None
+        if self._rh:
+            self.rh_roi = rh_plan.roi
+            self.rh_labels = rh_plan.labels
+            self.rh_reducer = rh_plan.reducer
+
         self.as_vertices = as_vertices
         self.pre_clean = pre_clean
         self.verbose = verbose
         self.drop_zero_label = drop_zero_label
+        self._set_summary(summary, as_vertices)
         self._clean_kwargs = kwargs
+        self.n_threads = n_threads
 
         self.regressor_names = None
         self.regressor_array = None
 
+    @staticmethod
+    def _compile_plan(roi_file):
+        """Compile a label.gii, .annot, or weighted func.gii/shape.gii file 
+        into an ExtractionPlan
+        """
+        if roi_file.endswith(('.func.gii', '.shape.gii')):
+            reducer, labels = _read_gifti_weights(roi_file)
+            return ExtractionPlan(reducer.to_roi(), labels, reducer, 
+                                  roi_file=roi_file)
+        darray, labels = _load_gifti_roi(roi_file)
+        return ExtractionPlan(darray, labels, roi_file=roi_file)
+
+    def _source_files(self):
+        """Input file of each hemisphere"""
+        return [x for x in [self.lh_file, self.rh_file] if x is not None]
+
     def discard_scans(self, n_scans):
         """Discard first N scans from data and regressors, if available 
 
@@ -189,32 +263,52 @@ class GiftiExtractor(BaseExtractor):
             self.regressor_array = self.regressor_array[n_scans:, :]
     
     def extract(self):
-        """Extract timeseries"""
+        """Extract timeseries
+        
+        Both hemispheres are extracted first and then denoised together, so 
+        that denoising is only set up and run once.
+        """
+        darrays, reducers = [], []
         if self._lh:
             self.show_extract_msg(self.lh_file)
-            lh_tseries = mask_data(self.lh_darray.T, self.lh_roi, 
-                                   self.regressor_array, self.as_vertices, 
-                                   self.pre_clean, **self._clean_kwargs)
-            lh_tseries = label_timeseries(lh_tseries, self.lh_labels.values(), 
-                                          self.as_vertices)
-            if self.drop_zero_label:
-                lh_tseries = drop_zeros(lh_tseries, self.lh_labels, 
-                                        self.as_vertices)
-            
+            darrays.append(self.lh_darray.T)
+            reducers.append(self.lh_reducer)
         if self._rh:
             self.show_extract_msg(self.rh_file)
-            rh_tseries = mask_data(self.rh_darray.T, self.rh_roi, 
-                                   self.regressor_array, self.as_vertices, 
-                                   self.pre_clean, **self._clean_kwargs)
-            rh_tseries = label_timeseries(rh_tseries, self.rh_labels.values(), 
-                                             self.as_vertices)
-            if self.drop_zero_label:
-                rh_tseries = drop_zeros(rh_tseries, self.rh_labels, 
-                                        self.as_vertices)
-
-        if self._lh and self._rh:
-            self.timeseries = _combine_timeseries(lh_tseries, rh_tseries)
-        elif self._lh:
-            self.timeseries = lh_tseries
-        elif self._rh:
-            self.timeseries = rh_tseries
\ No newline at end of file
+            darrays.append(self.rh_darray.T)
+            reducers.append(self.rh_reducer)
+
+        tseries = mask_datasets(darrays, reducers, self.regressor_array, 
+                                self.as_vertices, self.pre_clean, 
+                                self.n_threads, self._summary, 
+                                **self._clean_kwargs)
+        if self._summary is None:
+            tseries = [{'mean': x} for x in tseries]
+
+        self.summaries = {}
+        for stat in self.summary:
+            hems = [x[stat] for x in tseries]
+            if self._lh:
+                lh_tseries = label_timeseries(hems.pop(0), 
+                                              self.lh_labels.values(), 
+                                              self.as_vertices)
+                if self.drop_zero_label:
+                    lh_tseries = drop_zeros(lh_tseries, self.lh_labels, 
+                                            self.as_vertices)
+                
+            if self._rh:
+                rh_tseries = label_timeseries(hems.pop(0), 
+                                              self.rh_labels.values(), 
+                                              self.as_vertices)
+                if self.drop_zero_label:
+                    rh_tseries = drop_zeros(rh_tseries, self.rh_labels, 
+                                            self.as_vertices)
+
+            if self._lh and self._rh:
+                self.summaries[stat] = _combine_timeseries(lh_tseries, 
+                                                           rh_tseries)
+            elif self._lh:
+                self.summaries[stat] = lh_tseries
+            elif self._rh:
+                self.summaries[stat] = rh_tseries
+        self.timeseries = self.summaries[self.summary[0]]
@@ -0,0 +1,85 @@
+"""Persistent seek point indexes of gzipped NIFTI images"""
+import os
+import hashlib
+import tempfile
+import nibabel as nib
+
+
+def _import_indexed_gzip():
+    """indexed_gzip is only required for gzip seek point indexes"""
+    try:
+        import indexed_gzip
+    except ImportError as e:
+        raise ImportError('indexed_gzip is required for gzip seek point '
+                          'indexes') from e
+    return indexed_gzip
+
+
+def index_fname(fname, index_dir):
+    """Index file of a gzipped image
+
+    Indexes are named after the absolute path, size and modification time of
+    the image rather than its contents, so that finding an index does not
+    require reading the image. A modified image gets a new index.
+
+    Parameters
+    ----------
+    fname : str
+        Gzipped image file
+    index_dir : str
+        Directory of indexes
+
+    Returns
+    -------
+    str
+        Index file
+    """
+    stat = os.stat(fname)
+    key = f'{os.path.abspath(fname)}:{stat.st_size}:{stat.st_mtime_ns}'
+    digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+    return os.path.join(index_dir, digest + '.gzidx')
+
+
+def load_indexed(fname, index_dir):
+    """Load a .nii.gz image whose data are read through a gzip seek point
+    index, so that reading some of its volumes (e.g. after discarding scans)
+    only decompresses those volumes
+
+    The index is built by decompressing the image once, and is then stored in
+    index_dir for later loads of the same image. Indexes are written to a
+    temporary file and then renamed, which makes it safe for multiple
+    processes to share index_dir. The indexed_gzip file of the image
+    (`img.file_map['image'].fileobj`) is left open for its data proxy, and is
+    closed by the caller once the image is read.
+
+    Parameters
+    ----------
+    fname : str
+        Gzipped NIFTI image
+    index_dir : str
+        Directory in which indexes are stored
+
+    Returns
+    -------
+    nibabel.Nifti1Image
+        Image, with its data proxy reading from an indexed_gzip file
+    """
+    indexed_gzip = _import_indexed_gzip()
+    index_file = index_fname(fname, index_dir)
+    if os.path.exists(index_file):
+        fobj = indexed_gzip.IndexedGzipFile(fname, index_file=index_file)
+    else:
+        fobj = indexed_gzip.IndexedGzipFile(fname)
+        fobj.build_full_index()
+        os.makedirs(index_dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=index_dir, prefix='.tmp-')
+        os.close(fd)
+        try:
+            fobj.export_index(tmp)
+            os.replace(tmp, index_file)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    holder = nib.FileHolder(fname, fobj)
+    return nib.Nifti1Image.from_file_map({'header': holder, 'image': holder})
@@ -4,12 +4,20 @@ import warnings
 import numpy as np
 import pandas as pd
 import nibabel as nib
+from nibabel.arrayproxy import ArrayProxy
+from nibabel.volumeutils import apply_read_scaling
+from scipy import sparse
 from nilearn.input_data import (NiftiMasker, NiftiSpheresMasker, 
                                 NiftiLabelsMasker)
 from nilearn import image
 from nilearn.input_data.nifti_spheres_masker import _apply_mask_and_get_affinity
 
 from .base_extractor import BaseExtractor
+from .gzindex import load_indexed
+from .plan import ExtractionPlan
+from .reduction import LabelReducer
+from .summary import summarize
+from .utils import _clean_together
 
 
 def _read_coords(roi_file):
@@ -61,7 +69,13 @@ def _get_spheres_from_masker(masker, ref_img):
     return spheres_img
 
 
-def _set_volume_masker(roi_file, as_voxels=False, **kwargs):
+def _is_maps(roi_file):
+    """Check if a NIFTI roi file is a 4D image of weighted regions"""
+    return len(nib.load(roi_file).shape) == 4
+
+
+def _set_volume_masker(roi_file, as_voxels=False, cache_dir=None, plan=None,
+                       **kwargs):
     """Check and see if multiple ROIs exist in atlas file"""
 
     if not isinstance(roi_file, str):
@@ -78,17 +92,21 @@ def _set_volume_masker(roi_file, as_voxels=False, **kwargs):
                           'of extracting from a single voxel')
         masker = NiftiSpheresMasker(roi, **kwargs)
     
-    elif roi_file.endswith('.nii.gz'):
+    elif roi_file.endswith(('.nii.gz', '.nii')):
         # remove args for NiftiSpheresMasker 
         if 'radius' in kwargs:
             kwargs.pop('radius')
         if 'allow_overlap' in kwargs:
             kwargs.pop('allow_overlap')
     
-        roi_img = image.load_img(roi_file)
-        n_rois = len(np.unique(roi_img.get_fdata())) - 1
-        print('  {} region(s) detected from {}'.format(n_rois,
-                                                       roi_img.get_filename()))
+        if plan is None:
+            plan = NiftiExtractor.load_plan(roi_file, cache_dir)
+        roi_img = nib.Nifti1Image(plan.roi, plan.affine)
+        n_rois = len(plan.reducer.labels)
+        if 0 in plan.reducer.labels:
+            # background
+            n_rois -= 1
+        print('  {} region(s) detected from {}'.format(n_rois, roi_file))
         if n_rois > 1:
             masker = NiftiLabelsMasker(roi_img, **kwargs)
         elif n_rois == 1:
@@ -105,100 +123,458 @@ def _set_volume_masker(roi_file, as_voxels=False, **kwargs):
     
     else:
         raise ValueError('Invalid file type for roi_file. Must be one of: '
-                         '.nii.gz, .csv, .tsv')
+                         '.nii.gz, .nii, .csv, .tsv')
     
     return masker, n_rois
 
 
+# NiftiLabelsMasker parameters that are not applied by _summarize_labels, and
+# their nilearn defaults
+_LABELS_MASKER_DEFAULTS = {'resampling_target': 'data', 
+                           'high_variance_confounds': False, 
+                           'strategy': 'mean'}
+
+
+def _custom_masker_params(masker, maps=None):
+    """Names of the parameters of a NiftiLabelsMasker that are not at their
+    nilearn defaults and that _summarize_labels does not apply. The data are
+    always resampled to weighted region maps, so resampling_target does not 
+    apply to maps
+    """
+    params = [k for k, v in _LABELS_MASKER_DEFAULTS.items() 
+              if getattr(masker, k, v) != v]
+    if maps is not None and 'resampling_target' in params:
+        params.remove('resampling_target')
+    return params
+
+
+def _fast_labels(masker, img):
+    """Check if the regions of a NiftiLabelsMasker can be extracted from a
+    memory map of img by _summarize_labels, with the same result as the 
+    masker
+    """
+    memory = getattr(masker, 'memory', None)
+    return (isinstance(masker, NiftiLabelsMasker) and _is_uncompressed(img) 
+            and not _custom_masker_params(masker) 
+            and getattr(memory, 'location', memory) is None)
+
+
+def _is_uncompressed(img):
+    """Check if the data of an image are memory-mapped, or can be 
+    memory-mapped from an uncompressed file
+    """
+    dataobj = img.dataobj
+    if isinstance(dataobj, np.memmap):
+        return True
+    return (isinstance(dataobj, ArrayProxy) and 
+            isinstance(dataobj.file_like, str) and 
+            not dataobj.file_like.endswith('.gz'))
+
+
+def _read_voxels(img, columns, dtype):
+    """Read the timeseries of some voxels of an image whose data are 
+    memory-mapped (see _is_uncompressed)
+
+    Only the parts of the file that hold these voxels are read, rather than
+    the entire image. Scaling is applied to the voxels that are read.
+
+    Parameters
+    ----------
+    img : nibabel.Nifti1Image
+        4D functional image
+    columns : numpy.ndarray
+        Voxel indices, in column-major order
+    dtype : numpy.dtype
+        Floating point type of the timeseries
+
+    Returns
+    -------
+    numpy.ndarray, (n_timepoints, n_columns)
+        Voxel timeseries
+    """
+    dataobj = img.dataobj
+    if isinstance(dataobj, np.memmap):
+        raw, slope, inter = dataobj, 1., 0.
+    else:
+        raw = dataobj.get_unscaled()
+        slope, inter = dataobj.slope, dataobj.inter
+    # column-major, so the reshape is a view of the memory map
+    voxels = raw.reshape((-1, raw.shape[-1]), order='F')[columns]
+    voxels = apply_read_scaling(voxels, slope, inter)
+    return voxels.T.astype(dtype, copy=False)
+
+
+def _summarize_labels(masker, img, summary, confounds=None, maps=None):
+    """Extract summary statistics of each region of a NiftiLabelsMasker in a 
+    single pass over the data
+
+    Follows NiftiLabelsMasker.transform: labels (and the mask, if any) are 
+    resampled to the data, the data are smoothed, and the region timeseries
+    of all statistics are denoised together with nilearn.signal.clean using
+    the masker's parameters. If the data are memory-mapped from an 
+    uncompressed image (and are not smoothed or resampled), only the voxels
+    of the regions are read. The masker parameters that are not applied 
+    (see _custom_masker_params) must be at their defaults.
+    
+    If weighted region maps are provided, these are used instead of the 
+    masker's labels. Weights are not resampled; instead, the data are 
+    resampled to the grid of the maps if needed, and region means are 
+    weighted means of the voxels. The mask, if any, zeroes the weights of 
+    voxels outside of it.
+
+    Parameters
+    ----------
+    masker : nilearn.input_data.NiftiLabelsMasker
+        Labels masker
+    img : nibabel.Nifti1Image
+        4D functional image
+    summary : list of str
+        Summary statistics (see nixtract.extractors.summary)
+    confounds : numpy.ndarray, optional
+        Confound regressors, by default None
+    maps : nixtract.extractors.plan.ExtractionPlan, optional
+        Compiled plan of a 4D image of weighted regions, by default None
+
+    Returns
+    -------
+    dict of numpy.ndarray, (n_timepoints, n_regions)
+        Region timeseries of each statistic
+    """
+    masker.fit()
+    img = image.load_img(img)
+    if maps is None:
+        labels_img = image.resample_to_img(masker.labels_img_, img, 
+                                           interpolation='nearest')
+        labels = np.asarray(labels_img.get_fdata())
+        mask_ref = img
+    else:
+        mask_ref = nib.Nifti1Image(np.zeros(maps.roi.shape, dtype=np.int8), 
+                                   maps.affine)
+        if (img.shape[:3] != maps.roi.shape or 
+                not np.allclose(img.affine, maps.affine)):
+            img = image.resample_to_img(img, mask_ref)
+
+    mask = None
+    if masker.mask_img_ is not None:
+        mask_img = image.resample_to_img(masker.mask_img_, mask_ref, 
+                                         interpolation='nearest')
+        mask = np.asarray(mask_img.get_fdata()) != 0
+    if masker.smoothing_fwhm is not None:
+        img = image.smooth_img(img, masker.smoothing_fwhm)
+
+    if maps is None:
+        if mask is not None:
+            labels[~mask] = masker.background_label
+        reducer = LabelReducer.from_roi(labels.ravel(order='F'))
+        keep = reducer.labels != masker.background_label
+    else:
+        reducer = maps.reducer
+        if mask is not None:
+            matrix = sparse.csr_matrix(
+                reducer.matrix.multiply(mask.ravel(order='F')))
+            matrix.eliminate_zeros()
+            reducer = LabelReducer(matrix, reducer.labels)
+        # regions entirely outside of the mask
+        keep = reducer.weights > 0
+    reducer = LabelReducer(reducer.matrix[keep], reducer.labels[keep])
+    masker.labels_ = list(reducer.labels)
+
+    dtype = np.float64 if masker.dtype in [None, 'auto'] else masker.dtype
+    if _is_uncompressed(img):
+        # only read the voxels of the regions
+        columns = np.unique(reducer.matrix.indices)
+        darray = _read_voxels(img, columns, dtype)
+        reducer = reducer.subset(columns)
+    else:
+        data = img.get_fdata(dtype=dtype)
+        n_timepoints = data.shape[-1]
+        # voxels in column-major order, so the reshape does not copy nibabel 
+        # data
+        darray = data.reshape((-1, n_timepoints), order='F').T
+
+    timeseries = summarize(darray, reducer, summary)
+    return _clean_together(
+        [timeseries], confounds, detrend=masker.detrend, 
+        standardize=masker.standardize, 
+        standardize_confounds=masker.standardize_confounds, t_r=masker.t_r, 
+        low_pass=masker.low_pass, high_pass=masker.high_pass
+    )[0]
+
+
 class NiftiExtractor(BaseExtractor):
     def __init__(self, fname, roi_file, labels=None, as_voxels=False, 
-                 verbose=False, **kwargs):
+                 verbose=False, cache_dir=None, dtype=None, summary=None, 
+                 gzip_index_dir=None, **kwargs):
         """Extract timeseries from a NIFTI image
 
         Parameters
         ----------
         fname : str
             Functional data
-        roi_file : str
+        roi_file : str or list of str
             Nifti file containing numeric labels for each voxel to identify
             each region. Can be an atlas/parcellation with multiple regions,
-            or a binary mask for a single region. Or, a .tsv file containing
-            central coordinates for each region. 
-        labels : str, optional
+            or a binary mask for a single region. Or, a 4D image of weighted
+            (e.g., probabilistic) regions with one volume per region, in 
+            which case region timeseries are weighted means. Or, a .tsv file 
+            containing central coordinates for each region. If a list, the 
+            image is loaded once and extracted with every roi file, and the 
+            outputs of each roi file are kept separate (see 
+            `atlas_summaries`)
+        labels : list, optional
             Label names for each region in roi_file, given in the exact same
             ascending order. If None, a) numeric labels in roi_file will be 
             used if roi_file is a single or multi-region atlas, b) rows in 
             roi_file are enumerated (1-indexed) if roi_file is a .tsv file, or 
-            c) voxels are enumerated (1-indexed) if as_voxels is specified. By 
-            default None
+            c) voxels are enumerated (1-indexed) if as_voxels is specified. If
+            roi_file is a list, labels must be a list with the labels (or 
+            None) of each roi file. By default None
         as_voxels : bool, optional
             Extract the individual voxel timeseries from a region. Only 
             possible when roi_file is a binary mask (single region), by 
             default False
         verbose : bool, optional
             Print out extraction timestamp, by default False
+        cache_dir : str, optional
+            Directory in which the compiled roi_file is cached and reused 
+            across extractors. Not applicable to coordinate files. If None, 
+            roi_file is compiled without caching. By default None
+        dtype : numpy.dtype or str, optional
+            Floating point type used to load, extract and denoise the data, 
+            which is passed to the nilearn masker. 'float32' halves memory 
+            use, and results agree with float64 to within 
+            nixtract.extractors.utils.FLOAT32_RTOL. If None, the nilearn 
+            default is used. By default None
+        summary : str or list of str, optional
+            Summary statistic(s) of the voxels in each region, computed in a
+            single pass over the data. One or more of 'mean', 'median', 
+            'std', 'trimmed_mean' and 'eigenvariate' (see 
+            nixtract.extractors.summary). Only available when roi_file is an
+            atlas or a mask, and as_voxels is not used. If None, only the 
+            mean is extracted. By default None
+        gzip_index_dir : str, optional
+            Directory of gzip seek point indexes of .nii.gz images (requires 
+            indexed_gzip). If provided, the index of fname is built on first 
+            use and stored in this directory, and the volumes of fname are 
+            then read from it without decompressing the preceding volumes 
+            (see nixtract.extractors.gzindex.load_indexed). By default None
         **kwargs 
             Arguments to pass to a Nilearn masker object, which is determined
             by the roi_file
+
+        Raises
+        ------
+        ValueError
+            summary is used with coordinates or as_voxels, or the number of 
+            labels does not match the number of roi files
         """
         self.fname = fname
-        self.img = nib.load(fname)
-        self.roi_file = roi_file
+        self._gzip_file = None
+        if gzip_index_dir is not None and fname.endswith('.gz'):
+            self.img = load_indexed(fname, gzip_index_dir)
+            # closed once the image is extracted
+            self._gzip_file = self.img.file_map['image'].fileobj
+        else:
+            self.img = nib.load(fname)
+        self._n_discarded = 0
+        self._loaded = None
+        self._set_roi_files(roi_file)
         self.labels = labels
+        if self.atlas_names is None:
+            self._labels = [labels]
+        elif labels is None:
+            self._labels = [None] * len(self.roi_files)
+        elif len(labels) != len(self.roi_files):
+            raise ValueError('labels must have one entry per roi file')
+        else:
+            self._labels = list(labels)
         self.as_voxels = as_voxels
         self.verbose = verbose
+        self.dtype = dtype
+        if dtype is not None:
+            kwargs['dtype'] = dtype
+        self._set_summary(summary, as_voxels)
 
-        # determine masker
-        self.masker, self.n_rois = _set_volume_masker(roi_file, as_voxels, 
-                                                      **kwargs)
+        # determine the masker of each roi file
+        self.maskers, self._maps = [], []
+        for roi in self.roi_files:
+            plan, maps = None, None
+            if roi.endswith(('.nii.gz', '.nii')):
+                plan = self.load_plan(roi, cache_dir)
+            masker, n_rois = _set_volume_masker(roi, as_voxels, cache_dir, 
+                                                plan, **dict(kwargs))
+            if isinstance(masker, NiftiLabelsMasker) and _is_maps(roi):
+                # weighted regions, extracted from the plan rather than the 
+                # masker
+                maps = plan
+            if (self._summary is not None and 
+                    not isinstance(masker, NiftiLabelsMasker)):
+                raise ValueError('Summary statistics are only available when '
+                                 'roi_file is an atlas or a mask')
+            if self._summary is not None or maps is not None:
+                params = _custom_masker_params(masker, maps)
+                if params:
+                    raise ValueError(f"{', '.join(params)} cannot be used "
+                                     'with summary statistics or weighted '
+                                     'regions')
+            self.maskers.append(masker)
+            self._maps.append(maps)
+            if len(self.maskers) == 1:
+                self.masker, self.n_rois = masker, n_rois
         self.masker_type = self.masker.__class__.__name__
         self.regressor_names = None
         self.regressor_array = None
+
+    @staticmethod
+    def _compile_plan(roi_file):
+        """Compile a NIFTI atlas, mask or 4D image of weighted regions into an
+        ExtractionPlan. Coordinate files are not compiled
+        """
+        if roi_file.endswith('.csv') or roi_file.endswith('.tsv'):
+            return None
+        if _is_maps(roi_file):
+            img = nib.load(roi_file)
+            # read one map at a time from the proxy
+            maps = (np.asarray(img.dataobj[..., i]).ravel(order='F') 
+                    for i in range(img.shape[3]))
+            reducer = LabelReducer.from_weights(maps)
+            roi = reducer.to_roi().reshape(img.shape[:3], order='F')
+            return ExtractionPlan(roi, reducer=reducer, affine=img.affine,
+                                  roi_file=roi_file)
+        roi_img = image.load_img(roi_file)
+        return ExtractionPlan(roi_img.get_fdata(), affine=roi_img.affine, 
+                              roi_file=roi_file)
         
-    def _get_default_labels(self):
+    def _get_default_labels(self, masker=None, n_timeseries=None):
         """Generate default numerical (1-indexed) labels depending on the 
-        masker
+        masker, which is the masker of the first roi file if not provided
         """
-        self.check_extracted()
+        if masker is None:
+            self.check_extracted()
+            masker = self.masker
+            n_timeseries = self.timeseries.shape[1]
         
-        if isinstance(self.masker, NiftiMasker):
+        if isinstance(masker, NiftiMasker):
             return ['voxel{}'.format(int(i))
-                    for i in np.arange(self.timeseries.shape[1]) + 1]
-        elif isinstance(self.masker, NiftiLabelsMasker): 
+                    for i in np.arange(n_timeseries) + 1]
+        elif isinstance(masker, NiftiLabelsMasker): 
             # get actual numerical labels used in image          
-            return ['region{}'.format(int(i)) for i in self.masker.labels_]
-        elif isinstance(self.masker, NiftiSpheresMasker):
+            return ['region{}'.format(int(i)) for i in masker.labels_]
+        elif isinstance(masker, NiftiSpheresMasker):
             return ['region{}'.format(int(i)) 
-                    for i in np.arange(len(self.masker.seeds)) + 1]
+                    for i in np.arange(len(masker.seeds)) + 1]
 
     def discard_scans(self, n_scans):
         """Discard first N scans from data and regressors, if available 
 
+        Scans are discarded lazily: the image is not read until extraction,
+        when only the remaining scans are read from the image proxy (see
+        _load_img)
+
         Parameters
         ----------
         n_scans : int
             Number of initial scans to remove
         """
-        arr = self.img.get_data()
-        arr = arr[:, :, :, n_scans:]
-        self.img = nib.Nifti1Image(arr, self.img.affine)
+        self._n_discarded += n_scans
+        self._loaded = None
 
         if self.regressor_array is not None:
             self.regressor_array = self.regressor_array[n_scans:, :]
         
         return self
 
+    def _load_img(self):
+        """Get the image to extract, without any discarded scans
+
+        Discarded scans are sliced from the image proxy, so that only the
+        remaining scans are loaded, and the header is kept. Uncompressed, 
+        unscaled images stay memory-mapped. Otherwise, if there are multiple 
+        roi files, the image is loaded into memory once so that it is not 
+        re-read by the masker of each roi file.
+
+        Returns
+        -------
+        nibabel.Nifti1Image
+            Image to extract
+        """
+        img = self.img
+        n = self._n_discarded
+        if _is_uncompressed(img):
+            if n and isinstance(img.dataobj, ArrayProxy):
+                if img.dataobj.slope == 1 and img.dataobj.inter == 0:
+                    # a view of the memory map
+                    data = img.dataobj.get_unscaled()[..., n:]
+                else:
+                    data = img.dataobj[..., n:]
+                return nib.Nifti1Image(data, img.affine, img.header)
+            return img
+        if n:
+            return nib.Nifti1Image(img.dataobj[..., n:], img.affine, 
+                                   img.header)
+        if len(self.maskers) > 1 and not img.in_memory:
+            return nib.Nifti1Image(np.asanyarray(img.dataobj), img.affine, 
+                                   img.header)
+        return img
+
+    def load(self):
+        """Read the image to extract into memory ahead of extraction, so that
+        it is decompressed before extract is called (e.g., in a background 
+        thread). Uncompressed images stay memory-mapped
+
+        Returns
+        -------
+        NiftiExtractor
+            The extractor
+        """
+        img = self._load_img()
+        if not _is_uncompressed(img) and not img.in_memory:
+            img = nib.Nifti1Image(np.asanyarray(img.dataobj), img.affine, 
+                                  img.header)
+        self._loaded = img
+        return self
+
     def extract(self):
-        """Extract timeseries data using the determined nilearn masker"""
-        self.show_extract_msg(self.fname)
-        timeseries = self.masker.fit_transform(self.img, 
-                                               confounds=self.regressor_array)
-        self.timeseries = pd.DataFrame(timeseries)
+        """Extract timeseries data using the determined nilearn masker
         
-        if self.labels is None:
-            self.timeseries.columns = self._get_default_labels()
-        else:
-            self.timeseries.columns = self.labels
+        If there are multiple roi files, the image is loaded into memory once
+        and then extracted with the masker of each roi file. Regions of 
+        uncompressed (.nii) images are extracted from a memory map, so that 
+        only their voxels are read (see _summarize_labels), unless the masker
+        uses parameters that this does not apply (see _fast_labels), in which
+        case the masker extracts them. Images that were 
+        already read (see load) are not read again, and images read through a
+        gzip seek point index are closed once they are extracted.
+        """
+        self.show_extract_msg(self.fname)
+        img = self._loaded if self._loaded is not None else self._load_img()
+        # not kept once extracted, while outputs are saved
+        self._loaded = None
+
+        results = []
+        for masker, maps, labels in zip(self.maskers, self._maps, 
+                                        self._labels):
+            if (self._summary is None and maps is None and 
+                    not _fast_labels(masker, img)):
+                timeseries = {'mean': masker.fit_transform(
+                    img, confounds=self.regressor_array)}
+            else:
+                timeseries = _summarize_labels(masker, img, self.summary, 
+                                               self.regressor_array, maps)
+            summaries = {stat: pd.DataFrame(x) 
+                         for stat, x in timeseries.items()}
+            results.append(summaries)
+
+            if labels is None:
+                n_timeseries = summaries[self.summary[0]].shape[1]
+                labels = self._get_default_labels(masker, n_timeseries)
+            for x in summaries.values():
+                x.columns = labels
+
+        if self._gzip_file is not None:
+            self._gzip_file.close()
+            self._gzip_file = None
+        self._set_results(results)
         
         return self
 
@@ -0,0 +1,257 @@
+"""Writing and reading extracted timeseries in text and binary formats"""
+import os
+import io
+import csv
+import gzip
+import json
+import numpy as np
+import pandas as pd
+
+# file extension of each output format
+OUTPUT_FORMATS = {
+    'tsv': '.tsv',
+    'tsv.gz': '.tsv.gz',
+    'tsv.zst': '.tsv.zst',
+    'parquet': '.parquet',
+    'feather': '.feather',
+    'npy': '.npy',
+    'hdf5': '.h5'
+}
+
+# rows of a .tsv file that are formatted at once
+_TSV_BLOCK_ROWS = 4096
+
+# default compression level of compressed .tsv files, which are the defaults
+# of zlib and zstd
+_COMPRESSION_LEVELS = {'tsv.gz': 6, 'tsv.zst': 3}
+
+
+def check_output_format(output_format=None, fname=None):
+    """Validate an output format, or infer it from a file name
+
+    Parameters
+    ----------
+    output_format : str, optional
+        One of OUTPUT_FORMATS. If None, the format is inferred from the
+        extension of fname. By default None
+    fname : str, optional
+        Output file name, by default None
+
+    Returns
+    -------
+    str
+        Output format, which is 'tsv' if it cannot be inferred
+
+    Raises
+    ------
+    ValueError
+        Unknown output format
+    """
+    if output_format is None:
+        for fmt, ext in OUTPUT_FORMATS.items():
+            if fname is not None and fname.endswith(ext):
+                return fmt
+        return 'tsv'
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f'Invalid output format {output_format}. Must be '
+                         f'one of: {", ".join(OUTPUT_FORMATS)}')
+    return output_format
+
+
+def sidecar_fname(fname):
+    """JSON sidecar file that holds the labels of a .npy output"""
+    return os.path.splitext(fname)[0] + '.json'
+
+
+def _import_h5py():
+    """h5py is only required for hdf5 outputs"""
+    try:
+        import h5py
+    except ImportError as e:
+        raise ImportError('h5py is required for hdf5 outputs') from e
+    return h5py
+
+
+def _import_zstandard():
+    """zstandard is only required for .tsv.zst outputs"""
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError('zstandard is required for tsv.zst outputs '
+                          '(pip install nixtract[zstd])') from e
+    return zstandard
+
+
+def _open_tsv(fname, output_format='tsv', compression_level=None):
+    """Open a text file for writing, which is compressed as it is written
+    for 'tsv.gz' and 'tsv.zst'
+    """
+    if output_format == 'tsv':
+        return open(fname, 'w', newline='', encoding='utf-8')
+
+    if compression_level is None:
+        compression_level = _COMPRESSION_LEVELS[output_format]
+    if output_format == 'tsv.gz':
+        return gzip.open(fname, 'wt', compresslevel=compression_level,
+                         newline='', encoding='utf-8')
+    zstandard = _import_zstandard()
+    compressor = zstandard.ZstdCompressor(level=compression_level)
+    writer = compressor.stream_writer(open(fname, 'wb'), closefd=True)
+    return io.TextIOWrapper(writer, newline='', encoding='utf-8')
+
+
+def _write_tsv(timeseries, fname, n_decimals=None, output_format='tsv',
+               compression_level=None):
+    """Write a .tsv file with the same bytes as
+    `timeseries.to_csv(fname, sep='\\t', index=False, float_format=...)`
+
+    Fixed-precision values are formatted in bulk, a block of rows at a time,
+    with a single printf-style operation rather than formatting each cell
+    separately. Tables that this cannot reproduce exactly (no n_decimals,
+    missing values or non-float columns) are written by pandas, one block of
+    rows at a time. Either way, rows are streamed to the file (and 
+    compressed, if needed) in blocks, so the formatted text of the whole 
+    table is never held in memory.
+
+    Parameters
+    ----------
+    timeseries : pandas.DataFrame, (n_timepoints, n_timeseries)
+        Timeseries, with one labelled column per timeseries
+    fname : str
+        Output file name
+    n_decimals : int, optional
+        Number of decimals, by default None
+    output_format : str, optional
+        'tsv', or 'tsv.gz' or 'tsv.zst' to compress the file with gzip or 
+        zstd (requires zstandard), by default 'tsv'
+    compression_level : int, optional
+        Compression level of compressed files. By default None, which is 6 for
+        gzip and 3 for zstd
+    """
+    float_format = f'%.{n_decimals}f' if n_decimals else None
+    values = timeseries.values
+    with _open_tsv(fname, output_format, compression_level) as f:
+        if (float_format is None or values.size == 0
+                or values.dtype.kind != 'f' or np.isnan(values).any()):
+            # header with the first block, including for empty tables
+            for start in range(0, max(len(timeseries), 1), _TSV_BLOCK_ROWS):
+                block = timeseries.iloc[start:start + _TSV_BLOCK_ROWS]
+                block.to_csv(f, sep='\t', index=False, header=start == 0,
+                             float_format=float_format)
+            return
+
+        n_rows, n_cols = values.shape
+        row_format = '\t'.join([float_format] * n_cols) + os.linesep
+        # header is quoted as by pandas, which also uses the csv module
+        csv.writer(f, delimiter='\t', lineterminator=os.linesep).writerow(
+            [str(x) for x in timeseries.columns]
+        )
+        for start in range(0, n_rows, _TSV_BLOCK_ROWS):
+            block = values[start:start + _TSV_BLOCK_ROWS]
+            f.write((row_format * len(block)) % tuple(block.ravel().tolist()))
+
+
+def write_timeseries(timeseries, fname, output_format=None, n_decimals=None,
+                     compression_level=None, metadata=None):
+    """Write a table of timeseries, with the column labels kept as metadata
+
+    Parameters
+    ----------
+    timeseries : pandas.DataFrame, (n_timepoints, n_timeseries)
+        Timeseries, with one labelled column per timeseries
+    fname : str
+        Output file name
+    output_format : str, optional
+        One of OUTPUT_FORMATS: 'tsv' (text), 'tsv.gz' or 'tsv.zst' (text 
+        compressed with gzip, or with zstd, which requires zstandard), 
+        'parquet' or 'feather'
+        (require pyarrow), 'npy' (with labels in a JSON sidecar, see
+        sidecar_fname), or 'hdf5' (requires h5py; labels are an attribute
+        of the 'timeseries' dataset). If None, the format is inferred from
+        fname. By default None
+    n_decimals : int, optional
+        Number of decimals of text outputs. Binary outputs are rounded to
+        the same number of decimals. By default None
+    compression_level : int, optional
+        Compression level of 'tsv.gz' and 'tsv.zst' outputs (see _write_tsv),
+        by default None
+    metadata : dict, optional
+        Additional JSON-serializable metadata, such as the source file and
+        regressor names, which is added to the sidecar of 'npy' outputs. By 
+        default None
+    """
+    output_format = check_output_format(output_format, fname)
+    if output_format.startswith('tsv'):
+        _write_tsv(timeseries, fname, n_decimals, output_format, 
+                   compression_level)
+        return
+
+    labels = [str(x) for x in timeseries.columns]
+    values = timeseries.values
+    if n_decimals:
+        values = np.round(values, n_decimals)
+
+    if output_format in ['parquet', 'feather']:
+        # string column names are required by both formats
+        table = pd.DataFrame(values, columns=labels)
+        if output_format == 'parquet':
+            table.to_parquet(fname, index=False)
+        else:
+            table.to_feather(fname)
+    elif output_format == 'npy':
+        # column-major, so that each timeseries is contiguous on disk and can
+        # be read on its own from a memory-mapped file
+        np.save(fname, np.asfortranarray(values))
+        sidecar = {'labels': labels}
+        if metadata is not None:
+            sidecar.update(metadata)
+        with open(sidecar_fname(fname), 'w') as f:
+            json.dump(sidecar, f, indent=2)
+    elif output_format == 'hdf5':
+        h5py = _import_h5py()
+        with h5py.File(fname, 'w') as f:
+            dset = f.create_dataset('timeseries', data=values)
+            dset.attrs['labels'] = np.array(labels,
+                                            dtype=h5py.string_dtype())
+
+
+def read_timeseries(fname, output_format=None, mmap_mode=None):
+    """Read a table of timeseries written by write_timeseries
+
+    Parameters
+    ----------
+    fname : str
+        Timeseries file
+    output_format : str, optional
+        Format of fname (see write_timeseries). If None, the format is
+        inferred from fname. By default None
+    mmap_mode : str, optional
+        Memory-map 'npy' outputs with this mode (e.g. 'r', see numpy.load) 
+        rather than reading them, so that only the timeseries that are used
+        are read from disk. By default None
+
+    Returns
+    -------
+    pandas.DataFrame, (n_timepoints, n_timeseries)
+        Timeseries, with one labelled column per timeseries
+    """
+    output_format = check_output_format(output_format, fname)
+    if output_format.startswith('tsv'):
+        # compression is inferred from the extension
+        return pd.read_table(fname)
+    elif output_format == 'parquet':
+        return pd.read_parquet(fname)
+    elif output_format == 'feather':
+        return pd.read_feather(fname)
+    elif output_format == 'npy':
+        with open(sidecar_fname(fname), 'r') as f:
+            labels = json.load(f)['labels']
+        return pd.DataFrame(np.load(fname, mmap_mode=mmap_mode), 
+                            columns=labels, copy=False)
+    else:
+        h5py = _import_h5py()
+        with h5py.File(fname, 'r') as f:
+            dset = f['timeseries']
+            labels = [x.decode() if isinstance(x, bytes) else x
+                      for x in dset.attrs['labels']]
+            return pd.DataFrame(dset[()], columns=labels)
@@ -0,0 +1,285 @@
+"""Compiled and cacheable representations of ROI files"""
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+from scipy import sparse
+
+from .reduction import LabelReducer
+
+# bump when the on-disk format changes so that stale plans are rebuilt
+_PLAN_VERSION = 2
+
+
+def file_hash(fname, block_size=2 ** 20):
+    """Compute the SHA-256 digest of a file's contents
+
+    Parameters
+    ----------
+    fname : str
+        File name
+    block_size : int, optional
+        Number of bytes read at a time, by default 1 MB
+
+    Returns
+    -------
+    str
+        Hexadecimal digest
+    """
+    digest = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _json_value(value):
+    """Convert a label (or label key) to the JSON type of the same value, so 
+    that it is loaded back from plan.json unchanged, e.g. numpy integers to
+    int rather than to a string
+    """
+    if isinstance(value, np.generic):
+        value = value.item()
+    if value is not None and not isinstance(value, (str, int, float)):
+        raise ValueError(f'Label {value!r} cannot be saved in a plan')
+    return value
+
+
+class ExtractionPlan(object):
+    def __init__(self, roi, labels=None, reducer=None, layout=None,
+                 affine=None, roi_file=None):
+        """Everything derived from an ROI file that is needed for extraction
+
+        Plans are built once per ROI file and can be saved to and loaded from
+        a cache directory, which avoids re-reading and re-labelling the same
+        atlas for every input file.
+
+        Parameters
+        ----------
+        roi : numpy.ndarray
+            Label of each vertex/voxel
+        labels : list or dict, optional
+            Region names. A dict maps numeric labels to names. By default None
+        reducer : LabelReducer, optional
+            Sparse reduction of the roi; computed from roi if not provided
+        layout : dict, optional
+            Brain models of a CIFTI roi file (see
+            nixtract.extractors.cifti_extractor._get_models), by default None
+        affine : numpy.ndarray, optional
+            Affine of a NIFTI roi file, by default None
+        roi_file : str, optional
+            Source roi file, by default None
+        """
+        self.roi = roi
+        self.labels = labels
+        if reducer is None:
+            reducer = LabelReducer.from_roi(roi)
+        self.reducer = reducer
+        self.layout = layout
+        self.affine = affine
+        self.roi_file = roi_file
+
+    def save(self, path):
+        """Save plan into a directory of .npy arrays and a plan.json file
+
+        Parameters
+        ----------
+        path : str
+            Output directory. Created if it does not already exist
+        """
+        os.makedirs(path, exist_ok=True)
+        arrays = {
+            'roi': self.roi,
+            'reducer_data': self.reducer.matrix.data,
+            'reducer_indices': self.reducer.matrix.indices,
+            'reducer_indptr': self.reducer.matrix.indptr,
+            'reducer_labels': self.reducer.labels
+        }
+        if self.affine is not None:
+            arrays['affine'] = self.affine
+
+        meta = {'version': _PLAN_VERSION, 'roi_file': self.roi_file,
+                'reducer_shape': list(self.reducer.matrix.shape),
+                'labels': None, 'label_keys': None, 'layout': None}
+        if isinstance(self.labels, dict):
+            meta['label_keys'] = [_json_value(k) for k in self.labels.keys()]
+            meta['labels'] = [_json_value(v) for v in self.labels.values()]
+        elif self.labels is not None:
+            meta['labels'] = [_json_value(v) for v in self.labels]
+
+        if self.layout is not None:
+            meta['layout'] = {}
+            for struct, model in self.layout.items():
+                meta['layout'][struct] = {
+                    k: (v if isinstance(v, str) else int(v))
+                    for k, v in model.items() if k != 'indices'
+                }
+                arrays[f"layout_{model['model_index']}"] = model['indices']
+
+        for name, arr in arrays.items():
+            np.save(os.path.join(path, f'{name}.npy'), np.asarray(arr))
+        with open(os.path.join(path, 'plan.json'), 'w') as f:
+            json.dump(meta, f, indent=2)
+
+    @classmethod
+    def load(cls, path, mmap_mode=None):
+        """Load a plan saved by ExtractionPlan.save
+
+        Parameters
+        ----------
+        path : str
+            Plan directory
+        mmap_mode : str, optional
+            Memory-map mode passed to numpy.load, by default None
+
+        Returns
+        -------
+        ExtractionPlan
+            Loaded plan
+
+        Raises
+        ------
+        ValueError
+            Plan was saved with an incompatible version
+        """
+        with open(os.path.join(path, 'plan.json'), 'r') as f:
+            meta = json.load(f)
+        if meta.get('version') != _PLAN_VERSION:
+            raise ValueError(f'Incompatible extraction plan in {path}')
+
+        def _load(name):
+            return np.load(os.path.join(path, f'{name}.npy'),
+                           mmap_mode=mmap_mode)
+
+        matrix = sparse.csr_matrix(
+            (_load('reducer_data'), _load('reducer_indices'),
+             _load('reducer_indptr')),
+            shape=tuple(meta['reducer_shape'])
+        )
+        reducer = LabelReducer(matrix, _load('reducer_labels'))
+
+        labels = meta['labels']
+        if meta['label_keys'] is not None:
+            labels = dict(zip(meta['label_keys'], labels))
+
+        layout = meta['layout']
+        if layout is not None:
+            for model in layout.values():
+                model['indices'] = _load(f"layout_{model['model_index']}")
+
+        affine = None
+        if os.path.exists(os.path.join(path, 'affine.npy')):
+            affine = _load('affine')
+
+        return cls(_load('roi'), labels, reducer, layout, affine,
+                   meta['roi_file'])
+
+
+# plans loaded by this process, keyed by roi file (see load_plan)
+_LOADED_PLANS = {}
+
+
+def _loaded_key(roi_file, cache_dir):
+    """Identify an roi file by its path, size and modification time, so that
+    a plan loaded by this process is found without hashing the roi file
+    """
+    stat = os.stat(roi_file)
+    return (os.path.abspath(roi_file), stat.st_size, stat.st_mtime_ns,
+            os.path.abspath(cache_dir))
+
+
+def _discard_plan(path, cache_dir):
+    """Remove a cached plan, which is first renamed out of the cache so that
+    no process loads it while it is partially removed. A directory cannot
+    replace a non-empty directory, even with os.replace
+    """
+    tmp = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp-')
+    try:
+        os.rename(path, os.path.join(tmp, 'plan'))
+    except OSError:
+        # already discarded by another process
+        pass
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def load_plan(roi_file, compile_func, cache_dir=None, mmap_mode='r'):
+    """Load the extraction plan of an roi file, compiling it if needed
+
+    Plans are stored in `cache_dir` under the SHA-256 digest of the roi file
+    contents, so a plan is only ever compiled once per unique roi file. Plans
+    are written to a temporary directory and then renamed, and outdated plans
+    are renamed out of the cache before they are removed, which makes it safe
+    for multiple processes to share a cache directory.
+
+    Cached plans are memory-mapped from the cache directory, so processes 
+    that extract with the same roi file share a single copy of its arrays in
+    memory, and are kept by each process, so that each process only loads a 
+    plan once rather than once per input file. Processes forked after a plan 
+    is loaded (e.g., pool processes started after the CLI compiles the roi 
+    file) start with the plan already loaded.
+
+    Parameters
+    ----------
+    roi_file : str
+        ROI file
+    compile_func : callable
+        Function that takes roi_file and returns an ExtractionPlan, or None if
+        roi_file cannot be compiled
+    cache_dir : str, optional
+        Cache directory. If None, the plan is compiled without caching. By
+        default None
+    mmap_mode : str, optional
+        Memory-map mode of cached plans (see ExtractionPlan.load). Plans are
+        read-only by default. If None, cached plans are read into memory. By 
+        default 'r'
+
+    Returns
+    -------
+    ExtractionPlan or None
+        Plan for roi_file
+    """
+    if cache_dir is None:
+        return compile_func(roi_file)
+
+    key = _loaded_key(roi_file, cache_dir) + (mmap_mode,)
+    if key in _LOADED_PLANS:
+        path, plan = _LOADED_PLANS[key]
+        if os.path.exists(os.path.join(path, 'plan.json')):
+            return plan
+
+    path = os.path.join(cache_dir, file_hash(roi_file))
+    outdated = False
+    if os.path.exists(os.path.join(path, 'plan.json')):
+        try:
+            plan = ExtractionPlan.load(path, mmap_mode)
+            _LOADED_PLANS[key] = path, plan
+            return plan
+        except ValueError:
+            # replaced below, once the new plan is saved
+            outdated = True
+
+    plan = compile_func(roi_file)
+    if plan is None:
+        return plan
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp-')
+    try:
+        plan.save(tmp)
+        if outdated:
+            _discard_plan(path, cache_dir)
+        os.rename(tmp, path)
+    except OSError:
+        # another process has already stored this plan
+        pass
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    # use the stored plan, as would later loads
+    if os.path.exists(os.path.join(path, 'plan.json')):
+        plan = ExtractionPlan.load(path, mmap_mode)
+        _LOADED_PLANS[key] = path, plan
+    return plan
@@ -0,0 +1,262 @@
+"""Sparse reduction of vertex/voxel data into region timeseries"""
+import numpy as np
+from scipy import sparse
+
+# upper bound (in bytes) on the temporary copy made per block of timepoints or
+# vertices
+_BLOCK_BYTES = 2 ** 26
+
+
+def _indicator_matrix(index, n_labels):
+    """Make a sparse (n_labels, n_vertices) matrix with a single 1 in each
+    column, placed in the row given by index
+    """
+    n_vertices = len(index)
+    # exactly one non-zero per column, so CSC arrays can be built directly
+    # without any sorting
+    matrix = sparse.csc_matrix(
+        (np.ones(n_vertices), index, np.arange(n_vertices + 1)),
+        shape=(n_labels, n_vertices)
+    )
+    return matrix.tocsr()
+
+
+def _time_blocks(n_timepoints, n_vertices, itemsize=8):
+    """Generate slices over timepoints such that each block of a
+    (n_timepoints, n_vertices) array stays within _BLOCK_BYTES
+    """
+    step = max(1, _BLOCK_BYTES // max(1, n_vertices * itemsize))
+    for start in range(0, n_timepoints, step):
+        yield slice(start, min(start + step, n_timepoints))
+
+
+def _vertex_blocks(n_timepoints, n_vertices, itemsize=8):
+    """Generate slices over vertices such that each block of a
+    (n_timepoints, n_vertices) array stays within _BLOCK_BYTES
+    """
+    step = max(1, _BLOCK_BYTES // max(1, n_timepoints * itemsize))
+    for start in range(0, n_vertices, step):
+        yield slice(start, min(start + step, n_vertices))
+
+
+class LabelReducer(object):
+    def __init__(self, matrix, labels):
+        """Reduce vertices to region means with a single sparse product
+
+        Each row of `matrix` defines a region and each column a vertex. Region
+        timeseries are the weighted sum of vertices normalized by the total
+        weight of each row, i.e. the mean timeseries for binary rows.
+
+        Parameters
+        ----------
+        matrix : scipy.sparse matrix, (n_regions, n_vertices)
+            Region weights of each vertex
+        labels : array-like, (n_regions,)
+            Label value of each region, in row order
+        """
+        self.matrix = sparse.csr_matrix(matrix)
+        self.labels = np.asarray(labels)
+        self.weights = np.asarray(self.matrix.sum(axis=1)).ravel()
+
+    @classmethod
+    def from_roi(cls, roi):
+        """Make a reducer from a label array
+
+        Parameters
+        ----------
+        roi : numpy.ndarray, (n_vertices,)
+            Vertices with integer labels denoting the regions
+
+        Returns
+        -------
+        LabelReducer
+            Reducer with one region per unique label, in ascending order
+        """
+        labels, index = np.unique(np.asarray(roi).ravel(), return_inverse=True)
+        return cls(_indicator_matrix(index, len(labels)), labels)
+
+    @classmethod
+    def from_weights(cls, maps, labels=None):
+        """Make a reducer from weighted (e.g., probabilistic) region maps
+
+        Maps are read one at a time and only their non-zero weights are 
+        stored, so a dense (n_regions, n_vertices) matrix is never created.
+        Region timeseries are weighted means of the vertices.
+
+        Parameters
+        ----------
+        maps : iterable of numpy.ndarray, (n_vertices,)
+            Non-negative weight of each vertex, per region
+        labels : array-like, optional
+            Label of each region. If None, regions are numbered from 1. By 
+            default None
+
+        Returns
+        -------
+        LabelReducer
+            Reducer with one region per map
+
+        Raises
+        ------
+        ValueError
+            Maps have different lengths, negative weights, or no non-zero 
+            weights
+        """
+        data, indices, indptr = [], [], [0]
+        n_vertices = None
+        for i, weights in enumerate(maps):
+            weights = np.nan_to_num(np.asarray(weights, dtype=np.float64))
+            if n_vertices is None:
+                n_vertices = len(weights)
+            elif len(weights) != n_vertices:
+                raise ValueError('All weight maps must have the same number '
+                                 'of vertices')
+            if np.any(weights < 0):
+                raise ValueError(f'Weight map {i + 1} has negative weights')
+            nonzero = np.flatnonzero(weights)
+            if len(nonzero) == 0:
+                raise ValueError(f'Weight map {i + 1} has no non-zero '
+                                 'weights')
+            data.append(weights[nonzero])
+            indices.append(nonzero)
+            indptr.append(indptr[-1] + len(nonzero))
+        if n_vertices is None:
+            raise ValueError('No weight maps provided')
+
+        n_regions = len(data)
+        matrix = sparse.csr_matrix(
+            (np.concatenate(data), np.concatenate(indices), indptr),
+            shape=(n_regions, n_vertices)
+        )
+        if labels is None:
+            labels = np.arange(1, n_regions + 1)
+        return cls(matrix, labels)
+
+    @property
+    def n_vertices(self):
+        return self.matrix.shape[1]
+
+    def subset(self, columns):
+        """Make a reducer restricted to a subset of vertices
+
+        Regions without any remaining vertices are dropped, which is
+        equivalent to making a new reducer from the label array indexed by 
+        columns.
+
+        Parameters
+        ----------
+        columns : numpy.ndarray
+            Vertex indices, in the desired order
+
+        Returns
+        -------
+        LabelReducer
+            Reducer over the vertices in columns
+        """
+        matrix = self.matrix[:, columns]
+        keep = np.diff(matrix.indptr) > 0
+        return LabelReducer(matrix[keep], self.labels[keep])
+
+    def expand(self, columns, n_vertices):
+        """Make a reducer over a larger set of vertices, in which the current
+        vertices are placed at columns. This is the inverse of subset, and
+        allows data to be reduced without first copying out the columns
+
+        Parameters
+        ----------
+        columns : numpy.ndarray, (n_vertices,)
+            Index of each current vertex in the larger set of vertices
+        n_vertices : int
+            Size of the larger set of vertices
+
+        Returns
+        -------
+        LabelReducer
+            Reducer over n_vertices, with the same regions
+        """
+        matrix = self.matrix.tocoo()
+        matrix = sparse.csr_matrix(
+            (matrix.data, (matrix.row, np.asarray(columns)[matrix.col])),
+            shape=(self.matrix.shape[0], n_vertices)
+        )
+        return LabelReducer(matrix, self.labels)
+
+    def to_roi(self):
+        """Make a label array from the regions, in which each vertex is 
+        assigned the label of the region with the largest weight
+
+        Returns
+        -------
+        numpy.ndarray, (n_vertices,)
+            Label of each vertex, or 0 for vertices without any weight
+        """
+        matrix = self.matrix.tocsc()
+        roi = np.zeros(self.n_vertices, dtype=self.labels.dtype)
+        assigned = np.diff(matrix.indptr) > 0
+        rows = np.asarray(matrix.argmax(axis=0)).ravel()
+        roi[assigned] = self.labels[rows[assigned]]
+        return roi
+
+    def vertices(self):
+        """Return the indices of vertices that belong to a non-zero label"""
+        rows = self.matrix[self.labels != 0]
+        return np.unique(rows.indices)
+
+    def reduce(self, darray, transform=None):
+        """Compute the mean timeseries of every region
+
+        The dense data is never copied as a whole; only bounded blocks of 
+        timepoints (or vertices, if transform is given) are held in temporary
+        memory.
+
+        Parameters
+        ----------
+        darray : numpy.ndarray, (n_timepoints, n_vertices)
+            Functional vertices
+        transform : callable, optional
+            Function applied to each block of vertices before reduction, such
+            as denoising. It must take and return a (n_timepoints, n_block)
+            array and treat each vertex independently. By default None
+
+        Returns
+        -------
+        numpy.ndarray, (n_timepoints, n_regions)
+            Region timeseries, in the same order as labels. Floating point
+            data keeps its precision; other data are returned as float32 or 
+            float64 depending on their size
+        """
+        if darray.shape[1] != self.n_vertices:
+            raise ValueError(f'Data has {darray.shape[1]} vertices but roi '
+                             f'has {self.n_vertices} vertices')
+        n_timepoints = darray.shape[0]
+        dtype = np.result_type(darray.dtype, np.float32)
+        if transform is not None:
+            return self._reduce_transformed(darray, transform, dtype)
+
+        timeseries = np.zeros((n_timepoints, len(self.labels)), dtype=dtype)
+        # scipy requires the dense operand in row-major order, so only a
+        # bounded block of timepoints is transposed at a time
+        for block in _time_blocks(n_timepoints, self.n_vertices,
+                                  darray.itemsize):
+            timeseries[block] = (self.matrix @ darray[block].T).T
+        timeseries /= self.weights
+        return timeseries
+
+    def _reduce_transformed(self, darray, transform, dtype):
+        """Transform and reduce darray in blocks of vertices"""
+        n_timepoints = darray.shape[0]
+        # column slicing is cheap in CSC format
+        matrix = self.matrix.tocsc()
+        # vertices outside of every region are not transformed
+        columns = np.flatnonzero(np.diff(matrix.indptr))
+        if len(columns) == self.n_vertices:
+            columns = None
+        n_columns = self.n_vertices if columns is None else len(columns)
+        sums = np.zeros((n_timepoints, len(self.labels)))
+        for block in _vertex_blocks(n_timepoints, n_columns, darray.itemsize):
+            if columns is not None:
+                block = columns[block]
+            x = transform(darray[:, block])
+            sums += (matrix[:, block] @ x.T).T
+        sums /= self.weights
+        return sums.astype(dtype, copy=False)
@@ -0,0 +1,246 @@
+"""Consolidated HDF5 store of the timeseries of many input files"""
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+from .output import OUTPUT_FORMATS, _import_h5py
+
+# columns of the index, each stored as a resizable string dataset
+_INDEX_COLUMNS = ['key', 'source', 'labels']
+
+
+def store_key(fname):
+    """Key of an output in a store, which is its file name without the 
+    directory and extension
+    """
+    key = os.path.basename(fname)
+    for ext in OUTPUT_FORMATS.values():
+        if key.endswith(ext):
+            return key[:-len(ext)]
+    return os.path.splitext(key)[0]
+
+
+def _decode(value):
+    """Decode a string read from an HDF5 string dataset"""
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def _labels_id(labels):
+    """Identify a list of labels by the digest of its contents"""
+    digest = hashlib.sha1(json.dumps(labels).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+class TimeseriesStore(object):
+    def __init__(self, fname, mode='a', compression=None):
+        """A single HDF5 file that holds the timeseries of many input files
+
+        The file is laid out as:
+            /timeseries/<key> : (n_timepoints, n_timeseries) dataset of each
+                                output
+            /labels/<id>      : label table, shared by all outputs with the
+                                same labels
+            /index/<column>   : one row per output, with its key, source
+                                file and label table id
+            metadata          : JSON string attribute, such as the
+                                extraction parameters
+
+        Uncompressed timeseries are stored contiguously, so that they can be
+        memory-mapped directly from the file (see read). Compressed
+        timeseries are chunked.
+
+        HDF5 files cannot be safely written by multiple processes, so only a
+        single process should append to a store. Other processes write to 
+        their own stores, which are merged into it (see merge and 
+        nixtract.cli.base.run_extraction).
+
+        Parameters
+        ----------
+        fname : str
+            HDF5 file
+        mode : str, optional
+            'r' to read, 'a' to create or append, or 'w' to overwrite, by
+            default 'a'
+        compression : str, optional
+            HDF5 compression filter of new timeseries (e.g., 'gzip'), by
+            default None
+        """
+        h5py = _import_h5py()
+        self.fname = fname
+        self.compression = compression
+        self._file = h5py.File(fname, mode)
+        self._str = h5py.string_dtype()
+        if mode != 'r':
+            for group in ['timeseries', 'labels', 'index']:
+                self._file.require_group(group)
+            for column in _INDEX_COLUMNS:
+                if column not in self._file['index']:
+                    self._file['index'].create_dataset(
+                        column, shape=(0,), maxshape=(None,),
+                        dtype=self._str
+                    )
+        # row of each output in the index, read once and kept up to date by 
+        # append, so that outputs are found without re-reading the index
+        self._rows = {}
+        if 'index' in self._file:
+            keys = self._file['index/key'][()]
+            self._rows = {_decode(x): i for i, x in enumerate(keys)}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def close(self):
+        """Close the HDF5 file"""
+        self._file.close()
+
+    def keys(self):
+        """Return the key of every output, in the order they were added"""
+        return list(self._rows)
+
+    def _index_value(self, column, key):
+        """Read a single entry of the index"""
+        return _decode(self._file['index'][column][self._rows[key]])
+
+    @property
+    def metadata(self):
+        """Metadata of the store, as a dict"""
+        return json.loads(self._file.attrs.get('metadata', '{}'))
+
+    def set_metadata(self, metadata):
+        """Set the metadata of the store
+
+        Parameters
+        ----------
+        metadata : dict
+            JSON-serializable metadata
+        """
+        self._file.attrs['metadata'] = json.dumps(metadata)
+
+    def append(self, key, timeseries, source=None):
+        """Add the timeseries of an output, replacing any existing timeseries
+        with the same key
+
+        Parameters
+        ----------
+        key : str
+            Output key, typically the output file name without extension
+        timeseries : pandas.DataFrame, (n_timepoints, n_timeseries)
+            Timeseries, with one labelled column per timeseries
+        source : str, optional
+            Input file of the timeseries, by default None
+        """
+        labels = [str(x) for x in timeseries.columns]
+        labels_id = _labels_id(labels)
+        if labels_id not in self._file['labels']:
+            self._file['labels'].create_dataset(labels_id, data=labels,
+                                                dtype=self._str)
+
+        group = self._file['timeseries']
+        if key in group:
+            del group[key]
+        values = np.asarray(timeseries.values)
+        if self.compression is None:
+            group.create_dataset(key, data=values)
+        else:
+            group.create_dataset(key, data=values, chunks=True,
+                                 compression=self.compression)
+
+        row = dict(key=key, source='' if source is None else source,
+                   labels=labels_id)
+        i = self._rows.get(key, len(self._rows))
+        for column in _INDEX_COLUMNS:
+            dset = self._file['index'][column]
+            if i == len(self._rows):
+                dset.resize((i + 1,))
+            dset[i] = row[column]
+        self._rows[key] = i
+
+    def merge(self, fname):
+        """Add every output of another store file, replacing any existing
+        timeseries with the same keys
+
+        Parameters
+        ----------
+        fname : str
+            HDF5 file of the other store
+        """
+        with TimeseriesStore(fname, mode='r') as other:
+            for key in other.keys():
+                source = other._index_value('source', key)
+                self.append(key, other.read(key), source or None)
+
+    def labels(self, key):
+        """Return the labels of an output
+
+        Parameters
+        ----------
+        key : str
+            Output key
+
+        Returns
+        -------
+        list of str
+            Labels of each timeseries
+        """
+        labels_id = self._index_value('labels', key)
+        return [_decode(x) for x in self._file['labels'][labels_id][()]]
+
+    def read(self, key, mmap=False):
+        """Read the timeseries of an output
+
+        Parameters
+        ----------
+        key : str
+            Output key
+        mmap : bool, optional
+            Memory-map the timeseries from the file instead of reading them.
+            Only possible for uncompressed timeseries. By default False
+
+        Returns
+        -------
+        pandas.DataFrame, (n_timepoints, n_timeseries)
+            Timeseries, with one labelled column per timeseries
+
+        Raises
+        ------
+        ValueError
+            mmap is used with compressed timeseries
+        """
+        dset = self._file['timeseries'][key]
+        if mmap:
+            offset = dset.id.get_offset()
+            if offset is None or dset.chunks is not None:
+                raise ValueError(f'{key} is compressed and cannot be '
+                                 'memory-mapped')
+            values = np.memmap(self.fname, dtype=dset.dtype, mode='r',
+                               offset=offset, shape=dset.shape)
+        else:
+            values = dset[()]
+        return pd.DataFrame(values, columns=self.labels(key), copy=False)
+
+    def index(self):
+        """Return the index of the store
+
+        Returns
+        -------
+        pandas.DataFrame
+            One row per output, with its key, source file, label table id,
+            and number of timepoints and timeseries
+        """
+        index = {}
+        for column in _INDEX_COLUMNS:
+            index[column] = [_decode(x) 
+                             for x in self._file['index'][column][()]]
+        index = pd.DataFrame(index)
+        shapes = [self._file['timeseries'][k].shape for k in index['key']]
+        index['n_timepoints'] = [x[0] for x in shapes]
+        index['n_timeseries'] = [x[1] for x in shapes]
+        return index
@@ -0,0 +1,151 @@
+"""Summary statistics of the vertices/voxels in each region"""
+import numpy as np
+from scipy import stats as sp_stats
+
+SUMMARY_STATS = ['mean', 'median', 'std', 'trimmed_mean', 'eigenvariate']
+
+# proportion of vertices cut from each end for trimmed_mean
+TRIM_PROPORTION = 0.1
+
+
+def check_summary(summary):
+    """Validate requested summary statistics
+
+    Parameters
+    ----------
+    summary : str or list of str or None
+        One or more of SUMMARY_STATS. If None, only the mean is computed
+
+    Returns
+    -------
+    list of str
+        Summary statistics, in the requested order
+
+    Raises
+    ------
+    ValueError
+        Unknown or repeated summary statistics
+    """
+    if summary is None:
+        return ['mean']
+    if isinstance(summary, str):
+        summary = [summary]
+    summary = list(summary)
+    unknown = [s for s in summary if s not in SUMMARY_STATS]
+    if unknown:
+        raise ValueError(f'Invalid summary statistic(s) {unknown}. Must be '
+                         f'one or more of: {", ".join(SUMMARY_STATS)}')
+    if not summary or len(set(summary)) != len(summary):
+        raise ValueError('summary must contain one or more unique summary '
+                         'statistics')
+    return summary
+
+
+def _insert_entity(fname, key, value):
+    """Insert a `key-value` entity before _timeseries, or else before the 
+    file extension
+    """
+    head, sep, tail = fname.rpartition('_timeseries')
+    if not sep:
+        head, sep, tail = fname.rpartition('.')
+    if not sep:
+        return f'{fname}_{key}-{value}'
+    return f'{head}_{key}-{value}{sep}{tail}'
+
+
+def summary_fname(fname, stat):
+    """Insert a `stat-<stat>` entity into an output file name
+
+    Parameters
+    ----------
+    fname : str
+        Output file name, typically ending with _timeseries.tsv
+    stat : str
+        Summary statistic
+
+    Returns
+    -------
+    str
+        File name of the summary statistic, e.g. sub-01_stat-median_
+        timeseries.tsv for sub-01_timeseries.tsv
+    """
+    return _insert_entity(fname, 'stat', stat)
+
+
+def _eigenvariate(x):
+    """First principal eigenvariate of x, (n_timepoints, n_vertices)
+
+    Computed as in SPM (spm_regions.m): the first left singular vector of
+    the temporally centered data, scaled by its singular value over the square
+    root of the number of vertices, with the sign chosen such that the
+    vertex loadings sum to a positive value.
+    """
+    x = x - x.mean(axis=0)
+    u, s, vt = np.linalg.svd(x, full_matrices=False)
+    sign = np.sign(vt[0].sum()) or 1.
+    return sign * u[:, 0] * s[0] / np.sqrt(x.shape[1])
+
+
+def _region_stats(x, weights, summary):
+    """Compute summary statistics of a single region, (n_timepoints,
+    n_vertices), with the weight of each vertex used for the mean
+    """
+    funcs = {
+        'mean': lambda: x @ weights / weights.sum(),
+        'median': lambda: np.median(x, axis=1),
+        'std': lambda: x.std(axis=1),
+        'trimmed_mean': lambda: sp_stats.trim_mean(x, TRIM_PROPORTION,
+                                                   axis=1),
+        'eigenvariate': lambda: _eigenvariate(x)
+    }
+    return [funcs[stat]() for stat in summary]
+
+
+def summarize(darray, reducer, summary, transform=None):
+    """Compute summary statistics of every region in a single pass
+
+    Each region's vertices are gathered once and all statistics are
+    computed from them. If only the mean is requested, the faster sparse
+    reduction (LabelReducer.reduce) is used instead. Statistics other than
+    the mean treat any vertex with a non-zero weight as a member of the
+    region.
+
+    Parameters
+    ----------
+    darray : numpy.ndarray, (n_timepoints, n_vertices)
+        Functional vertices
+    reducer : LabelReducer
+        Regions of the vertices
+    summary : list of str
+        Summary statistics (see check_summary)
+    transform : callable, optional
+        Function applied to the vertices of each region before summarizing,
+        such as denoising (see LabelReducer.reduce), by default None
+
+    Returns
+    -------
+    dict of numpy.ndarray, (n_timepoints, n_regions)
+        Region timeseries of each statistic, in the same order as the labels
+        of reducer
+    """
+    if summary == ['mean']:
+        return {'mean': reducer.reduce(darray, transform)}
+
+    if darray.shape[1] != reducer.n_vertices:
+        raise ValueError(f'Data has {darray.shape[1]} vertices but roi '
+                         f'has {reducer.n_vertices} vertices')
+    n_timepoints = darray.shape[0]
+    dtype = np.result_type(darray.dtype, np.float32)
+    out = {stat: np.zeros((n_timepoints, len(reducer.labels)), dtype=dtype)
+           for stat in summary}
+
+    matrix = reducer.matrix
+    for i in range(len(reducer.labels)):
+        row = slice(matrix.indptr[i], matrix.indptr[i + 1])
+        x = darray[:, matrix.indices[row]]
+        if transform is not None:
+            x = transform(x)
+        values = _region_stats(x, matrix.data[row], summary)
+        for stat, value in zip(summary, values):
+            out[stat][:, i] = value
+    return out
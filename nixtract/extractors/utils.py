@@ -2,56 +2,126 @@ import numpy as np
 import pandas as pd
 from nilearn import signal
 
+from .reduction import LabelReducer, _vertex_blocks
+from .denoise import SignalCleaner
+from .summary import summarize
 
-def _mask(darray, roi, as_vertices=False):
+# Maximum difference between float32 and float64 extractions, relative to the
+# magnitude of the input data. float32 stores ~7 significant digits, so this
+# allows for rounding error accumulated over reduction and denoising. Checked 
+# in the test suite
+FLOAT32_RTOL = 1e-5
+
+
+def check_precision(actual, expected, scale=None, rtol=FLOAT32_RTOL):
+    """Check that reduced precision timeseries agree with float64 timeseries
+
+    Rounding error of reduced precision data is proportional to the magnitude
+    of the input data, not of the (e.g., detrended or confound-regressed) 
+    output. The absolute difference between actual and expected must therefore
+    be within rtol of `scale`, the largest absolute value of the input data.
+    Standardized outputs should be rescaled by their original standard 
+    deviation before checking.
+
+    Parameters
+    ----------
+    actual : numpy.ndarray, (n_timepoints, n_timeseries)
+        Timeseries extracted with reduced precision (e.g., float32)
+    expected : numpy.ndarray, (n_timepoints, n_timeseries)
+        Timeseries extracted with float64
+    scale : float or numpy.ndarray, optional
+        Largest absolute value of the input data, overall or per timeseries. 
+        If None, the largest absolute value of each expected timeseries is 
+        used, which is only appropriate when timeseries are not denoised. By 
+        default None
+    rtol : float, optional
+        Relative tolerance, by default FLOAT32_RTOL
+
+    Returns
+    -------
+    bool
+        True if all timeseries are within tolerance
+    """
+    expected = np.asarray(expected, dtype=np.float64)
+    if scale is None:
+        scale = np.abs(expected).max(axis=0)
+    scale = np.where(np.asarray(scale) == 0, 1, scale)
+    return bool(np.all(np.abs(actual - expected) <= rtol * scale))
+
+
+def _mask(darray, roi, as_vertices=False, transform=None, summary=None):
     """Extract timeseries for each unique value in roi mask
 
     Parameters
     ----------
     darray : numpy.ndarray, (n_timepoints, n_vertices)
         Functional vertices
-    roi : numpy.ndarray, (n_vertices,)
-        Vertices with integer labels denoting the regions
+    roi : numpy.ndarray, (n_vertices,) or LabelReducer
+        Vertices with integer labels denoting the regions, or a precomputed
+        reducer of those labels
     as_vertices : bool, optional
         Extract all vertices beloging to a label in roi. Only possible when
         roi is a binary mask, by default False
+    transform : callable, optional
+        Function applied to the vertices before they are reduced (see 
+        LabelReducer.reduce), by default None
+    summary : list of str, optional
+        Summary statistics to compute for each region (see 
+        nixtract.extractors.summary). If None, the mean is computed. By 
+        default None
 
     Returns
     -------
-    numpy.ndarray
-        Masked array
+    numpy.ndarray or dict of numpy.ndarray
+        Masked array, or masked array of each summary statistic if summary
+        is provided
 
     Raises
     ------
     ValueError
-        roi contains multiple regions but as_vertices=True
+        roi contains multiple regions but as_vertices=True, or summary is 
+        used with as_vertices=True
     """
-    labels = np.unique(roi)
-    if len(labels) > 2 and as_vertices:
+    if not isinstance(roi, LabelReducer):
+        roi = LabelReducer.from_roi(roi)
+
+    if len(roi.labels) > 2 and as_vertices:
         raise ValueError('Using as_vertices=True with more than one region '
                          'in roi file. Vertex-level extraction can only be '
                          'performed with a single-region (binary) roi file.')
+    if summary is not None:
+        if as_vertices:
+            raise ValueError('Summary statistics cannot be computed with '
+                             'as_vertices=True')
+        return summarize(darray, roi, summary, transform)
+
     if as_vertices:
-        timeseries = darray[:, roi.ravel().astype(bool)]
+        timeseries = darray[:, roi.vertices()]
+        if transform is not None:
+            timeseries = transform(timeseries)
     else:
-        timeseries = np.zeros((darray.shape[0], len(labels)))
-        for i, l in enumerate(labels):
-            mask = (roi.ravel() == l)
-            timeseries[:, i] = darray[:, mask].mean(axis=1)
+        timeseries = roi.reduce(darray, transform)
     
     return timeseries
 
 
 def mask_data(darray, roi, regressors=None, as_vertices=False, 
-              pre_clean=False, **kwargs):
-    """[summary]
+              pre_clean=False, n_threads=1, summary=None, **kwargs):
+    """Extract and denoise timeseries for each unique value in roi
+
+    darray is never copied as a whole. With pre_clean, vertices are denoised 
+    and reduced in bounded blocks, which gives the same result as denoising
+    all vertices at once because denoising treats each vertex independently.
+    Vertices are denoised with a SignalCleaner, so that the confounds and 
+    filters are only processed once for all vertices.
 
     Parameters
     ----------
     darray : numpy.ndarray, (n_timepoints, n_vertices)
         Functional vertices
-    roi : numpy.ndarray, (n_vertices,)
-        Vertices with integer labels denoting the regions
+    roi : numpy.ndarray, (n_vertices,) or LabelReducer
+        Vertices with integer labels denoting the regions, or a precomputed
+        reducer of those labels
     regressors : numpy.ndarray, optional
         Confound regressors to regress from timeseries, by default None
     as_vertices : bool, optional
@@ -60,20 +130,237 @@ def mask_data(darray, roi, regressors=None, as_vertices=False,
     pre_clean : bool, optional
         Run nilearn.signal.clean on all vertices prior to masking, rather than
         after. By default False
+    n_threads : int, optional
+        Number of threads used to denoise vertices if pre_clean=True, by 
+        default 1
+    summary : list of str, optional
+        Summary statistics to compute for each region (see 
+        nixtract.extractors.summary), by default None
 
     Returns
     -------
-    numpy.ndarray
-        Extracted timeseries
+    numpy.ndarray or dict of numpy.ndarray
+        Extracted timeseries, or extracted timeseries of each summary 
+        statistic if summary is provided
+    """
+    return mask_datasets([darray], [roi], regressors, as_vertices, pre_clean,
+                         n_threads, summary, **kwargs)[0]
+
+
+def _clean_shared(darray, rois, clean):
+    """Denoise the vertices of darray that belong to any of rois once
+
+    Parameters
+    ----------
+    darray : numpy.ndarray, (n_timepoints, n_vertices)
+        Functional vertices
+    rois : list of numpy.ndarray or LabelReducer
+        Rois of darray (see mask_data)
+    clean : callable
+        Denoising function, which must treat each vertex independently
+
+    Returns
+    -------
+    numpy.ndarray, (n_timepoints, n_used), list of LabelReducer
+        Denoised vertices that belong to any roi, and each roi restricted to
+        those vertices, with the same regions
+    """
+    rois = [x if isinstance(x, LabelReducer) else LabelReducer.from_roi(x)
+            for x in rois]
+    columns = np.unique(np.concatenate([x.matrix.indices for x in rois]))
+    n_timepoints = darray.shape[0]
+    cleaned = np.empty((n_timepoints, len(columns)), 
+                       dtype=np.result_type(darray.dtype, np.float32))
+    for block in _vertex_blocks(n_timepoints, len(columns), darray.itemsize):
+        cleaned[:, block] = clean(darray[:, columns[block]])
+    return cleaned, [LabelReducer(x.matrix[:, columns], x.labels) 
+                     for x in rois]
+
+
+def mask_datasets(darrays, rois, regressors=None, as_vertices=False, 
+                  pre_clean=False, n_threads=1, summary=None, **kwargs):
+    """Extract timeseries from several datasets that share the same 
+    timepoints and denoise them together
+
+    Denoising is set up and run once for all datasets (e.g., both 
+    hemispheres of a GIFTI extraction), rather than once per dataset. Results
+    are the same as calling mask_data on each dataset.
+
+    With pre_clean, a dataset that is given more than once (i.e., the same 
+    array, such as a CIFTI image extracted with several atlases) is denoised
+    once, and then reduced with each of its rois. The denoised vertices of 
+    all of its rois are then held in memory at once, rather than in blocks.
+
+    Parameters
+    ----------
+    darrays : list of numpy.ndarray, (n_timepoints, n_vertices)
+        Functional vertices of each dataset
+    rois : list of numpy.ndarray or LabelReducer
+        Roi of each dataset (see mask_data)
+    regressors : numpy.ndarray, optional
+        Confound regressors to regress from timeseries, by default None
+    as_vertices : bool, optional
+        Extract all vertices beloging to a label in each roi. Only possible 
+        when rois are binary masks, by default False
+    pre_clean : bool, optional
+        Denoise all vertices prior to masking, rather than after. By default 
+        False
+    n_threads : int, optional
+        Number of threads used to denoise vertices if pre_clean=True, by 
+        default 1
+    summary : list of str, optional
+        Summary statistics to compute for each region (see 
+        nixtract.extractors.summary), by default None
+
+    Returns
+    -------
+    list of numpy.ndarray or list of dict of numpy.ndarray
+        Extracted timeseries of each dataset, or of each summary statistic of
+        each dataset if summary is provided
+
+    Raises
+    ------
+    ValueError
+        Datasets have different numbers of timepoints
     """
-    x = darray.copy()
+    n_timepoints = {x.shape[0] for x in darrays}
+    if len(n_timepoints) != 1:
+        raise ValueError('All data must have the same number of timepoints')
+    
     if pre_clean:
-        x = signal.clean(x, confounds=regressors, **kwargs)
-        return _mask(x, roi, as_vertices)
+        if kwargs.get('sessions') is not None:
+            # not supported by SignalCleaner
+            def _clean(x):
+                return signal.clean(x, confounds=regressors, **kwargs)
+        else:
+            kwargs.pop('sessions', None)
+            _clean = SignalCleaner(n_timepoints.pop(), regressors, 
+                                   n_threads=n_threads, **kwargs).transform
+        # datasets that are given more than once are only denoised once
+        shared = {}
+        for i, x in enumerate(darrays):
+            shared.setdefault(id(x), []).append(i)
+        timeseries = [None] * len(darrays)
+        for indices in shared.values():
+            darray = darrays[indices[0]]
+            if len(indices) == 1:
+                timeseries[indices[0]] = _mask(darray, rois[indices[0]], 
+                                               as_vertices, _clean, summary)
+                continue
+            cleaned, reducers = _clean_shared(
+                darray, [rois[i] for i in indices], _clean
+            )
+            for i, roi in zip(indices, reducers):
+                timeseries[i] = _mask(cleaned, roi, as_vertices, 
+                                      summary=summary)
+        return timeseries
     else:
-        timeseries = _mask(x, roi, as_vertices)
-        out = signal.clean(timeseries, confounds=regressors, **kwargs)
+        timeseries = [_mask(x, roi, as_vertices, summary=summary) 
+                      for x, roi in zip(darrays, rois)]
+        return _clean_together(timeseries, regressors, **kwargs)
+
+
+def _clean_together(timeseries, regressors=None, **kwargs):
+    """Denoise a list of timeseries arrays, or of dicts of timeseries arrays,
+    with a single call to nilearn.signal.clean
+    """
+    arrays = timeseries
+    if timeseries and isinstance(timeseries[0], dict):
+        arrays = [x for d in timeseries for x in d.values()]
+    out = signal.clean(np.hstack(arrays), confounds=regressors, **kwargs)
+    splits = np.cumsum([x.shape[1] for x in arrays])[:-1]
+    out = np.split(out, splits, axis=1)
+    if arrays is timeseries:
         return out
+    cleaned = []
+    for d in timeseries:
+        cleaned.append(dict(zip(d.keys(), out[:len(d)])))
+        out = out[len(d):]
+    return cleaned
+
+
+def mask_chunks(chunks, roi, regressors=None, as_vertices=False, 
+                summary=None, **kwargs):
+    """Extract timeseries from data that is streamed in blocks of timepoints
+
+    Each block is reduced as soon as it is received, and denoising is 
+    performed on the extracted timeseries once all blocks are reduced. 
+
+    Parameters
+    ----------
+    chunks : iterable of numpy.ndarray, (n_timepoints, n_vertices)
+        Consecutive blocks of functional vertices
+    roi : numpy.ndarray, (n_vertices,) or LabelReducer
+        Vertices with integer labels denoting the regions, or a precomputed
+        reducer of those labels
+    regressors : numpy.ndarray, optional
+        Confound regressors to regress from timeseries, by default None
+    as_vertices : bool, optional
+        Extract all vertices beloging to a label in roi. Only possible when
+        roi is a binary mask, by default False
+    summary : list of str, optional
+        Summary statistics to compute for each region (see 
+        nixtract.extractors.summary), by default None. The eigenvariate 
+        requires all timepoints and cannot be streamed
+
+    Returns
+    -------
+    numpy.ndarray or dict of numpy.ndarray
+        Extracted timeseries, or extracted timeseries of each summary 
+        statistic if summary is provided
+
+    Raises
+    ------
+    ValueError
+        summary includes the eigenvariate
+    """
+    return mask_chunks_rois(chunks, [roi], regressors, as_vertices, summary,
+                            **kwargs)[0]
+
+
+def mask_chunks_rois(chunks, rois, regressors=None, as_vertices=False, 
+                     summary=None, **kwargs):
+    """Extract timeseries of several rois from the same data, which is 
+    streamed in blocks of timepoints
+
+    Each block is read once and reduced with every roi, and the timeseries of
+    all rois are denoised together (see mask_chunks).
+
+    Parameters
+    ----------
+    chunks : iterable of numpy.ndarray, (n_timepoints, n_vertices)
+        Consecutive blocks of functional vertices
+    rois : list of numpy.ndarray or LabelReducer
+        Rois of the vertices (see mask_chunks)
+    regressors, as_vertices, summary
+        See mask_chunks
+
+    Returns
+    -------
+    list of numpy.ndarray or list of dict of numpy.ndarray
+        Extracted timeseries of each roi, or of each summary statistic of 
+        each roi if summary is provided
+
+    Raises
+    ------
+    ValueError
+        summary includes the eigenvariate
+    """
+    if summary is not None and 'eigenvariate' in summary:
+        raise ValueError('The eigenvariate cannot be computed from streamed '
+                         'data')
+    rois = [roi if isinstance(roi, LabelReducer) else LabelReducer.from_roi(roi)
+            for roi in rois]
+    blocks = [[_mask(x, roi, as_vertices, summary=summary) for roi in rois] 
+              for x in chunks]
+    timeseries = []
+    for i in range(len(rois)):
+        if summary is None:
+            timeseries.append(np.vstack([x[i] for x in blocks]))
+        else:
+            timeseries.append({stat: np.vstack([x[i][stat] for x in blocks]) 
+                               for stat in summary})
+    return _clean_together(timeseries, regressors, **kwargs)
 
 
 def label_timeseries(tseries, labels, as_vertices):
@@ -92,10 +379,9 @@ def label_timeseries(tseries, labels, as_vertices):
     Returns
     -------
     pandas.DataFrame
-        Data table containing each timeseries with labels as column headers 
+        Data table containing each timeseries with labels as column headers.
+        The table is a view of tseries, which is not copied
     """
     if as_vertices:
-        cols = [f'vert{i}' for i in np.arange(tseries.shape[1])]
-        return pd.DataFrame(tseries, columns=cols)
-    else:
-        return pd.DataFrame(tseries, columns=labels)
\ No newline at end of file
+        labels = [f'vert{i}' for i in range(tseries.shape[1])]
+    return pd.DataFrame(tseries, columns=labels, copy=False)
\ No newline at end of file
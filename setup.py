@@ -12,6 +12,12 @@ test_deps = ['pytest-cov',
 
 extras = {
     'test': test_deps,
+    # optional output formats
+    'arrow': ['pyarrow'],
+    'hdf5': ['h5py'],
+    'zstd': ['zstandard'],
+    # random access to .nii.gz inputs
+    'gzip_index': ['indexed_gzip'],
 }
 
 with open("README.md", "r", encoding="utf-8") as fh:
@@ -39,6 +45,7 @@ setup(
         'natsort>=7.1.1',
         'scipy>=1.5.0',
         'scikit-learn>=0.24.1',
+        'threadpoolctl>=2.1.0',
         'load_confounds>=0.11.1'
     ],
     tests_require=test_deps,
@@ -28,10 +28,27 @@ mock dtseries of Schaefer labels with conventional ~91k vertices (see the
 setup script).  
 
 Additional checks where scans are discarded and regressors are used are also
-performed, which are some basic functionalities of `CiftiExtractor`.
+performed, which are some basic functionalities of `CiftiExtractor`. These 
+are repeated when the dtseries is streamed in blocks of timepoints 
+(`--chunk_size`), and checked against float64 when extracting with float32
+precision (`--precision float32`). Summary statistics other than the mean 
+(`--summary`) are checked with and without streaming. Weighted regions are 
+checked with a dscalar of weight maps made from the dlabel, and multiple 
+atlases are extracted from a single load of the dtseries. Binary output 
+formats (`--output_format`) and the consolidated HDF5 store of all inputs 
+(`--output_store`) are checked against the default .tsv output. Re-runs are 
+checked to only extract new or changed inputs, as recorded in the manifest, 
+and extractions are checked to be returned to the main process as compact 
+result records rather than extractors. Parallel extractions are checked to
+report their progress as each input file is done, in any order, and to stay
+within a memory budget (`--max_memory`) estimated from the dtseries headers.
+`--threads_per_job` is checked to reach the pre-extraction denoiser.
 """
 import os
+import sys
+import pickle
 import subprocess
+import pytest
 import json
 import numpy as np
 import pandas as pd
@@ -40,6 +57,13 @@ from nilearn import signal
 import nilearn
 from sklearn.preprocessing import scale
 
+from nixtract.extractors.utils import check_precision
+from nixtract.extractors.output import read_timeseries
+from nixtract.extractors import CiftiExtractor
+from nixtract.cli.base import _extract_job
+from nixtract.cli.cifti import (estimate_cifti_memory, _cli_parser, 
+                                 _check_cifti_params, load_cifti)
+
 def test_aligned_extraction(data_dir, mock_data, tmpdir):
 
     dtseries = os.path.join(mock_data, 'gordon.dtseries.nii')
@@ -189,3 +213,381 @@ def test_regressors(data_dir, mock_data, basic_regressor_config, tmpdir):
 
     assert np.allclose(actual.values, expected)
 
+
+
+def test_chunked_extraction(data_dir, mock_data, basic_regressor_config, 
+                            tmpdir):
+
+    roi_file = os.path.join(data_dir, 
+                            'Schaefer2018_100Parcels_7Networks_order.dlabel.nii')
+    dtseries = os.path.join(mock_data, 'schaefer_91k.dtseries.nii')
+    
+    # chunks that do not evenly divide the number of timepoints
+    cmd = (f"nixtract-cifti {tmpdir} --input_files {dtseries} "
+           f"--roi_file {roi_file} --chunk_size 3 --discard_scans 2")
+    subprocess.run(cmd.split())
+
+    actual = pd.read_table(os.path.join(tmpdir, 'schaefer_91k_timeseries.tsv'))
+    expected = np.tile(np.arange(1, 101), (8, 1))
+    assert np.array_equal(actual.values, expected)
+
+    # denoising is performed on the extracted timeseries
+    dtseries = os.path.join(mock_data, 'gordon.dtseries.nii')
+    roi_file = os.path.join(data_dir, 
+                            'Gordon333_FreesurferSubcortical.32k_fs_LR.dlabel.nii')
+    config_file = os.path.join(tmpdir, 'config.json')
+    with open(config_file, 'w') as fp:
+        json.dump(basic_regressor_config, fp)
+    cmd = (f"nixtract-cifti {tmpdir} --input_files {dtseries} "
+           f"--roi_file {roi_file} --chunk_size 4 -c {config_file}")
+    subprocess.run(cmd.split())
+    actual = pd.read_table(os.path.join(tmpdir, 'gordon_timeseries.tsv'))
+
+    regressors = pd.read_table(basic_regressor_config['regressor_files'], 
+                               usecols=basic_regressor_config['regressors'])
+    expected = np.tile(np.arange(1, 353), (10, 1))
+    expected = signal.clean(expected, confounds=regressors, standardize=False, 
+                            detrend=False)
+    assert np.allclose(actual.values, expected)
+
+    # vertex-level extraction 
+    roi_file = os.path.join(mock_data, 'gordon_L_SMhand_10.dlabel.nii')
+    cmd = (f"nixtract-cifti {tmpdir} --input_files {dtseries} "
+           f"--roi_file {roi_file} --as_vertices --chunk_size 3")
+    subprocess.run(cmd.split())
+    actual = pd.read_table(os.path.join(tmpdir, 'gordon_timeseries.tsv'))
+
+    roi_array = nib.load(roi_file).get_fdata()
+    n_vertices = len(roi_array[roi_array == 273])
+    expected = np.full((10, n_vertices), fill_value=273)
+    assert np.array_equal(actual.values, expected)
+
+
+def test_float32_precision(data_dir, mock_data, basic_regressor_config, 
+                           tmpdir):
+
+    dtseries = os.path.join(mock_data, 'gordon.dtseries.nii')
+    roi_file = os.path.join(data_dir, 
+                            'Gordon333_FreesurferSubcortical.32k_fs_LR.dlabel.nii')
+    config_file = os.path.join(tmpdir, 'config.json')
+    with open(config_file, 'w') as fp:
+        json.dump(basic_regressor_config, fp)
+
+    cmd = (f"nixtract-cifti {tmpdir} --input_files {dtseries} "
+           f"--roi_file {roi_file} --precision float32")
+    subprocess.run(cmd.split())
+    actual = pd.read_table(os.path.join(tmpdir, 'gordon_timeseries.tsv'))
+    expected = np.tile(np.arange(1, 353), (10, 1))
+    assert np.array_equal(actual.values, expected)
+
+    cmd = (f"nixtract-cifti {tmpdir} --input_files {dtseries} "
+           f"--roi_file {roi_file} --precision float32 -c {config_file}")
+    subprocess.run(cmd.split())
+    actual = pd.read_table(os.path.join(tmpdir, 'gordon_timeseries.tsv'))
+
+    regressors = pd.read_table(basic_regressor_config['regressor_files'], 
+                               usecols=basic_regressor_config['regressors'])
+    expected = signal.clean(expected.astype(float), confounds=regressors, 
+                            standardize=False, detrend=False)
+    assert check_precision(actual.values, expected, scale=352)
+
+
+def test_summary(data_dir, mock_data, tmpdir):
+
+    dtseries = os.path.join(mock_data, 'gordon.dtseries.nii')
+    roi_file = os.path.join(data_dir, 
+                            'Gordon333_FreesurferSubcortical.32k_fs_LR.dlabel.nii')
+
+    cmd = (f"nixtract-cifti {tmpdir} --input_files {dtseries} "
+           f"--roi_file {roi_file} --summary median trimmed_mean std")
+    subprocess.run(cmd.split())
+
+    expected = np.tile(np.arange(1, 353), (10, 1))
+    for stat in ['median', 'trimmed_mean']:
+        fname = f'gordon_stat-{stat}_timeseries.tsv'
+        actual = pd.read_table(os.path.join(tmpdir, fname))
+        assert np.array_equal(actual.values, expected)
+    actual = pd.read_table(os.path.join(tmpdir, 'gordon_stat-std_timeseries.tsv'))
+    assert actual.shape == expected.shape
+    assert np.allclose(actual.values, 0)
+
+    # streamed
+    out_dir = os.path.join(tmpdir, 'chunked')
+    cmd = (f"nixtract-cifti {out_dir} --input_files {dtseries} "
+           f"--roi_file {roi_file} --summary median --chunk_size 3")
+    subprocess.run(cmd.split())
+    fname = os.path.join(out_dir, 'gordon_stat-median_timeseries.tsv')
+    assert np.array_equal(pd.read_table(fname).values, expected)
+
+
+def test_weighted_atlas(data_dir, mock_data, tmpdir):
+
+    dtseries = os.path.join(mock_data, 'gordon.dtseries.nii')
+    dlabel = os.path.join(data_dir, 
+                          'Gordon333_FreesurferSubcortical.32k_fs_LR.dlabel.nii')
+
+    # weighted maps of the first 10 regions, which are constant in the mock
+    # dtseries so that every weighted mean equals the label
+    img = nib.load(dlabel)
+    data = img.get_fdata()[0]
+    label_dict = img.header.get_axis(index=0).label[0]
+    names = [label_dict[i][0] for i in range(1, 11)]
+    rng = np.random.RandomState(0)
+    maps = np.stack([(data == i) * rng.uniform(.1, 1, size=data.shape) 
+                     for i in range(1, 11)]).astype(np.float32)
+    axes = (nib.cifti2.ScalarAxis(names), img.header.get_axis(1))
+    roi_file = os.path.join(tmpdir, 'gordon_maps.dscalar.nii')
+    nib.save(nib.Cifti2Image(maps, header=axes), roi_file)
+
+    cmd = (f"nixtract-cifti {tmpdir} --input_files {dtseries} "
+           f"--roi_file {roi_file}")
+    subprocess.run(cmd.split())
+    actual = pd.read_table(os.path.join(tmpdir, 'gordon_timeseries.tsv'))
+    assert list(actual.columns) == names
+    expected = np.tile(np.arange(1, 11), (10, 1))
+    assert np.allclose(actual.values, expected)
+
+
+def test_multiple_atlases(data_dir, mock_data, tmpdir):
+
+    dtseries = os.path.join(mock_data, 'schaefer_91k.dtseries.nii')
+    # an atlas that needs to be aligned with the dtseries, and one that does 
+    # not 
+    roi_files = [
+        os.path.join(data_dir, 
+                     'Schaefer2018_100Parcels_7Networks_order.dlabel.nii'),
+        os.path.join(mock_data, 'schaefer_91k.dlabel.nii')
+    ]
+    names = ['Schaefer2018100Parcels7Networksorder', 'schaefer91k']
+
+    expected = np.tile(np.arange(1, 101), (10, 1))
+    for args in ['', '--chunk_size 4', '--denoise-pre-extract', 
+                 '--summary median']:
+        out_dir = os.path.join(tmpdir, args.replace(' ', ''))
+        cmd = (f"nixtract-cifti {out_dir} --input_files {dtseries} "
+               f"--roi_file {' '.join(roi_files)} {args}")
+        subprocess.run(cmd.split())
+        for name in names:
+            fname = f'schaefer_91k_atlas-{name}_timeseries.tsv'
+            if 'median' in args:
+                fname = f'schaefer_91k_atlas-{name}_stat-median_timeseries.tsv'
+            actual = pd.read_table(os.path.join(out_dir, fname))
+            assert np.allclose(actual.values, expected)
+        assert not os.path.exists(os.path.join(out_dir, 
+                                               'schaefer_91k_timeseries.tsv'))
+
+
+def test_output_format(data_dir, mock_data, tmpdir):
+
+    dtseries = os.path.join(mock_data, 'gordon.dtseries.nii')
+    roi_file = os.path.join(data_dir, 
+                            'Gordon333_FreesurferSubcortical.32k_fs_LR.dlabel.nii')
+    cmd = (f"nixtract-cifti {tmpdir} --input_files {dtseries} "
+           f"--roi_file {roi_file}")
+    subprocess.run(cmd.split())
+    expected = pd.read_table(os.path.join(tmpdir, 'gordon_timeseries.tsv'))
+
+    out_dir = os.path.join(tmpdir, 'npy')
+    cmd = (f"nixtract-cifti {out_dir} --input_files {dtseries} "
+           f"--roi_file {roi_file} --output_format npy")
+    subprocess.run(cmd.split())
+    actual = read_timeseries(os.path.join(out_dir, 'gordon_timeseries.npy'),
+                             mmap_mode='r')
+    assert list(actual.columns) == list(expected.columns)
+    assert np.array_equal(actual.values, expected.values)
+    assert not os.path.exists(os.path.join(out_dir, 'gordon_timeseries.tsv'))
+    # store files of each extraction are removed once merged
+    assert not [x for x in os.listdir(out_dir) if x.startswith('.timeseries')]
+    with open(os.path.join(out_dir, 'gordon_timeseries.json')) as f:
+        sidecar = json.load(f)
+    assert sidecar['source'] == [dtseries]
+    assert sidecar['regressors'] is None
+
+
+def test_output_store(data_dir, mock_data, tmpdir):
+    pytest.importorskip('h5py')
+    from nixtract.extractors.store import TimeseriesStore
+
+    dtseries = os.path.join(mock_data, 'gordon.dtseries.nii')
+    roi_file = os.path.join(data_dir, 
+                            'Gordon333_FreesurferSubcortical.32k_fs_LR.dlabel.nii')
+    cmd = (f"nixtract-cifti {tmpdir} --input_files {dtseries} "
+           f"--roi_file {roi_file}")
+    subprocess.run(cmd.split())
+    expected = pd.read_table(os.path.join(tmpdir, 'gordon_timeseries.tsv'))
+
+    # two inputs merged by the main process while extracting in parallel
+    out_dir = os.path.join(tmpdir, 'store')
+    schaefer = os.path.join(mock_data, 'schaefer_91k.dtseries.nii')
+    cmd = (f"nixtract-cifti {out_dir} --input_files {dtseries} {schaefer} "
+           f"--roi_file {roi_file} --output_store --n_jobs 2")
+    subprocess.run(cmd.split())
+    assert not os.path.exists(os.path.join(out_dir, 'gordon_timeseries.tsv'))
+
+    with TimeseriesStore(os.path.join(out_dir, 'timeseries.h5'), 'r') as store:
+        # results are added in the order in which they are completed
+        assert sorted(store.keys()) == ['gordon_timeseries', 
+                                        'schaefer_91k_timeseries']
+        assert store.metadata['parameters']['output_store']
+        index = store.index().set_index('key')
+        assert index.loc['gordon_timeseries', 'source'] == dtseries
+        assert index.loc['schaefer_91k_timeseries', 'source'] == schaefer
+        # same roi file, so a single label table is shared
+        assert index['labels'].nunique() == 1
+        actual = store.read('gordon_timeseries')
+    assert list(actual.columns) == list(expected.columns)
+    assert np.array_equal(actual.values, expected.values)
+
+
+def test_resume(data_dir, mock_data, tmpdir):
+
+    gordon = os.path.join(mock_data, 'gordon.dtseries.nii')
+    schaefer = os.path.join(mock_data, 'schaefer_91k.dtseries.nii')
+    roi_file = os.path.join(data_dir, 
+                            'Gordon333_FreesurferSubcortical.32k_fs_LR.dlabel.nii')
+    outputs = [os.path.join(tmpdir, 'gordon_timeseries.tsv'),
+               os.path.join(tmpdir, 'schaefer_91k_timeseries.tsv')]
+
+    def _run(input_files, *args):
+        cmd = (f"nixtract-cifti {tmpdir} --input_files {input_files} "
+               f"--roi_file {roi_file} " + ' '.join(args))
+        subprocess.run(cmd.split())
+        return [os.stat(x).st_mtime_ns if os.path.exists(x) else None 
+                for x in outputs]
+
+    first = _run(gordon)
+    assert first[1] is None
+    # only the new input file is extracted
+    second = _run(f'{gordon} {schaefer}')
+    assert second[0] == first[0] and second[1] is not None
+    # everything is up to date, including after an interrupted write
+    with open(os.path.join(tmpdir, 'nixtract_data', 'manifest.jsonl'), 
+              'a') as f:
+        f.write('{"input": ')
+    assert _run(f'{gordon} {schaefer}') == second
+    # missing outputs, changed parameters and --overwrite are re-extracted
+    os.remove(outputs[1])
+    third = _run(f'{gordon} {schaefer}')
+    assert third[0] == second[0] and third[1] is not None
+    assert _run(f'{gordon} {schaefer}') == third
+    fourth = _run(f'{gordon} {schaefer}', '--n_decimals 3')
+    assert all(x != y for x, y in zip(fourth, third))
+    fifth = _run(f'{gordon} {schaefer}', '--n_decimals 3 --overwrite')
+    assert all(x != y for x, y in zip(fifth, fourth))
+
+
+def test_result_records(data_dir, mock_data, basic_regressor_config, 
+                        tmpdir):
+
+    dtseries = os.path.join(mock_data, 'gordon.dtseries.nii')
+    roi_file = os.path.join(data_dir, 
+                            'Gordon333_FreesurferSubcortical.32k_fs_LR.dlabel.nii')
+    out = os.path.join(tmpdir, 'gordon_timeseries.tsv')
+
+    def _extract(fname):
+        extractor = CiftiExtractor(fname, roi_file)
+        extractor.set_regressors(basic_regressor_config['regressor_files'],
+                                 basic_regressor_config['regressors'])
+        extractor.extract()
+        extractor.save(out)
+        return out, extractor
+
+    # workers return a compact record rather than the extractor
+    result = _extract_job(_extract, (dtseries,))
+    assert result['out'] == out
+    assert result['outputs'] == [out]
+    assert result['regressor_names'] == basic_regressor_config['regressors']
+    assert not result['load_confounds']
+    assert result['store'] is None
+    assert result['seconds'] > 0
+    _, extractor = _extract(dtseries)
+    assert len(pickle.dumps(result)) < len(pickle.dumps(extractor)) / 100
+
+    # timeseries to store are written to a store file of their own, and 
+    # only its file name is returned
+    pytest.importorskip('h5py')
+    from nixtract.extractors.store import TimeseriesStore
+    result = _extract_job(_extract, (dtseries,), store_dir=str(tmpdir), 
+                          n_decimals=2)
+    assert result['store'] == os.path.join(tmpdir, 'gordon_timeseries.h5')
+    assert len(pickle.dumps(result)) < 1000
+    with TimeseriesStore(result['store'], mode='r') as shard:
+        assert shard.keys() == ['gordon_timeseries']
+        assert shard.index()['source'].tolist() == [dtseries]
+        assert np.array_equal(shard.read('gordon_timeseries').values, 
+                              extractor.timeseries.round(2).values)
+
+
+def test_parallel_progress(data_dir, mock_data, tmpdir):
+
+    gordon = os.path.join(mock_data, 'gordon.dtseries.nii')
+    schaefer = os.path.join(mock_data, 'schaefer_91k.dtseries.nii')
+    roi_file = os.path.join(data_dir, 
+                            'Gordon333_FreesurferSubcortical.32k_fs_LR.dlabel.nii')
+    cmd = (f"nixtract-cifti {tmpdir} --input_files {gordon} {schaefer} "
+           f"--roi_file {roi_file} --n_jobs 2 --pool_chunksize 1 "
+           "--max_tasks_per_child 1 -v")
+    proc = subprocess.run(cmd.split(), stdout=subprocess.PIPE, 
+                          stderr=subprocess.PIPE, universal_newlines=True)
+
+    for fname in ['gordon_timeseries.tsv', 'schaefer_91k_timeseries.tsv']:
+        assert os.path.exists(os.path.join(tmpdir, fname))
+    progress = [x for x in proc.stdout.splitlines() if 'files done' in x]
+    assert len(progress) == 2
+    assert '1/2 files done' in progress[0] and '2/2 files done' in progress[1]
+    assert 'MB/s' in progress[1] and progress[1].endswith('ETA 00:00:00')
+
+
+def test_max_memory(data_dir, mock_data, tmpdir):
+
+    gordon = os.path.join(mock_data, 'gordon.dtseries.nii')
+    schaefer = os.path.join(mock_data, 'schaefer_91k.dtseries.nii')
+    roi_file = os.path.join(data_dir, 
+                            'Gordon333_FreesurferSubcortical.32k_fs_LR.dlabel.nii')
+
+    # float64 data and a float64 copy of (10, 91282) timepoints and vertices
+    params = {'precision': None, 'chunk_size': None}
+    assert estimate_cifti_memory(gordon, params) == 10 * 91282 * 16
+    params = {'precision': 'float32', 'chunk_size': 2, 'as_vertices': True}
+    assert estimate_cifti_memory(gordon, params) == 2 * 91282 * (8 + 2 * 4)
+
+    # each input file is within the budget, but not both at once
+    cmd = (f"nixtract-cifti {tmpdir} --input_files {gordon} {schaefer} "
+           f"--roi_file {roi_file} --n_jobs 2 --max_memory 20M")
+    subprocess.run(cmd.split())
+    expected = np.tile(np.arange(1, 353), (10, 1))
+    for fname in ['gordon_timeseries.tsv', 'schaefer_91k_timeseries.tsv']:
+        assert os.path.exists(os.path.join(tmpdir, fname))
+    actual = pd.read_table(os.path.join(tmpdir, 'gordon_timeseries.tsv'))
+    assert np.array_equal(actual.values, expected)
+
+
+def test_denoise_threads(data_dir, mock_data, basic_regressor_config, tmpdir,
+                         monkeypatch):
+
+    dtseries = os.path.join(mock_data, 'gordon.dtseries.nii')
+    roi_file = os.path.join(data_dir, 
+                            'Gordon333_FreesurferSubcortical.32k_fs_LR.dlabel.nii')
+    regressor_file = basic_regressor_config['regressor_files']
+    argv = ['nixtract-cifti', str(tmpdir), '--input_files', dtseries, 
+            '--roi_file', roi_file, '--regressor_files', regressor_file, 
+            '--regressors', *basic_regressor_config['regressors'],
+            '--denoise-pre-extract']
+
+    # --threads_per_job reaches the denoiser of each extraction
+    monkeypatch.setattr(sys, 'argv', argv + ['--threads_per_job', '3'])
+    params = _check_cifti_params(vars(_cli_parser()))
+    _, extractor = load_cifti(dtseries, params['roi_file'], regressor_file, 
+                              params)
+    assert extractor.pre_clean and extractor.n_threads == 3
+    extractor.extract()
+    actual = extractor.timeseries
+
+    monkeypatch.setattr(sys, 'argv', argv)
+    params = _check_cifti_params(vars(_cli_parser()))
+    _, extractor = load_cifti(dtseries, params['roi_file'], regressor_file, 
+                              params)
+    assert extractor.n_threads == 1
+    extractor.extract()
+    expected = extractor.timeseries
+    assert np.allclose(actual.values, expected.values)
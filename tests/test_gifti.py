@@ -23,7 +23,11 @@ func.gii file. Binary masks for these tests are created in `setup_mock_data.py`.
 The Schaefer atlas (100 region, 7 networks) in fsaverage5-space is used. 
 
 Additional checks where scans are discarded and regressors are used are also
-performed, which are some basic functionalities of `GiftiExtractor`.
+performed, which are some basic functionalities of `GiftiExtractor`, and 
+summary statistics other than the mean (`--summary`) are extracted. Weighted 
+regions are checked with weight maps (.func.gii) made from the annot files.
+The size of func.gii files used to schedule extractions within `--max_memory`
+is checked to be read from their headers.
 """
 import os
 import json
@@ -33,6 +37,8 @@ import nibabel as nib
 import pandas as pd
 from nilearn import signal
 
+from nixtract.cli.gifti import _gifti_size, estimate_gifti_memory
+
 def test_annot(data_dir, mock_data, tmpdir):
     
     schaef = '.Schaefer2018_100Parcels_7Networks_order.annot'
@@ -337,4 +343,82 @@ def test_regressors(mock_data, tmpdir, basic_regressor_config):
     regressors = regressors.values[3:, :]
     expected = signal.clean(expected, confounds=regressors, standardize=False, 
                             detrend=False)
-    assert np.allclose(actual, expected)
\ No newline at end of file
+    assert np.allclose(actual, expected)
+
+def test_summary(data_dir, mock_data, tmpdir):
+    
+    schaef = '.Schaefer2018_100Parcels_7Networks_order.annot'
+    lh_annot = os.path.join(data_dir, 'lh' + schaef)
+    rh_annot = os.path.join(data_dir, 'rh' + schaef)
+
+    lh_func = os.path.join(mock_data, 'schaefer_hemi-L.func.gii')
+    rh_func = os.path.join(mock_data, 'schaefer_hemi-R.func.gii')
+
+    cmd = (f"nixtract-gifti {tmpdir} --lh_files {lh_func} --rh_files {rh_func} "
+           f"--lh_roi_file {lh_annot} --rh_roi_file {rh_annot} "
+           "--summary mean median eigenvariate")
+    subprocess.run(cmd.split())
+
+    expected_hemi = np.tile(np.arange(1, 51), (10, 1))
+    expected = np.concatenate([expected_hemi, expected_hemi], axis=1)
+    for stat in ['mean', 'median']:
+        tseries = os.path.join(tmpdir, 
+                               f'schaefer_hemi-LR_stat-{stat}_timeseries.tsv')
+        actual = pd.read_table(tseries)
+        assert np.array_equal(actual.values, expected)
+    tseries = os.path.join(tmpdir, 
+                           'schaefer_hemi-LR_stat-eigenvariate_timeseries.tsv')
+    actual = pd.read_table(tseries)
+    assert actual.shape == expected.shape
+    assert np.allclose(actual.values, 0)
+
+
+def _make_weights(annot, n_regions, fname):
+    """Make a func.gii of random weights for the first regions of an annot"""
+    darray = nib.freesurfer.read_annot(annot)[0]
+    rng = np.random.RandomState(0)
+    darrays = []
+    for i in range(1, n_regions + 1):
+        weights = (darray == i) * rng.uniform(.1, 1, size=darray.shape)
+        meta = nib.gifti.GiftiMetaData.from_dict({'Name': f'region{i}'})
+        darrays.append(nib.gifti.GiftiDataArray(weights.astype(np.float32), 
+                                                meta=meta))
+    nib.save(nib.GiftiImage(darrays=darrays), fname)
+
+
+def test_weighted_atlas(data_dir, mock_data, tmpdir):
+
+    schaef = '.Schaefer2018_100Parcels_7Networks_order.annot'
+    lh_weights = os.path.join(tmpdir, 'lh_weights.func.gii')
+    _make_weights(os.path.join(data_dir, 'lh' + schaef), 5, lh_weights)
+    rh_weights = os.path.join(tmpdir, 'rh_weights.shape.gii')
+    _make_weights(os.path.join(data_dir, 'rh' + schaef), 5, rh_weights)
+
+    lh_func = os.path.join(mock_data, 'schaefer_hemi-L.func.gii')
+    rh_func = os.path.join(mock_data, 'schaefer_hemi-R.func.gii')
+
+    cmd = (f"nixtract-gifti {tmpdir} --lh_files {lh_func} --rh_files {rh_func} "
+           f"--lh_roi_file {lh_weights} --rh_roi_file {rh_weights}")
+    subprocess.run(cmd.split())
+
+    actual = pd.read_table(os.path.join(tmpdir, 
+                                        'schaefer_hemi-LR_timeseries.tsv'))
+    names = [f'region{i}' for i in range(1, 6)]
+    assert list(actual.columns) == ['L_' + i for i in names] + \
+                                   ['R_' + i for i in names]
+    expected_hemi = np.tile(np.arange(1, 6), (10, 1))
+    expected = np.concatenate([expected_hemi, expected_hemi], axis=1)
+    assert np.allclose(actual.values, expected)
+
+
+def test_estimate_memory(mock_data):
+
+    lh_func = os.path.join(mock_data, 'schaefer_hemi-L.func.gii')
+    rh_func = os.path.join(mock_data, 'schaefer_hemi-R.func.gii')
+    data = nib.load(lh_func).agg_data()
+    assert _gifti_size(lh_func) == (data.size, data.dtype)
+
+    params = {'precision': 'float32'}
+    assert estimate_gifti_memory((lh_func, None), params) == data.size * 8
+    assert (estimate_gifti_memory((lh_func, rh_func), params) 
+            == 2 * estimate_gifti_memory((lh_func, None), params))
@@ -28,16 +28,28 @@ The underlying nilearn masker object is also checked via
 The Schaefer atlas (100 region, 7 networks) is used. 
  
 Additional checks where scans are discarded and regressors are used are also
-performed, which are some basic functionalities of `NiftiExtractor`.
+performed, which are some basic functionalities of `NiftiExtractor`, and 
+scans are checked to be discarded lazily from the image proxy, including 
+through a persistent gzip seek point index (`--gzip_index`). Uncompressed 
+(.nii) images, which are memory-mapped, and atlases are checked against .nii.gz 
+images. Summary 
+statistics (`--summary`) are checked against the mock data and against the
+corresponding nilearn masker strategies. Weighted regions are checked with a 4D
+image of weight maps made from the atlas, and multiple roi files are extracted
+from a single load of the image. Images are checked to be read ahead of 
+extraction (`NiftiExtractor.load`), and input files loaded by the prefetching
+pipeline (`--prefetch`) to be extracted as without it.
 """
 import os
 import pytest
 import json
+import shutil
 import subprocess
 import numpy as np
 import nibabel as nib
 import pandas as pd
 
+from nixtract.extractors import NiftiExtractor
 from nixtract.extractors.nifti_extractor import _set_volume_masker
 from nilearn.input_data import (NiftiLabelsMasker, NiftiMasker, 
                                 NiftiSpheresMasker)
@@ -177,3 +189,321 @@ def test_discard_scans(data_dir, mock_data, tmpdir):
 
     expected = np.tile(np.arange(1, 101), (7, 1))
     assert np.array_equal(actual.values, expected)
+
+
+def _make_scaled_func(func, tmpdir):
+    """Scale each scan by its index so that discarded scans can be 
+    identified, with a TR of 2s
+    """
+    img = nib.load(func)
+    data = img.get_fdata() * np.arange(1, 11)
+    header = img.header.copy()
+    header.set_zooms(img.header.get_zooms()[:3] + (2.,))
+    scaled = os.path.join(tmpdir, 'scaled.nii.gz')
+    nib.save(nib.Nifti1Image(data, img.affine, header), scaled)
+    return scaled
+
+
+def test_discard_scans_lazy(data_dir, mock_data, tmpdir):
+
+    roi_file = os.path.join(data_dir, 
+                            'Schaefer2018_100Parcels_7Networks_order_FSLMNI152_2mm.nii.gz')
+    func = os.path.join(mock_data, 'schaefer_func.nii.gz')
+    scaled = _make_scaled_func(func, tmpdir)
+
+    extractor = NiftiExtractor(scaled, roi_file)
+    extractor.discard_scans(2).discard_scans(1)
+    # nothing is read until extraction
+    assert not extractor.img.in_memory
+    # the header, including the TR, is kept
+    assert extractor._load_img().header.get_zooms()[3] == 2.
+    extractor.extract()
+
+    expected = np.arange(1, 101) * np.arange(4, 11)[:, np.newaxis]
+    assert np.allclose(extractor.timeseries.values, expected)
+
+
+def test_gzip_index(data_dir, mock_data, tmpdir):
+    pytest.importorskip('indexed_gzip')
+
+    roi_file = os.path.join(data_dir, 
+                            'Schaefer2018_100Parcels_7Networks_order_FSLMNI152_2mm.nii.gz')
+    func = os.path.join(mock_data, 'schaefer_func.nii.gz')
+    scaled = _make_scaled_func(func, tmpdir)
+    expected = NiftiExtractor(scaled, roi_file).discard_scans(3).extract()
+
+    index_dir = os.path.join(tmpdir, 'gzip_index')
+    for _ in range(2):
+        # the index is built once, and then reused
+        actual = NiftiExtractor(scaled, roi_file, gzip_index_dir=index_dir)
+        gzip_file = actual.img.file_map['image'].fileobj
+        actual.discard_scans(3).extract()
+        assert gzip_file.closed
+        assert len(os.listdir(index_dir)) == 1
+        assert np.allclose(actual.timeseries.values, 
+                           expected.timeseries.values)
+
+    out_dir = os.path.join(tmpdir, 'out')
+    cmd = (f"nixtract-nifti {out_dir} --input_files {scaled} "
+           f"--roi_file {roi_file} --discard_scans 3 --gzip_index")
+    subprocess.run(cmd.split())
+    actual = pd.read_table(os.path.join(out_dir, 'scaled_timeseries.tsv'))
+    assert np.allclose(actual.values, expected.timeseries.values)
+    assert os.listdir(os.path.join(out_dir, 'nixtract_data', 'cache', 
+                                   'gzip_index'))
+
+
+def test_uncompressed(data_dir, mock_data, tmpdir):
+
+    roi_file = os.path.join(data_dir, 
+                            'Schaefer2018_100Parcels_7Networks_order_FSLMNI152_2mm.nii.gz')
+    func = os.path.join(mock_data, 'schaefer_func.nii.gz')
+    scaled = _make_scaled_func(func, tmpdir)
+
+    # scaled integer data, which are memory-mapped and then scaled
+    img = nib.load(scaled)
+    img.set_data_dtype(np.int16)
+    img.header.set_slope_inter(0.5, 1.)
+    uncompressed = os.path.join(tmpdir, 'scaled.nii')
+    nib.save(img, uncompressed)
+    img = nib.load(uncompressed)
+    assert img.dataobj.slope == 0.5
+    compressed = os.path.join(tmpdir, 'unscaled.nii.gz')
+    nib.save(nib.Nifti1Image(img.get_fdata(), img.affine), compressed)
+
+    for kwargs in [{}, {'summary': ['mean', 'median']}]:
+        for n_scans in [0, 3]:
+            expected = NiftiExtractor(compressed, roi_file, **kwargs)
+            expected.discard_scans(n_scans).extract()
+            actual = NiftiExtractor(uncompressed, roi_file, **kwargs)
+            actual.discard_scans(n_scans).extract()
+            assert list(actual.timeseries.columns) == \
+                   list(expected.timeseries.columns)
+            for stat in actual.summaries:
+                assert np.allclose(actual.summaries[stat].values, 
+                                   expected.summaries[stat].values)
+
+    cmd = (f"nixtract-nifti {tmpdir} --input_files {uncompressed} "
+           f"--roi_file {roi_file}")
+    subprocess.run(cmd.split())
+    actual = pd.read_table(os.path.join(tmpdir, 'scaled_timeseries.tsv'))
+    expected = np.arange(1, 101) * np.arange(1, 11)[:, np.newaxis] * 0.5 + 1
+    assert np.allclose(actual.values, expected)
+
+
+def test_uncompressed_masker_params(data_dir, mock_data, tmpdir):
+
+    roi_file = os.path.join(data_dir, 
+                            'Schaefer2018_100Parcels_7Networks_order_FSLMNI152_2mm.nii.gz')
+    func = os.path.join(mock_data, 'schaefer_func.nii.gz')
+    img = nib.load(func)
+    rng = np.random.RandomState(1)
+    data = img.get_fdata() + rng.standard_normal(img.shape)
+    compressed = os.path.join(tmpdir, 'noisy.nii.gz')
+    nib.save(nib.Nifti1Image(data, img.affine), compressed)
+    uncompressed = os.path.join(tmpdir, 'noisy.nii')
+    nib.save(nib.Nifti1Image(data, img.affine), uncompressed)
+
+    # parameters that are not applied when reading regions from a memory map
+    # are extracted by the masker, as for .nii.gz images
+    kwargs = dict(resampling_target='labels', high_variance_confounds=True)
+    expected = NiftiExtractor(compressed, roi_file, **kwargs).extract()
+    actual = NiftiExtractor(uncompressed, roi_file, **kwargs).extract()
+    assert np.allclose(actual.timeseries.values, expected.timeseries.values)
+    default = NiftiExtractor(uncompressed, roi_file).extract()
+    assert not np.allclose(actual.timeseries.values, 
+                           default.timeseries.values)
+
+
+def test_uncompressed_roi(data_dir, mock_data, tmpdir):
+
+    roi_file = os.path.join(data_dir, 
+                            'Schaefer2018_100Parcels_7Networks_order_FSLMNI152_2mm.nii.gz')
+    func = os.path.join(mock_data, 'schaefer_func.nii.gz')
+    uncompressed = os.path.join(tmpdir, 'schaefer.nii')
+    nib.save(nib.load(roi_file), uncompressed)
+
+    expected = NiftiExtractor(func, roi_file).extract()
+    actual = NiftiExtractor(func, uncompressed).extract()
+    assert list(actual.timeseries.columns) == \
+           list(expected.timeseries.columns)
+    assert np.array_equal(actual.timeseries.values, 
+                          expected.timeseries.values)
+
+    with pytest.raises(ValueError, match=r'\.nii\.gz, \.nii, \.csv, \.tsv'):
+        NiftiExtractor(func, os.path.join(tmpdir, 'schaefer.mgz'))
+
+    out_dir = os.path.join(tmpdir, 'uncompressed')
+    cmd = (f"nixtract-nifti {out_dir} --input_files {func} "
+           f"--roi_file {uncompressed}")
+    subprocess.run(cmd.split())
+    actual = pd.read_table(os.path.join(out_dir, 'schaefer_func_timeseries.tsv'))
+    assert np.allclose(actual.values, expected.timeseries.values)
+
+
+def test_summary(data_dir, mock_data, tmpdir):
+
+    roi_file = os.path.join(data_dir, 
+                            'Schaefer2018_100Parcels_7Networks_order_FSLMNI152_2mm.nii.gz')
+    func = os.path.join(mock_data, 'schaefer_func.nii.gz')
+
+    cmd = (f"nixtract-nifti {tmpdir} --input_files {func} "
+           f"--roi_file {roi_file} --summary mean median std eigenvariate")
+    subprocess.run(cmd.split())
+
+    expected = np.tile(np.arange(1, 101), (10, 1))
+    for stat in ['mean', 'median']:
+        fname = f'schaefer_func_stat-{stat}_timeseries.tsv'
+        actual = pd.read_table(os.path.join(tmpdir, fname))
+        assert np.array_equal(actual.values, expected)
+    # constant within regions and over time
+    for stat in ['std', 'eigenvariate']:
+        fname = f'schaefer_func_stat-{stat}_timeseries.tsv'
+        actual = pd.read_table(os.path.join(tmpdir, fname))
+        assert actual.shape == expected.shape
+        assert np.allclose(actual.values, 0)
+    assert not os.path.exists(os.path.join(tmpdir, 
+                                           'schaefer_func_timeseries.tsv'))
+
+    # compare against nilearn strategies on non-constant data
+    img = nib.load(func)
+    rng = np.random.RandomState(0)
+    noisy = os.path.join(tmpdir, 'noisy.nii.gz')
+    nib.save(nib.Nifti1Image(img.get_fdata() + rng.standard_normal(img.shape),
+                             img.affine), noisy)
+    extractor = NiftiExtractor(noisy, roi_file, 
+                               summary=['median', 'mean', 'std'], 
+                               detrend=True, smoothing_fwhm=4).extract()
+    assert list(extractor.summaries) == ['median', 'mean', 'std']
+    for stat, strategy in [('mean', 'mean'), ('median', 'median'), 
+                           ('std', 'standard_deviation')]:
+        masker = NiftiLabelsMasker(roi_file, strategy=strategy, detrend=True, 
+                                   smoothing_fwhm=4)
+        expected = masker.fit_transform(noisy)
+        assert np.allclose(extractor.summaries[stat].values, expected)
+    
+    coords = os.path.join(
+        data_dir, 
+        'Schaefer2018_100Parcels_7Networks_order_FSLMNI152_2mm.Centroid_XYZ.tsv'
+    )
+    with pytest.raises(ValueError):
+        NiftiExtractor(func, coords, summary='median')
+    # masker parameters that are not applied to summary statistics
+    for kwargs in [{'high_variance_confounds': True}, 
+                   {'resampling_target': 'labels'}, {'strategy': 'median'}]:
+        with pytest.raises(ValueError, match=list(kwargs)[0]):
+            NiftiExtractor(func, roi_file, summary='median', **kwargs)
+
+
+def test_weighted_atlas(data_dir, mock_data, tmpdir):
+
+    atlas = os.path.join(data_dir, 
+                         'Schaefer2018_100Parcels_7Networks_order_FSLMNI152_2mm.nii.gz')
+    func = os.path.join(mock_data, 'schaefer_func.nii.gz')
+
+    # weight maps of the first 5 regions
+    img = nib.load(atlas)
+    data = img.get_fdata()
+    rng = np.random.RandomState(0)
+    maps = np.stack([(data == i) * rng.uniform(.1, 1, size=data.shape) 
+                     for i in range(1, 6)], axis=-1)
+    roi_file = os.path.join(tmpdir, 'maps.nii.gz')
+    nib.save(nib.Nifti1Image(maps.astype(np.float32), img.affine), roi_file)
+
+    cmd = (f"nixtract-nifti {tmpdir} --input_files {func} "
+           f"--roi_file {roi_file}")
+    subprocess.run(cmd.split())
+    actual = pd.read_table(os.path.join(tmpdir, 'schaefer_func_timeseries.tsv'))
+    assert list(actual.columns) == [f'region{i}' for i in range(1, 6)]
+    expected = np.tile(np.arange(1, 6), (10, 1))
+    assert np.allclose(actual.values, expected)
+
+    # weighted means of non-constant data, with a mask that removes region 1
+    func_img = nib.load(func)
+    noisy = os.path.join(tmpdir, 'noisy.nii.gz')
+    noisy_data = func_img.get_fdata() + rng.standard_normal(func_img.shape)
+    nib.save(nib.Nifti1Image(noisy_data, func_img.affine), noisy)
+    mask = os.path.join(tmpdir, 'mask.nii.gz')
+    nib.save(nib.Nifti1Image((data > 1).astype(np.int8), img.affine), mask)
+    extractor = NiftiExtractor(noisy, roi_file, mask_img=mask).extract()
+
+    weights = maps.reshape(-1, 5)[:, 1:]
+    expected = noisy_data.reshape(-1, 10).T @ weights / weights.sum(axis=0)
+    assert list(extractor.timeseries.columns) == [f'region{i}' 
+                                                  for i in range(2, 6)]
+    assert np.allclose(extractor.timeseries.values, expected)
+
+
+def test_multiple_atlases(data_dir, mock_data, tmpdir):
+
+    atlas = os.path.join(data_dir, 
+                         'Schaefer2018_100Parcels_7Networks_order_FSLMNI152_2mm.nii.gz')
+    coords = os.path.join(
+        data_dir, 
+        'Schaefer2018_100Parcels_7Networks_order_FSLMNI152_2mm.Centroid_XYZ.tsv'
+    )
+    mask = os.path.join(mock_data, 'schaefer_LH_Vis_4.nii.gz')
+    func = os.path.join(mock_data, 'schaefer_func.nii.gz')
+
+    cmd = (f"nixtract-nifti {tmpdir} --input_files {func} "
+           f"--roi_file {atlas} {coords} {mask}")
+    subprocess.run(cmd.split())
+
+    expected = np.tile(np.arange(1, 101), (10, 1))
+    for name in ['Schaefer2018100Parcels7NetworksorderFSLMNI1522mm', 
+                 'Schaefer2018100Parcels7NetworksorderFSLMNI1522mmCentroidXYZ']:
+        fname = f'schaefer_func_atlas-{name}_timeseries.tsv'
+        actual = pd.read_table(os.path.join(tmpdir, fname))
+        assert np.array_equal(actual.values, expected)
+    fname = 'schaefer_func_atlas-schaeferLHVis4_timeseries.tsv'
+    actual = pd.read_table(os.path.join(tmpdir, fname))
+    assert actual.shape == (10, 1)
+    assert np.all(actual.values == 4)
+
+    # labels of each roi file
+    extractor = NiftiExtractor(func, [atlas, mask], 
+                               labels=[None, ['Vis_4']]).extract()
+    assert list(extractor.atlas_summaries['schaeferLHVis4']['mean'].columns) \
+        == ['Vis_4']
+    assert extractor.timeseries.shape == (10, 100)
+    with pytest.raises(ValueError):
+        NiftiExtractor(func, [atlas, mask], labels=[None])
+
+
+def test_prefetch(data_dir, mock_data, tmpdir):
+
+    roi_file = os.path.join(data_dir, 
+                            'Schaefer2018_100Parcels_7Networks_order_FSLMNI152_2mm.nii.gz')
+    func = os.path.join(mock_data, 'schaefer_func.nii.gz')
+    scaled = _make_scaled_func(func, tmpdir)
+    expected = NiftiExtractor(scaled, roi_file).discard_scans(3).extract()
+
+    # read into memory once, without the discarded scans
+    extractor = NiftiExtractor(scaled, roi_file).discard_scans(3).load()
+    assert extractor._loaded.in_memory
+    assert extractor._loaded.shape[3] == 7
+    extractor.extract()
+    assert extractor._loaded is None
+    assert np.allclose(extractor.timeseries.values, 
+                       expected.timeseries.values)
+
+    input_files = []
+    for i in range(3):
+        fname = os.path.join(tmpdir, f'sub-0{i}_bold.nii.gz')
+        shutil.copy2(scaled, fname)
+        input_files.append(fname)
+    outputs = {}
+    # in the main process, and in batches of 2 input files per pool process
+    for prefetch, n_jobs in [(0, 1), (2, 1), (1, 2)]:
+        out_dir = os.path.join(tmpdir, f'prefetch-{prefetch}_jobs-{n_jobs}')
+        cmd = (f"nixtract-nifti {out_dir} --input_files {' '.join(input_files)} "
+               f"--roi_file {roi_file} --discard_scans 3 --prefetch {prefetch} "
+               f"--n_jobs {n_jobs}")
+        subprocess.run(cmd.split())
+        outputs[prefetch, n_jobs] = [
+            pd.read_table(os.path.join(out_dir, f'sub-0{i}_bold_timeseries.tsv'))
+            for i in range(3)
+        ]
+    for key in [(2, 1), (1, 2)]:
+        for actual, expected in zip(outputs[key], outputs[0, 1]):
+            assert np.array_equal(actual.values, expected.values)
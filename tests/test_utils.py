@@ -0,0 +1,744 @@
+"""Unit tests for the shared extraction utilities
+
+Checks are grouped by module:
+    1. Reduction: `LabelReducer` against the original per-label loop
+       (`darray[:, roi == label].mean(axis=1)`) and against dense weighted
+       means, float32 against float64 extractions (`FLOAT32_RTOL`), and the
+       peak memory of `mask_data`, measured with tracemalloc.
+    2. Outputs: every output format round-trips with its labels, the bulk
+       .tsv writer matches `to_csv` byte-for-byte, and the HDF5 store shares
+       labels, indexes, memory-maps and merges outputs.
+    3. Plans: compiled plans round-trip through the on-disk cache and are
+       inherited by pool processes.
+    4. Scheduling: the memory budget, BLAS/OpenMP thread limits of pool
+       processes and the prefetching pipeline.
+    5. Denoising and summaries: `SignalCleaner` against
+       `nilearn.signal.clean`, and summary statistics against numpy/scipy.
+
+Timings are measured outside of the tests, by the scripts in `benchmarks/`.
+"""
+import os
+import gzip
+import json
+import time
+import tracemalloc
+import threading
+from functools import partial
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from threadpoolctl import threadpool_info
+import numpy as np
+import pandas as pd
+import pytest
+from nilearn import signal
+from scipy import stats
+
+from nixtract.extractors import (CiftiExtractor, GiftiExtractor,
+                                 NiftiExtractor)
+from nixtract.cli.base import (parse_memory, estimate_memory, _indexed_job,
+                               _imap_by_memory, threads_per_job,
+                               _limit_threads, _pipeline)
+from nixtract.extractors.base_extractor import atlas_names, atlas_fname
+from nixtract.extractors import plan as plan_module
+from nixtract.extractors.plan import load_plan, file_hash, ExtractionPlan
+from nixtract.extractors.reduction import LabelReducer
+from nixtract.extractors.denoise import SignalCleaner
+from nixtract.extractors.output import (OUTPUT_FORMATS, write_timeseries,
+                                        read_timeseries, check_output_format,
+                                        _write_tsv)
+from nixtract.extractors.summary import (summarize, check_summary,
+                                         summary_fname, TRIM_PROPORTION)
+from nixtract.extractors.utils import (_mask, mask_data, mask_datasets,
+                                      check_precision)
+
+
+def _loop_mask(darray, roi):
+    """Reference implementation of the original per-label extraction"""
+    labels = np.unique(roi)
+    timeseries = np.zeros((darray.shape[0], len(labels)))
+    for i, l in enumerate(labels):
+        timeseries[:, i] = darray[:, roi == l].mean(axis=1)
+    return timeseries
+
+
+@pytest.fixture
+def roi():
+    rng = np.random.RandomState(0)
+    return rng.randint(0, 20, size=5000).astype(float)
+
+
+def test_reducer_matches_loop(roi):
+    rng = np.random.RandomState(1)
+    darray = rng.standard_normal((50, len(roi)))
+
+    reducer = LabelReducer.from_roi(roi)
+    assert np.array_equal(reducer.labels, np.unique(roi))
+    # .mean(axis=1) sums the vertices of each label pairwise, while the
+    # sparse product sums them in order, so float results can differ in the
+    # last bits; the error is relative to the magnitude of the data
+    assert np.allclose(reducer.reduce(darray), _loop_mask(darray, roi),
+                       rtol=1e-10, atol=0)
+
+    # integer-valued data is summed exactly, so results are identical
+    darray = np.tile(roi, (10, 1))
+    assert np.array_equal(reducer.reduce(darray), _loop_mask(darray, roi))
+
+
+def test_reducer_blocks(roi, monkeypatch):
+    # force one timepoint per block
+    monkeypatch.setattr('nixtract.extractors.reduction._BLOCK_BYTES', 1)
+    rng = np.random.RandomState(2)
+    darray = rng.standard_normal((7, len(roi)))
+    reducer = LabelReducer.from_roi(roi)
+    assert np.allclose(reducer.reduce(darray), _loop_mask(darray, roi))
+
+
+def test_reducer_from_weights(roi):
+    rng = np.random.RandomState(3)
+    darray = rng.standard_normal((12, len(roi)))
+    labels = np.unique(roi)[1:]
+
+    # binary maps are the same as labels
+    reducer = LabelReducer.from_weights(roi == l for l in labels)
+    assert np.array_equal(reducer.labels, np.arange(1, len(labels) + 1))
+    assert np.allclose(reducer.reduce(darray), _loop_mask(darray, roi)[:, 1:])
+    assert np.array_equal(reducer.to_roi(), roi)
+
+    # weighted means
+    weights = rng.uniform(0, 1, size=(3, len(roi)))
+    weights[weights < .5] = 0
+    reducer = LabelReducer.from_weights(weights)
+    expected = darray @ weights.T / weights.sum(axis=1)
+    assert np.allclose(reducer.reduce(darray), expected)
+    expected = np.where(weights.max(axis=0) > 0,
+                        weights.argmax(axis=0) + 1, 0)
+    assert np.array_equal(reducer.to_roi(), expected)
+
+    for maps in [[], [np.ones(3), np.ones(4)], [-np.ones(3)], [np.zeros(3)]]:
+        with pytest.raises(ValueError):
+            LabelReducer.from_weights(maps)
+
+
+def test_reducer_expand(roi):
+    rng = np.random.RandomState(4)
+    darray = rng.standard_normal((12, 2 * len(roi)))
+    columns = np.sort(rng.choice(darray.shape[1], len(roi), replace=False))
+    reducer = LabelReducer.from_roi(roi).expand(columns, darray.shape[1])
+    expected = _loop_mask(darray[:, columns], roi)
+    assert np.allclose(reducer.reduce(darray), expected)
+    assert np.allclose(reducer.reduce(darray, lambda x: x * 2), 2 * expected)
+
+
+def test_atlas_names():
+    roi_files = ['/a/Schaefer_400.dlabel.nii', '/b/Schaefer_400.dlabel.nii',
+                 'gordon.nii.gz', 'coords.tsv']
+    assert atlas_names(roi_files) == ['Schaefer4001', 'Schaefer4002',
+                                      'gordon', 'coords']
+    assert (atlas_fname('/out/sub-01_timeseries.tsv', 'gordon') ==
+            '/out/sub-01_atlas-gordon_timeseries.tsv')
+
+
+def test_mask_as_vertices():
+    roi = np.array([0, 4, 4, 0, 4, 0])
+    darray = np.tile(np.arange(6), (3, 1))
+
+    actual = _mask(darray, LabelReducer.from_roi(roi), as_vertices=True)
+    assert np.array_equal(actual, darray[:, [1, 2, 4]])
+
+    with pytest.raises(ValueError):
+        _mask(darray, np.array([0, 1, 2, 0, 1, 2]), as_vertices=True)
+
+
+def test_plan_cache(data_dir, tmpdir):
+    roi_file = os.path.join(
+        data_dir, 'Gordon333_FreesurferSubcortical.32k_fs_LR.dlabel.nii'
+    )
+    cache_dir = os.path.join(tmpdir, 'cache')
+
+    plan = load_plan(roi_file, CiftiExtractor._compile_plan, cache_dir)
+    assert os.listdir(cache_dir) == [file_hash(roi_file)]
+
+    def fail(roi_file):
+        raise AssertionError('plan should be loaded from the cache')
+
+    # from the cache directory, rather than the plans loaded by this process
+    plan_module._LOADED_PLANS.clear()
+    plan = CiftiExtractor._compile_plan(roi_file)
+    cached = load_plan(roi_file, fail, cache_dir)
+    assert np.array_equal(cached.roi, plan.roi)
+    assert cached.labels == plan.labels
+    assert np.array_equal(cached.reducer.labels, plan.reducer.labels)
+    assert (cached.reducer.matrix != plan.reducer.matrix).nnz == 0
+    for struct, model in plan.layout.items():
+        assert np.array_equal(cached.layout[struct]['indices'],
+                              model['indices'])
+        assert cached.layout[struct]['offset'] == model['offset']
+
+    # outdated plans are replaced, leaving nothing else in the cache
+    plan_module._LOADED_PLANS.clear()
+    meta_file = os.path.join(cache_dir, file_hash(roi_file), 'plan.json')
+    with open(meta_file, 'r') as f:
+        meta = json.load(f)
+    with open(meta_file, 'w') as f:
+        json.dump(dict(meta, version=0), f)
+    replaced = load_plan(roi_file, CiftiExtractor._compile_plan, cache_dir)
+    assert np.array_equal(replaced.roi, plan.roi)
+    assert os.listdir(cache_dir) == [file_hash(roi_file)]
+    with open(meta_file, 'r') as f:
+        assert json.load(f)['version'] == plan_module._PLAN_VERSION
+
+
+@pytest.mark.parametrize('labels', [
+    None,
+    ['a', 'b', 'c'],
+    [1, 2, 3],
+    np.array([0.5, 1.5, 2.5]),
+    {np.int32(0): '???', np.int32(1): 'a', np.int32(2): None},
+])
+def test_plan_labels(labels, tmpdir):
+    roi = np.array([0, 1, 2, 2, 1, 0], dtype=float)
+    plan = ExtractionPlan(roi, labels)
+    plan.save(str(tmpdir))
+    cached = ExtractionPlan.load(str(tmpdir))
+    # labels keep their values and types, rather than becoming strings
+    if isinstance(labels, dict):
+        assert cached.labels == plan.labels
+        assert list(cached.labels) == list(plan.labels)
+        assert [type(x) for x in cached.labels.values()] == \
+               [type(x) for x in plan.labels.values()]
+    elif labels is None:
+        assert cached.labels is None
+    else:
+        assert cached.labels == list(plan.labels)
+        assert [type(x) for x in cached.labels] == \
+               [type(np.asarray(x).item()) for x in plan.labels]
+
+    with pytest.raises(ValueError):
+        ExtractionPlan(roi, [b'a', b'b', b'c']).save(str(tmpdir))
+
+
+def test_compiled_plans(data_dir, tmpdir):
+    # plans of each type of roi file compare equal once cached
+    roi_files = [
+        ('Gordon333_FreesurferSubcortical.32k_fs_LR.dlabel.nii',
+         CiftiExtractor),
+        ('lh.Schaefer2018_100Parcels_7Networks_order.annot', GiftiExtractor),
+        ('Schaefer2018_100Parcels_7Networks_order_FSLMNI152_2mm.nii.gz',
+         NiftiExtractor),
+    ]
+    for fname, extractor in roi_files:
+        roi_file = os.path.join(data_dir, fname)
+        plan = extractor._compile_plan(roi_file)
+        path = os.path.join(tmpdir, fname)
+        plan.save(path)
+        cached = ExtractionPlan.load(path)
+        assert cached.labels == plan.labels
+        if isinstance(plan.labels, dict):
+            assert list(cached.labels) == list(plan.labels)
+        assert np.array_equal(cached.roi, plan.roi)
+
+
+@pytest.mark.parametrize('pre_clean', [False, True])
+def test_float32_precision(roi, pre_clean):
+    rng = np.random.RandomState(3)
+    n_timepoints = 100
+    # realistic BOLD-like scale with a shared confound signal
+    regressors = rng.standard_normal((n_timepoints, 6))
+    darray = (1000 + rng.standard_normal((n_timepoints, len(roi))) * 10
+              + regressors @ rng.standard_normal((6, len(roi))))
+    kwargs = dict(detrend=True, standardize=False, low_pass=0.1, t_r=2)
+
+    reducer = LabelReducer.from_roi(roi)
+    expected = mask_data(darray, reducer, regressors, pre_clean=pre_clean,
+                         **kwargs)
+    actual = mask_data(darray.astype(np.float32), reducer, regressors,
+                       pre_clean=pre_clean, **kwargs)
+    assert actual.dtype == np.float32
+    assert check_precision(actual, expected, scale=np.abs(darray).max())
+
+
+def _peak_memory(func, *args, **kwargs):
+    """Return the output of func and its peak traced memory in bytes"""
+    tracemalloc.start()
+    try:
+        out = func(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return out, peak
+
+
+@pytest.mark.parametrize('pre_clean', [False, True])
+@pytest.mark.parametrize('as_vertices', [False, True])
+def test_mask_data_memory(pre_clean, as_vertices, monkeypatch):
+    # 16 MB of data in blocks of at most 1 MB
+    monkeypatch.setattr('nixtract.extractors.reduction._BLOCK_BYTES', 2 ** 20)
+    rng = np.random.RandomState(4)
+    n_timepoints, n_vertices = 100, 20000
+    darray = rng.standard_normal((n_timepoints, n_vertices))
+    regressors = rng.standard_normal((n_timepoints, 3))
+    if as_vertices:
+        # single region covering 0.5% of vertices
+        roi = (np.arange(n_vertices) % 200 == 0).astype(float)
+    else:
+        roi = rng.randint(0, 20, size=n_vertices).astype(float)
+    reducer = LabelReducer.from_roi(roi)
+    kwargs = dict(detrend=True, standardize=True)
+
+    actual, peak = _peak_memory(mask_data, darray, reducer, regressors,
+                                as_vertices=as_vertices, pre_clean=pre_clean,
+                                **kwargs)
+    assert peak / darray.nbytes < 0.5
+
+    # signal.clean of more than ~150 columns depends on the BLAS kernels of
+    # its matrix products, and is wrong with the AVX-512 kernels of some
+    # OpenBLAS builds (OPENBLAS_CORETYPE=Haswell avoids them). Columns are
+    # cleaned independently, so the reference is cleaned 100 columns at a
+    # time, and the region of as_vertices has 100 vertices
+    def clean(x):
+        return np.hstack([signal.clean(x[:, i:i + 100], confounds=regressors,
+                                       **kwargs)
+                          for i in range(0, x.shape[1], 100)])
+
+    if pre_clean:
+        expected = _mask(clean(darray), reducer, as_vertices)
+    else:
+        expected = clean(_mask(darray, reducer, as_vertices))
+    assert np.allclose(actual, expected)
+
+
+@pytest.mark.parametrize('detrend', [False, True])
+@pytest.mark.parametrize('standardize', [False, 'zscore', 'psc'])
+@pytest.mark.parametrize('filters', [
+    {},
+    {'low_pass': 0.1, 't_r': 2},
+    {'high_pass': 0.01, 'low_pass': 0.1, 't_r': 2}
+])
+@pytest.mark.parametrize('use_confounds', [False, True])
+def test_signal_cleaner(detrend, standardize, filters, use_confounds):
+    if standardize == 'psc' and 'high_pass' in filters and not detrend:
+        pytest.skip('high-pass filtering removes the mean required for psc')
+    rng = np.random.RandomState(5)
+    n_timepoints = 80
+    signals = 1000 + rng.standard_normal((n_timepoints, 300)) * 10
+    confounds = None
+    if use_confounds:
+        confounds = rng.standard_normal((n_timepoints, 4))
+    kwargs = dict(detrend=detrend, standardize=standardize,
+                  confounds=confounds, **filters)
+
+    expected = signal.clean(signals, **kwargs)
+    cleaner = SignalCleaner(n_timepoints, n_threads=4, **kwargs)
+    actual = cleaner.transform(signals)
+    assert np.allclose(actual, expected, rtol=0, atol=1e-8 * 1000)
+
+    with pytest.raises(ValueError):
+        cleaner.transform(signals[1:])
+
+
+@pytest.mark.parametrize('pre_clean', [False, True])
+def test_mask_datasets(roi, pre_clean):
+    rng = np.random.RandomState(6)
+    n_timepoints = 60
+    lh = rng.standard_normal((n_timepoints, len(roi)))
+    rh = rng.standard_normal((n_timepoints, 3000))
+    rh_roi = rng.randint(0, 5, size=3000)
+    regressors = rng.standard_normal((n_timepoints, 3))
+    kwargs = dict(detrend=True, standardize=True, low_pass=0.1, t_r=2)
+
+    actual = mask_datasets([lh, rh], [roi, rh_roi], regressors,
+                           pre_clean=pre_clean, **kwargs)
+    expected = [mask_data(x, r, regressors, pre_clean=pre_clean, **kwargs)
+                for x, r in [(lh, roi), (rh, rh_roi)]]
+    assert len(actual) == 2
+    for a, e in zip(actual, expected):
+        assert np.allclose(a, e)
+
+    with pytest.raises(ValueError):
+        mask_datasets([lh, rh[1:]], [roi, rh_roi], pre_clean=pre_clean)
+
+
+@pytest.mark.parametrize('summary', [None, ['mean', 'median']])
+def test_mask_shared_dataset(roi, summary, monkeypatch):
+    rng = np.random.RandomState(10)
+    n_timepoints = 60
+    darray = rng.standard_normal((n_timepoints, len(roi)))
+    other_roi = rng.randint(0, 5, size=len(roi))
+    weights = LabelReducer.from_weights(rng.uniform(0, 1, size=(2, len(roi))))
+    regressors = rng.standard_normal((n_timepoints, 3))
+    kwargs = dict(detrend=True, standardize=True)
+
+    n_cleaned = []
+    transform = SignalCleaner.transform
+    def _transform(self, signals):
+        n_cleaned.append(signals.shape[1])
+        return transform(self, signals)
+    monkeypatch.setattr(SignalCleaner, 'transform', _transform)
+
+    rois = [roi, other_roi] if summary else [roi, other_roi, weights]
+    # the same dataset with several rois, as for multiple CIFTI atlases
+    actual = mask_datasets([darray] * len(rois), rois, regressors,
+                           pre_clean=True, summary=summary, **kwargs)
+    # each vertex is denoised once for all rois
+    assert sum(n_cleaned) == len(roi)
+    expected = [mask_data(darray, x, regressors, pre_clean=True,
+                          summary=summary, **kwargs) for x in rois]
+    for a, e in zip(actual, expected):
+        if summary is None:
+            a, e = {'mean': a}, {'mean': e}
+        assert a.keys() == e.keys()
+        for stat in a:
+            assert np.allclose(a[stat], e[stat])
+
+
+def test_summarize(roi):
+    rng = np.random.RandomState(7)
+    darray = rng.standard_normal((30, len(roi)))
+    reducer = LabelReducer.from_roi(roi)
+    summary = ['median', 'mean', 'std', 'trimmed_mean', 'eigenvariate']
+
+    actual = summarize(darray, reducer, summary)
+    assert list(actual) == summary
+    assert np.allclose(actual['mean'], reducer.reduce(darray))
+    for i, label in enumerate(reducer.labels):
+        x = darray[:, roi == label]
+        assert np.allclose(actual['median'][:, i], np.median(x, axis=1))
+        assert np.allclose(actual['std'][:, i], np.std(x, axis=1))
+        assert np.allclose(actual['trimmed_mean'][:, i],
+                           stats.trim_mean(x, TRIM_PROPORTION, axis=1))
+
+    # regions of a single shared signal with positive loadings
+    signal_ = rng.standard_normal(30)
+    darray = np.outer(signal_, rng.uniform(1, 2, size=len(roi)))
+    eigenvariate = summarize(darray, reducer, ['eigenvariate'])['eigenvariate']
+    centered = signal_ - signal_.mean()
+    for i in range(eigenvariate.shape[1]):
+        r = np.corrcoef(eigenvariate[:, i], centered)[0, 1]
+        assert np.isclose(r, 1)
+
+    # denoising before summarizing
+    actual = summarize(darray, reducer, ['mean', 'median'],
+                       transform=lambda x: x * 2)
+    assert np.allclose(actual['mean'], 2 * reducer.reduce(darray))
+
+
+def test_check_summary():
+    assert check_summary(None) == ['mean']
+    assert check_summary('median') == ['median']
+    assert check_summary(('std', 'mean')) == ['std', 'mean']
+    for summary in [[], ['mean', 'mean'], ['mode']]:
+        with pytest.raises(ValueError):
+            check_summary(summary)
+
+    assert (summary_fname('/out/sub-01_timeseries.tsv', 'median') ==
+            '/out/sub-01_stat-median_timeseries.tsv')
+    assert summary_fname('sub-01.tsv', 'std') == 'sub-01_stat-std.tsv'
+
+
+@pytest.mark.parametrize('output_format', list(OUTPUT_FORMATS))
+def test_write_timeseries(output_format, tmpdir):
+    if output_format in ['parquet', 'feather']:
+        pytest.importorskip('pyarrow')
+    elif output_format == 'hdf5':
+        pytest.importorskip('h5py')
+    elif output_format == 'tsv.zst':
+        pytest.importorskip('zstandard')
+
+    rng = np.random.RandomState(5)
+    timeseries = pd.DataFrame(rng.standard_normal((10, 4)),
+                              columns=['a', 'b', 'c', 'd'])
+    fname = os.path.join(tmpdir,
+                         'sub-01_timeseries' + OUTPUT_FORMATS[output_format])
+    write_timeseries(timeseries, fname, n_decimals=3)
+    actual = read_timeseries(fname)
+    assert list(actual.columns) == list(timeseries.columns)
+    assert np.allclose(actual.values, timeseries.values, atol=5e-4)
+    assert check_output_format(fname=fname) == output_format
+
+    with pytest.raises(ValueError):
+        check_output_format('csv')
+
+
+def test_write_npy_mmap(tmpdir):
+    rng = np.random.RandomState(9)
+    timeseries = pd.DataFrame(rng.standard_normal((20, 4)),
+                              columns=['a', 'b', 'c', 'd'])
+    fname = os.path.join(tmpdir, 'sub-01_timeseries.npy')
+    metadata = {'source': ['sub-01.nii.gz'], 'regressors': ['csf', 'wm']}
+    write_timeseries(timeseries, fname, metadata=metadata)
+
+    with open(os.path.join(tmpdir, 'sub-01_timeseries.json')) as f:
+        sidecar = json.load(f)
+    assert sidecar == {'labels': ['a', 'b', 'c', 'd'], **metadata}
+
+    actual = read_timeseries(fname, mmap_mode='r')
+    assert not actual.values.flags.writeable
+    assert np.array_equal(actual.values, timeseries.values)
+    # each timeseries is contiguous in the file
+    assert actual['c'].values.flags['C_CONTIGUOUS']
+
+
+def _read_bytes(fname):
+    if fname.endswith('.gz'):
+        with gzip.open(fname, 'rb') as f:
+            return f.read()
+    with open(fname, 'rb') as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('output_format', ['tsv', 'tsv.gz'])
+@pytest.mark.parametrize('n_decimals', [None, 1, 3, 8])
+@pytest.mark.parametrize('dtype', ['float64', 'float32'])
+def test_write_tsv(n_decimals, dtype, output_format, tmpdir, monkeypatch):
+    # several blocks of rows, with a partial last block
+    monkeypatch.setattr('nixtract.extractors.output._TSV_BLOCK_ROWS', 16)
+    rng = np.random.RandomState(7)
+    values = rng.standard_normal((50, 5)) * [1, 1e-4, 1e4, -1e-9, 0]
+    timeseries = pd.DataFrame(values.astype(dtype),
+                              columns=['a', 'b c', 'd\te', 'f"g', 7])
+    expected = os.path.join(tmpdir, 'expected.tsv')
+    float_format = f'%.{n_decimals}f' if n_decimals else None
+    timeseries.to_csv(expected, sep='\t', index=False,
+                      float_format=float_format)
+    actual = os.path.join(tmpdir, 'actual.' + output_format)
+    _write_tsv(timeseries, actual, n_decimals, output_format)
+    assert _read_bytes(actual) == _read_bytes(expected)
+
+    # missing values are written by pandas, also a block of rows at a time
+    timeseries.iloc[3, 1] = np.nan
+    timeseries.to_csv(expected, sep='\t', index=False,
+                      float_format=float_format)
+    n_rows = []
+    to_csv = pd.DataFrame.to_csv
+    def _to_csv(self, *args, **kwargs):
+        n_rows.append(len(self))
+        return to_csv(self, *args, **kwargs)
+    monkeypatch.setattr(pd.DataFrame, 'to_csv', _to_csv)
+    _write_tsv(timeseries, actual, n_decimals, output_format)
+    assert _read_bytes(actual) == _read_bytes(expected)
+    assert n_rows == [16, 16, 16, 2]
+
+    # header only
+    monkeypatch.undo()
+    timeseries.iloc[:0].to_csv(expected, sep='\t', index=False)
+    _write_tsv(timeseries.iloc[:0], actual, n_decimals, output_format)
+    assert _read_bytes(actual) == _read_bytes(expected)
+
+
+def test_timeseries_store(tmpdir, monkeypatch):
+    pytest.importorskip('h5py')
+    from nixtract.extractors.store import TimeseriesStore
+
+    rng = np.random.RandomState(6)
+    a = pd.DataFrame(rng.standard_normal((10, 3)), columns=['x', 'y', 'z'])
+    b = pd.DataFrame(rng.standard_normal((8, 3)), columns=['x', 'y', 'z'])
+    c = pd.DataFrame(rng.standard_normal((8, 2)), columns=[1, 2])
+
+    fname = os.path.join(tmpdir, 'timeseries.h5')
+    with TimeseriesStore(fname) as store:
+        store.set_metadata({'parameters': {'n_jobs': 2}})
+        store.append('sub-01_timeseries', a, 'sub-01.nii.gz')
+        store.append('sub-02_timeseries', c)
+        # replace an existing output
+        store.append('sub-02_timeseries', b, 'sub-02.nii.gz')
+    with TimeseriesStore(fname) as store:
+        store.append('sub-03_timeseries', c, 'sub-03.nii.gz')
+
+    with TimeseriesStore(fname, mode='r') as store:
+        assert store.keys() == ['sub-01_timeseries', 'sub-02_timeseries',
+                                'sub-03_timeseries']
+        assert store.metadata == {'parameters': {'n_jobs': 2}}
+        index = store.index()
+        assert list(index['source']) == ['sub-01.nii.gz', 'sub-02.nii.gz',
+                                         'sub-03.nii.gz']
+        assert list(index['n_timepoints']) == [10, 8, 8]
+        # identical labels share a single table
+        assert index['labels'][0] == index['labels'][1]
+        assert index['labels'][0] != index['labels'][2]
+
+        actual = store.read('sub-02_timeseries', mmap=True)
+        # memory-mapped read-only from the file rather than read
+        assert not actual.values.flags.writeable
+        assert list(actual.columns) == ['x', 'y', 'z']
+        assert np.array_equal(actual.values, b.values)
+        assert store.labels('sub-03_timeseries') == ['1', '2']
+
+    # outputs are found from the rows of the index kept in memory, without
+    # building the index of every output
+    with TimeseriesStore(fname) as store:
+        def _fail(*args):
+            raise AssertionError('index should not be built')
+        monkeypatch.setattr(store, 'index', _fail)
+        assert 'sub-02_timeseries' in store
+        assert store.keys() == ['sub-01_timeseries', 'sub-02_timeseries',
+                                'sub-03_timeseries']
+        assert store.labels('sub-01_timeseries') == ['x', 'y', 'z']
+
+    # merged from the store file of another process
+    shard = os.path.join(tmpdir, 'shard.h5')
+    with TimeseriesStore(shard, mode='w') as store:
+        store.append('sub-04_timeseries', a, 'sub-04.nii.gz')
+        store.append('sub-01_timeseries', b)
+    with TimeseriesStore(fname) as store:
+        store.merge(shard)
+        assert store.keys() == ['sub-01_timeseries', 'sub-02_timeseries',
+                                'sub-03_timeseries', 'sub-04_timeseries']
+        index = store.index().set_index('key')
+        assert index.loc['sub-04_timeseries', 'source'] == 'sub-04.nii.gz'
+        assert index.loc['sub-01_timeseries', 'source'] == ''
+        assert np.array_equal(store.read('sub-01_timeseries').values,
+                              b.values)
+        assert np.array_equal(store.read('sub-04_timeseries').values,
+                              a.values)
+
+    fname = os.path.join(tmpdir, 'compressed.h5')
+    with TimeseriesStore(fname, compression='gzip') as store:
+        store.append('sub-01_timeseries', a)
+        assert np.array_equal(store.read('sub-01_timeseries').values, a.values)
+        with pytest.raises(ValueError):
+            store.read('sub-01_timeseries', mmap=True)
+
+
+def test_parse_memory():
+    assert parse_memory(None) is None
+    assert parse_memory('1024') == 1024
+    assert parse_memory('512M') == 512 * 2 ** 20
+    assert parse_memory('1.5g') == int(1.5 * 2 ** 30)
+    assert parse_memory('16GB') == 16 * 2 ** 30
+    for value in ['lots', '0', '-1G']:
+        with pytest.raises(ValueError):
+            parse_memory(value)
+
+
+def test_estimate_memory():
+    params = {'precision': None}
+    assert estimate_memory(100, np.int16, params) == 100 * (2 + 8)
+    assert estimate_memory(100, np.int16, params, scaled=True) == 100 * 18
+    params = {'precision': 'float32', 'denoise_pre_extract': True,
+              'as_vertices': True}
+    assert estimate_memory(100, np.float32, params) == 100 * (4 + 3 * 4)
+
+
+def test_imap_by_memory():
+    footprints = [6, 3, 3, 12, 2, 2, 2, 5]
+    lock = threading.Lock()
+    running, peaks = [], []
+
+    def _job(args):
+        with lock:
+            running.append(args)
+            peaks.append((sum(running), len(running)))
+        time.sleep(0.05)
+        with lock:
+            running.remove(args)
+        return args
+
+    with ThreadPool(4) as pool:
+        job = partial(_indexed_job, _job)
+        results = list(_imap_by_memory(pool, job, footprints, footprints,
+                                       max_memory=10, n_jobs=4))
+
+    assert sorted(i for i, _ in results) == list(range(len(footprints)))
+    assert all(footprints[i] == x for i, x in results)
+    # the job over budget runs on its own, and the others within the budget
+    assert (12, 1) in peaks
+    assert all(n == 1 or x <= 10 for x, n in peaks)
+    # small jobs run alongside each other
+    assert max(n for _, n in peaks) >= 3
+
+
+def test_threads_per_job(monkeypatch):
+    monkeypatch.setattr(os, 'cpu_count', lambda: 32)
+    assert threads_per_job({'n_jobs': 1}) is None
+    assert threads_per_job({'n_jobs': 8}) == 4
+    assert threads_per_job({'n_jobs': 64}) == 1
+    # no more processes than input files
+    assert threads_per_job({'n_jobs': 8}, n_inputs=2) == 16
+    assert threads_per_job({'n_jobs': 8}, n_inputs=1) is None
+    assert threads_per_job({'n_jobs': 8, 'threads_per_job': 2}) == 2
+    assert threads_per_job({'n_jobs': 1, 'threads_per_job': 2}) == 2
+
+
+def test_limit_threads():
+    with multiprocessing.Pool(1, initializer=_limit_threads,
+                              initargs=(2,)) as pool:
+        info = pool.apply(threadpool_info)
+    # numpy's BLAS, at least
+    assert info
+    assert all(x['num_threads'] == 2 for x in info)
+
+
+def test_pipeline():
+    lock = threading.Lock()
+    loaded, written = [], []
+
+    def _load(x):
+        time.sleep(0.05)
+        with lock:
+            loaded.append(x)
+        return x
+
+    def _compute(x):
+        time.sleep(0.05)
+        # 2 items loaded ahead, 1 computed and 1 written, at most
+        with lock:
+            assert len(loaded) - len(written) <= 4
+        return x * 10
+
+    def _write(x):
+        time.sleep(0.05)
+        with lock:
+            written.append(x)
+        return x + 1
+
+    items = list(range(8))
+    results = list(_pipeline(items, _load, _compute, _write, n_prefetch=2))
+    assert results == [x * 10 + 1 for x in items]
+
+    def _fail(x):
+        if x == 3:
+            raise ValueError('Invalid item')
+        return x
+
+    results = _pipeline(items, _fail, _compute, _write)
+    with pytest.raises(ValueError):
+        list(results)
+
+
+def _loaded_plans(_):
+    """Plans loaded by a pool process"""
+    return list(plan_module._LOADED_PLANS)
+
+
+def test_shared_plans(data_dir, mock_data, tmpdir, monkeypatch):
+    roi_file = os.path.join(
+        data_dir, 'Gordon333_FreesurferSubcortical.32k_fs_LR.dlabel.nii'
+    )
+    cache_dir = os.path.join(tmpdir, 'cache')
+    plan_module._LOADED_PLANS.clear()
+
+    plan = load_plan(roi_file, CiftiExtractor._compile_plan, cache_dir)
+    # memory-mapped read-only from the cache, including the plan just stored
+    for values in [plan.roi, plan.reducer.matrix.indices,
+                   plan.reducer.matrix.data]:
+        base = values
+        while base is not None and not isinstance(base, np.memmap):
+            base = base.base
+        assert base is not None
+        assert not values.flags.writeable
+
+    # loaded once per process, without reading the roi file again
+    def fail(*args):
+        raise AssertionError('plan should already be loaded')
+
+    monkeypatch.setattr(plan_module, 'file_hash', fail)
+    assert load_plan(roi_file, fail, cache_dir) is plan
+    extractor = CiftiExtractor(os.path.join(mock_data, 'gordon.dtseries.nii'),
+                               roi_file, cache_dir=cache_dir)
+    assert extractor.plan is plan
+
+    # pool processes start with the plans loaded by the main process
+    ctx = multiprocessing.get_context('fork')
+    with ctx.Pool(1) as pool:
+        loaded = pool.map(_loaded_plans, [0])
+    assert loaded == [list(plan_module._LOADED_PLANS)]